@@ -1,15 +1,16 @@
 from __future__ import annotations
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from enum import Enum
+from pathlib import Path
 from typing import assert_never
 import streamlit as st
 from typer.models import NoneType
 import pandas as pd
 import numpy as np
 
-from pilooper.mixer import Mixer
-from pilooper.playback import Speaker
-from pilooper.record import Mic
+from pilooper.audio_format import DEFAULT_FORMAT, AudioFormat
+from pilooper.engine import Engine, EngineError, EngineProcess
+from pilooper.session import SessionError
 
 
 @dataclass
@@ -37,6 +38,9 @@ class UIState:
     reset: MaybeBool
     mix: MaybeBool
     clip_50: MaybeBool
+    calibrate: MaybeBool
+    # mac address of the output device
+    output_device: str | None = None
 
 
 class ControllerState(Enum):
@@ -50,41 +54,93 @@ def warn(msg: str):
 
 @dataclass
 class Controller:
-    mixer: Mixer
-    mic: Mic
-    speaker: Speaker
+    engine: Engine | EngineProcess
     state: ControllerState
+    output_device: str | None = None
 
     @classmethod
-    def from_defaults(cls, track_length_seconds: int) -> Controller:
-        mixer = Mixer.create_mixer(track_length_seconds=track_length_seconds)
-        mic = Mic.from_blueyeti(callback=mixer.mic_callback)
-        speaker = Speaker.from_bt_headphones(callback=mixer.speaker_callback)
-
-        return cls(
-            mixer=mixer, mic=mic, speaker=speaker, state=ControllerState.READY_TO_RECORD
+    def from_defaults(
+        cls,
+        track_length_seconds: int,
+        storage_dir: Path | None = None,
+        metrics_port: int | None = None,
+        isolate: bool = True,
+        format: AudioFormat = DEFAULT_FORMAT,
+        adaptive_buffer: bool = True,
+    ) -> Controller:
+        """metrics_port : serve prometheus metrics on this port (None : dont)
+        isolate : run the audio engine in its own process (see EngineProcess)
+        format : sample rate / channels of the audio (see AudioFormat)
+        adaptive_buffer : adapt the frames per buffer to the output device
+        (see buffer_size.py), only in its own process
+        """
+        engine_kwargs = dict(
+            track_length_seconds=track_length_seconds,
+            storage_dir=storage_dir,
+            metrics_port=metrics_port,
+            format=format,
+            adaptive_buffer=adaptive_buffer and isolate,
+        )
+        engine = (
+            EngineProcess.start(**engine_kwargs)
+            if isolate
+            else Engine.create(**engine_kwargs)
         )
+        return cls(engine=engine, state=ControllerState.READY_TO_RECORD)
 
     def _start_metronome(self, bpm: MaybeInt):
         assert bpm.value is not None
-        self.mixer.add_metronome(bpm.value)
-        self.mixer.start_metronome()
+        self.engine.add_metronome(bpm.value)
+        self.engine.start_metronome()
+
+    def callback_stats(self, window: int | None = None) -> pd.DataFrame:
+        """rolling runtime / xrun stats of the audio callbacks, one row each"""
+        stats = self.engine.callback_stats(window)
+        return pd.DataFrame([asdict(s) for s in stats]).set_index("name")
+
+    def dump_callback_stats(self, path: Path, window: int | None = None):
+        self.engine.dump_callback_stats(path, window)
+
+    def save_session(self):
+        self.engine.save_session()
+
+    def load_session(self) -> dict | None:
+        """loads the saved session, returns its metadata (None : it couldnt be
+        loaded)"""
+        try:
+            return self.engine.load_session()
+        except (SessionError, EngineError) as e:
+            warn(f"couldnt load the session : {e}")
+            return None
 
     def _update_plots(self):
-        np_mic = np.frombuffer(self.mixer.mic_track.track.data, np.int16).astype(
-            np.float32
-        )
-        np_mic = np_mic[::5][:500_000]
+        # note : the first channel of every 5th frame
+        channels = self.engine.audio_format().channels
+        np_mic = self.engine.track("mic")[:: 5 * channels].astype(np.float32)
+        np_mic = np_mic[:500_000]
         df = pd.DataFrame({"y": np_mic})
         st.line_chart(data=df, x=None, y="y")
 
+    def _update_output_device(self, ui_state: UIState):
+        device = ui_state.output_device
+        if device is not None and device != self.output_device:
+            self.engine.set_output_device(device)
+            self.output_device = device
+
     def _state_ready_to_record(self, ui_state: UIState):
+        self._update_output_device(ui_state)
+
+        # measure the round trip latency, takes are shifted to make up for it
+        if ui_state.calibrate:
+            latency = self.engine.calibrate_latency()
+            sample_rate = self.engine.audio_format().sample_rate
+            st.toast(f"round trip latency : {latency / sample_rate * 1000:.1f} ms")
         # metronome
         if ui_state.enable_metronome.has_changed:
             if ui_state.enable_metronome.value:
                 self._start_metronome(ui_state.bpm)
             else:
-                self.mixer.stop_metronome()
+                self.engine.stop_metronome()
 
         # beat sync
         if ui_state.enable_beat_sync.has_changed:
@@ -93,31 +149,31 @@ class Controller:
                 bpm = ui_state.bpm.value
             else:
                 bpm = None
-            self.mixer.set_bpm(bpm)
+            self.engine.set_bpm(bpm)
 
         # clip mic track to 50%
         if ui_state.clip_50.has_changed:
-            self.mixer.set_clip50(ui_state.clip_50.value)
+            self.engine.set_clip50(ui_state.clip_50.value)
 
         # bpm has changed, restart metronome / beat-sync
         if ui_state.bpm.has_changed:
-            if self.mixer.metronome is not None:
-                self.mixer.stop_metronome()
+            if self.engine.has_metronome():
+                self.engine.stop_metronome()
                 self._start_metronome(ui_state.bpm)
             if ui_state.enable_beat_sync.value:
-                self.mixer.set_bpm(ui_state.bpm.value)
+                self.engine.set_bpm(ui_state.bpm.value)
 
         assert ui_state.stop.value is False
         assert ui_state.mix.value is False
 
         # reset everything so far
         if ui_state.reset:
-            self.mixer.reset()
+            self.engine.reset()
             return
 
         # start recording
         if ui_state.record:
-            self.mic.start()
+            self.engine.record()
             self.state = ControllerState.RECORDING
 
     def _state_recording(self, ui_state: UIState):
@@ -127,29 +183,30 @@ class Controller:
 
         # clip mic track to 50%
         if ui_state.clip_50.has_changed:
-            self.mixer.set_clip50(ui_state.clip_50.value)
+            self.engine.set_clip50(ui_state.clip_50.value)
 
         if ui_state.record:
             warn("mixer is already recording!")
             return
 
+        if ui_state.calibrate:
+            warn("cant calibrate while recording!")
+            return
+
         if ui_state.stop:
-            self.mic.stop()
-            self.mixer.reset_mic_track()
+            self.engine.stop()
             self.state = ControllerState.READY_TO_RECORD
             return
 
         # reset everything so far
         if ui_state.reset:
-            self.mic.stop()
-            self.mixer.reset()
+            self.engine.reset()
             self.state = ControllerState.READY_TO_RECORD
             return
 
         if ui_state.mix:
-            self.mic.stop()
             # self._update_plots()
-            self.mixer.mix()
+            self.engine.mix()
             self.state = ControllerState.READY_TO_RECORD
             return
 
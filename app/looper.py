@@ -7,12 +7,20 @@ from dataclasses import dataclass, asdict, field
 from gpiozero import Button
 from threading import Thread
 import time
+from pathlib import Path
 from streamlit.runtime.scriptrunner.script_run_context import get_script_run_ctx
 from streamlit.runtime.scriptrunner import add_script_run_ctx
 
-from app.controller import Controller, MaybeBool, MaybeInt, UIState
+from app.controller import (
+    Controller,
+    ControllerState,
+    MaybeBool,
+    MaybeInt,
+    UIState,
+)
 from app.notify import notify
 from pilooper.constants import MAC_ADDRESS_HEADPHONES, MAC_ADDRESS_SPEAKER
+from pilooper.metrics import METRICS_PORT
 
 
 @dataclass
@@ -78,6 +86,7 @@ class Callbacks:
             "mix_cb",
             "stop_cb",
             "clip_50_cb",
+            "calibrate_cb",
         }
     )
 
@@ -111,6 +120,9 @@ class Callbacks:
         curr_ui_state.mix.has_changed = st.session_state.get("mix_cb", False)
         curr_ui_state.stop.has_changed = st.session_state.get("stop_cb", False)
         curr_ui_state.clip_50.has_changed = st.session_state.get("clip_50_cb", False)
+        curr_ui_state.calibrate.has_changed = st.session_state.get(
+            "calibrate_cb", False
+        )
 
 
 @st.cache_resource
@@ -159,11 +171,14 @@ def add_updates_from_gpio(ui_state: UIState):
     st.session_state["gpio_stop"] = False
 
 
+MAC_ADDRESSES = {
+    "headphones": MAC_ADDRESS_HEADPHONES,
+    "speaker": MAC_ADDRESS_SPEAKER,
+}
+
+
 def connect_speaker(speaker_choice: str, prev_speaker_choice: str | None):
-    mac_addresses = {
-        "headphones": MAC_ADDRESS_HEADPHONES,
-        "speaker": MAC_ADDRESS_SPEAKER,
-    }
+    mac_addresses = MAC_ADDRESSES
 
     # nothing to do
     if prev_speaker_choice is not None and prev_speaker_choice == speaker_choice:
@@ -257,6 +272,15 @@ def sidebar() -> UIState:
             # note : setting the speaker choice even if the call fails because the radio
             # button gets set anyway
 
+            calibrate = st.button(
+                ":gray-background[:stopwatch: Calibrate latency]",
+                key="calibrate_button",
+                help="plays a test signal to measure the latency of the output, overdubs are shifted to make up for it",
+                use_container_width=True,
+                on_click=cb.default,
+                args=("calibrate_cb",),
+            )
+
         with st.container(border=True):
             record_button = RecordButton(
                 name="record",
@@ -306,6 +330,8 @@ def sidebar() -> UIState:
             reset=MaybeBool(reset),
             mix=MaybeBool(mix),
             clip_50=MaybeBool(clip_50),
+            calibrate=MaybeBool(calibrate),
+            output_device=MAC_ADDRESSES.get(st.session_state.get("speaker_choice", "")),
         )
         add_updates_from_gpio(ui_state)
 
@@ -320,15 +346,59 @@ def sidebar() -> UIState:
 @st.cache_resource
 def setup() -> Controller:
     max_track_length_seconds = 3 * 60
-    controller = Controller.from_defaults(track_length_seconds=max_track_length_seconds)
-    controller.speaker.start()
+    controller = Controller.from_defaults(
+        track_length_seconds=max_track_length_seconds, metrics_port=METRICS_PORT
+    )
+    controller.engine.start_speaker()
     return controller
 
 
+def callback_stats(controller: Controller):
+    with st.expander("Callback stats :stopwatch:"):
+        st.dataframe(controller.callback_stats().T, use_container_width=True)
+        if st.button("Dump callback stats", key="dump_stats_button"):
+            path = Path(f"callback_stats_{time.strftime('%Y%m%d_%H%M%S')}.json")
+            controller.dump_callback_stats(path)
+            st.toast(f"saved callback stats to {path.resolve()}")
+
+
+def load_session(controller: Controller):
+    # note : an on_click callback runs before the sidebar is drawn, so its
+    # widgets can still be set to the settings of the session
+    session = controller.load_session()
+    if session is None:
+        return
+    metronome = session["metronome"]
+    bpm = session["bpm"] or (metronome["bpm"] if metronome is not None else None)
+    st.session_state["bpm"] = bpm
+    st.session_state["enable_beat_sync"] = session["bpm"] is not None
+    st.session_state["enable_metronome"] = bool(metronome and metronome["enabled"])
+    st.session_state["clip_50"] = bool(session["clip_50"])
+    st.toast("loaded the session")
+
+
+def session(controller: Controller):
+    with st.expander("Session :floppy_disk:"):
+        recording = controller.state == ControllerState.RECORDING
+        if st.button("Save session", key="save_session_button", disabled=recording):
+            controller.save_session()
+            st.toast("saved the session")
+        st.button(
+            "Load session",
+            key="load_session_button",
+            help="loads the saved loop, bpm and metronome / sync settings",
+            disabled=recording,
+            on_click=load_session,
+            args=(controller,),
+        )
+
+
 def main():
     controller = setup()
     ui_state = sidebar()
     controller.update(ui_state)
+    callback_stats(controller)
+    session(controller)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+from __future__ import annotations
+from dataclasses import dataclass, replace
+import numpy as np
+import pyaudio
+import pilooper.constants as constants
+
+# bit depth -> (numpy sample type, portaudio sample format). the devices are
+# int16, float32 is the mix bus (in int16 units, see AudioFormat.bus)
+SAMPLE_TYPES = {
+    16: (np.int16, pyaudio.paInt16),
+    32: (np.float32, pyaudio.paFloat32),
+}
+# bit depth of the mix bus
+BUS_BIT_DEPTH = 32
+
+
+@dataclass(frozen=True)
+class AudioFormat:
+    """sample rate, bit depth and channel count of the audio
+
+    samples are interleaved, a frame holds one sample per channel. the mixer,
+    tracks and callbacks count frames, bytes only come up at the buffers (see
+    to_bytes() / to_frames())
+    """
+
+    sample_rate: int = constants.SAMPLING_RATE
+    channels: int = 1
+    bit_depth: int = 16
+
+    def __post_init__(self):
+        if self.bit_depth not in SAMPLE_TYPES:
+            raise ValueError(f"{self.bit_depth} bit audio isnt supported")
+        assert self.channels > 0 and self.sample_rate > 0
+
+    @property
+    def dtype(self) -> type[np.number]:
+        return SAMPLE_TYPES[self.bit_depth][0]
+
+    @property
+    def pa_format(self) -> int:
+        return SAMPLE_TYPES[self.bit_depth][1]
+
+    @property
+    def sample_width(self) -> int:
+        """bytes per sample"""
+        return self.bit_depth // 8
+
+    @property
+    def frame_bytes(self) -> int:
+        return self.sample_width * self.channels
+
+    @property
+    def bus(self) -> AudioFormat:
+        """the format the mixer sums in : float32, so that overdubs add up with
+        headroom and are only rounded / limited to int16 on the way out"""
+        return replace(self, bit_depth=BUS_BIT_DEPTH)
+
+    def to_bytes(self, num_frames: int) -> int:
+        return num_frames * self.frame_bytes
+
+    def to_frames(self, num_bytes: int) -> int:
+        return num_bytes // self.frame_bytes
+
+    def frames_in(self, seconds: float) -> int:
+        return round(seconds * self.sample_rate)
+
+    def frames(self, data) -> np.ndarray:
+        """(num_frames, channels) view of the buffer data"""
+        return np.frombuffer(data, dtype=self.dtype).reshape(-1, self.channels)
+
+
+# what the looper ran at before the format was configurable
+DEFAULT_FORMAT = AudioFormat()
@@ -0,0 +1,138 @@
+"""adapts the frames per buffer of the audio streams to the output device
+
+without a frames_per_buffer portaudio picks one, which is rarely the best
+one : a wired output keeps up with small buffers (low latency), bluetooth
+needs bigger ones. BufferSizer starts small and doubles the size whenever
+the callbacks glitch (xruns, or a callback close to its deadline), halves it
+again once a size has played clean for a while, and never goes back down to
+a size that glitched. the size a device settles on is stored (like its round
+trip latency, see latency.py) and is where it starts the next time
+"""
+
+from __future__ import annotations
+from dataclasses import dataclass, field
+from pathlib import Path
+import json
+import numpy as np
+import pyaudio
+import pilooper.constants as constants
+from pilooper.instrument import Column, Instrumentation
+
+MIN_FRAMES_PER_BUFFER = 64
+MAX_FRAMES_PER_BUFFER = 4096
+# audio a size has to play without glitches to be settled on
+SETTLE_SECONDS = 10.0
+# callbacks right after the streams are (re)opened often flag xruns while the
+# buffers fill up, theyre not held against the size
+WARMUP_SECONDS = 0.5
+# a callback that takes more than this much of its deadline counts as a glitch,
+# its one slow callback away from an xrun
+MAX_LOAD = 0.8
+XRUN_FLAGS = (
+    pyaudio.paInputUnderflow
+    | pyaudio.paInputOverflow
+    | pyaudio.paOutputUnderflow
+    | pyaudio.paOutputOverflow
+)
+
+
+def load_buffer_sizes(path: Path = constants.BUFFER_SIZE_FILE) -> dict[str, int]:
+    """settled frames per buffer by output device"""
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def save_buffer_size(
+    device: str, frames_per_buffer: int, path: Path = constants.BUFFER_SIZE_FILE
+):
+    sizes = load_buffer_sizes(path)
+    sizes[device] = frames_per_buffer
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(sizes, indent=2))
+
+
+@dataclass
+class BufferSizer:
+    """picks the frames per buffer from the callback records (see
+    Instrumentation), see poll()"""
+
+    frames_per_buffer: int = MIN_FRAMES_PER_BUFFER
+    # largest size that glitched, sizes up to it arent tried again
+    glitched: int = 0
+    # size that last played clean for SETTLE_SECONDS (None : none so far)
+    settled: int | None = None
+    # audio (in frames) played at frames_per_buffer so far, by callback ring :
+    # separate mic and speaker streams each have their own callbacks
+    num_frames: dict[str, int] = field(default_factory=dict)
+    # read position in each callback ring
+    read_idx: dict[str, int] = field(default_factory=dict)
+
+    @classmethod
+    def create(cls, frames_per_buffer: int | None = None) -> BufferSizer:
+        """frames_per_buffer : to start from (say the stored size of the
+        device), MIN_FRAMES_PER_BUFFER if None"""
+        if frames_per_buffer is None:
+            return cls()
+        return cls(
+            frames_per_buffer=min(
+                max(frames_per_buffer, MIN_FRAMES_PER_BUFFER), MAX_FRAMES_PER_BUFFER
+            )
+        )
+
+    def poll(self, instrumentation: Instrumentation) -> int | None:
+        """looks at the callbacks since the last poll, returns the size to
+        reopen the streams at (None : keep the current one)"""
+        records = {}
+        for ring in instrumentation.rings:
+            records[ring.name], self.read_idx[ring.name], _ = ring.read_from(
+                self.read_idx.get(ring.name, 0)
+            )
+        return self.update(records, instrumentation.sample_rate)
+
+    def update(self, records: dict[str, np.ndarray], sample_rate: int) -> int | None:
+        """poll() on the records (see Column) of the new callbacks of each
+        ring, by name"""
+        size = self.frames_per_buffer
+        glitched = False
+        for name, ring_records in records.items():
+            glitched |= self._glitched(name, ring_records, sample_rate)
+        if glitched:
+            self.glitched = max(self.glitched, size)
+            if self.settled is not None and self.settled <= size:
+                self.settled = None
+            return self._resize(min(2 * size, MAX_FRAMES_PER_BUFFER))
+
+        played = max(self.num_frames.values(), default=0)
+        if played < SETTLE_SECONDS * sample_rate or self.settled == size:
+            return None
+        self.settled = size
+        # try the next size down, unless its known to glitch
+        smaller = size // 2
+        if smaller >= MIN_FRAMES_PER_BUFFER and smaller > self.glitched:
+            return self._resize(smaller)
+        return None
+
+    def _glitched(self, name: str, records: np.ndarray, sample_rate: int) -> bool:
+        """whether any of the new callbacks of ring name (past the warmup)
+        glitched at the current size"""
+        size = self.frames_per_buffer
+        # note : callbacks of the previous size can still be in the rings
+        records = records[records[:, Column.FRAME_COUNT] == size]
+        warmup = round(WARMUP_SECONDS * sample_rate)
+        num_frames = self.num_frames.get(name, 0)
+        played = num_frames + size * np.arange(1, len(records) + 1)
+        records = records[played > warmup]
+        self.num_frames[name] = num_frames + size * len(played)
+
+        deadline_ns = size / sample_rate * 1e9
+        xruns = records[:, Column.STATUS] & XRUN_FLAGS
+        overloaded = records[:, Column.RUNTIME_NS] > MAX_LOAD * deadline_ns
+        return bool(np.any(xruns) or np.any(overloaded))
+
+    def _resize(self, size: int) -> int | None:
+        self.num_frames = {}
+        if size == self.frames_per_buffer:
+            return None
+        self.frames_per_buffer = size
+        return size
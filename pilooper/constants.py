@@ -1,3 +1,11 @@
+from pathlib import Path
+
 SAMPLING_RATE = 44_100
 MAC_ADDRESS_HEADPHONES = "2A:85:3F:3B:7B:D4"
 MAC_ADDRESS_SPEAKER = "00:0C:8A:43:83:85"
+METRONOME_WAV = Path("~/dev/drumstick_16.wav").expanduser()
+# measured round trip latencies, by output device (see latency.py)
+LATENCY_FILE = Path("~/.config/pilooper/latency.json").expanduser()
+# settled frames per buffer of the audio streams, by output device (see
+# buffer_size.py)
+BUFFER_SIZE_FILE = Path("~/.config/pilooper/buffer_size.json").expanduser()
@@ -0,0 +1,252 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+import numpy as np
+
+INT16_MIN = np.iinfo(np.int16).min
+INT16_MAX = np.iinfo(np.int16).max
+
+# number of samples processed at a time by the mixing kernels. a block of 16k
+# float32 samples (64kB, the scratch) stays in the l2 cache of a pi-5
+BLOCK_SAMPLES = 16_384
+# limiter (see Limiter) : gain changes are ramped over LIMITER_RAMP_FRAMES, and
+# every block the gain recovers LIMITER_RELEASE of the way back to 1 (and snaps
+# to 1 once its within LIMITER_SNAP)
+LIMITER_RAMP_FRAMES = 64
+LIMITER_RELEASE = 0.05
+LIMITER_SNAP = 1e-4
+
+
+def _flat(x: np.ndarray) -> np.ndarray:
+    """1d view of x, a block of interleaved frames (num_frames, channels)"""
+    flat = x.view()
+    # note : setting the shape raises instead of silently copying
+    flat.shape = (x.size,)
+    return flat
+
+
+def tile_into(x: np.ndarray, period: int):
+    """repeats x[:period] over the rest of x, in place (x[i] = x[i % period])
+
+    the tiled kernels index the first axis : samples, or frames of a
+    (num_frames, channels) array
+    """
+    assert period > 0
+    for start in range(period, len(x), period):
+        n = min(period, len(x) - start)
+        x[start : start + n] = x[:n]
+
+
+def _tiled_chunks(num_dst: int, num_src: int, offset: int):
+    """splits dst[i] <- src[(offset + i) % num_src] into (dst_start, src_start, n)
+    chunks that dont wrap around the end of src"""
+    assert num_src > 0
+    start = 0
+    while start < num_dst:
+        src_start = (offset + start) % num_src
+        n = min(num_src - src_start, num_dst - start)
+        yield start, src_start, n
+        start += n
+
+
+def copy_tiled(dst: np.ndarray, src: np.ndarray, offset: int = 0):
+    """dst[i] = src[(offset + i) % len(src)]"""
+    for start, src_start, n in _tiled_chunks(len(dst), len(src), offset):
+        dst[start : start + n] = src[src_start : src_start + n]
+
+
+def make_float_scratch() -> np.ndarray:
+    """scratch buffer for the float kernels, allocate once and reuse"""
+    return np.empty(BLOCK_SAMPLES, dtype=np.float32)
+
+
+def accumulate_tiled(
+    dst: np.ndarray, src: np.ndarray, gain: float, scratch: np.ndarray, offset: int = 0
+):
+    """dst[i] += gain * src[(offset + i) % len(src)] (float32 dst, int16 src), in place"""
+    for start, src_start, n in _tiled_chunks(len(dst), len(src), offset):
+        dst_chunk = _flat(dst[start : start + n])
+        src_chunk = _flat(src[src_start : src_start + n])
+        for block_start in range(0, len(dst_chunk), len(scratch)):
+            block_end = min(block_start + len(scratch), len(dst_chunk))
+            block = scratch[: block_end - block_start]
+            np.multiply(
+                src_chunk[block_start:block_end], gain, out=block, dtype=np.float32
+            )
+            dst_chunk[block_start:block_end] += block
+
+
+def _unit_ramp(num_frames: int) -> np.ndarray:
+    return np.arange(1, num_frames + 1, dtype=np.float32) / num_frames
+
+
+@dataclass
+class GainRamp:
+    """a gain applied to blocks of frames (or samples) in place
+
+    changing the gain (see set()) would click if it stepped from one sample to
+    the next, so the change is ramped linearly over the first frames of the
+    next block instead. the ramp is precomputed, a block only costs the
+    multiplications (and nothing at all at unity gain)
+    """
+
+    gain: float = 1.0
+    target: float = 1.0
+    unit_ramp: np.ndarray = field(
+        repr=False, default_factory=lambda: _unit_ramp(LIMITER_RAMP_FRAMES)
+    )
+    ramp: np.ndarray = field(
+        repr=False, default_factory=lambda: np.empty(LIMITER_RAMP_FRAMES, np.float32)
+    )
+
+    @classmethod
+    def create(cls, num_frames: int, gain: float = 1.0) -> GainRamp:
+        """changes are ramped over num_frames"""
+        return cls(
+            gain=gain,
+            target=gain,
+            unit_ramp=_unit_ramp(num_frames),
+            ramp=np.empty(num_frames, np.float32),
+        )
+
+    def set(self, gain: float):
+        """the gain ramps to gain from the next block on"""
+        self.target = gain
+
+    def apply(self, block: np.ndarray):
+        """block *= gain (float32), ramping to the target gain"""
+        target = self.target
+        if self.gain == target:
+            if target != 1.0:
+                block *= target
+            return
+        num_ramp = min(len(block), len(self.unit_ramp))
+        if num_ramp == 0:
+            return
+        ramp = self.ramp[:num_ramp]
+        np.multiply(self.unit_ramp[:num_ramp], target - self.gain, out=ramp)
+        ramp += self.gain
+        block[:num_ramp] *= ramp if block.ndim == 1 else ramp[:, None]
+        block[num_ramp:] *= target
+        # note : a block shorter than the ramp ramps on from there next time
+        self.gain = target if num_ramp == len(self.unit_ramp) else float(ramp[-1])
+
+
+@dataclass
+class Limiter:
+    """peak limiter from the float32 mix bus to int16, one block at a time
+
+    transparent (rounding only) while the bus stays within int16 range. a block
+    that peaks above full scale is scaled down to fit instead of clipping every
+    sample over it flat : the gain ramps down over the first
+    LIMITER_RAMP_FRAMES of the block and recovers over the next blocks. the
+    state carries over between blocks, use one limiter per output stream
+    """
+
+    ramp: GainRamp = field(default_factory=GainRamp)
+
+    @property
+    def gain(self) -> float:
+        return self.ramp.gain
+
+    def process(self, dst: np.ndarray, src: np.ndarray):
+        """dst = limited src (int16 dst, float32 src : samples, or frames of the
+        same shape). src is used as scratch, its overwritten"""
+        assert dst.shape == src.shape
+        high, low = float(src.max(initial=0.0)), float(src.min(initial=0.0))
+        target = min(
+            1.0,
+            INT16_MAX / high if high > INT16_MAX else 1.0,
+            INT16_MIN / low if low < INT16_MIN else 1.0,
+        )
+        gain = self.ramp.gain
+        if target >= 1.0 and gain >= 1.0:
+            np.rint(src, out=src)
+            dst[...] = src
+            return
+
+        if target < gain:
+            gain = target
+        else:
+            gain = min(target, gain + (1.0 - gain) * LIMITER_RELEASE)
+            # note : the release only ever gets close to 1, snap to it
+            if 1.0 - gain < LIMITER_SNAP:
+                gain = 1.0
+        self.ramp.set(gain)
+        self.ramp.apply(src)
+        # note : the start of the ramp can still be over full scale
+        np.rint(src, out=src)
+        np.clip(src, INT16_MIN, INT16_MAX, out=src)
+        dst[...] = src
+
+
+@dataclass
+class Fade:
+    """short fades, precomputed once and applied to every take at mix time :
+    the ends of a take are faded in / out (see apply()) and loop seams are
+    crossfaded (see crossfade_seam()), so that neither clicks
+    """
+
+    fade_in: np.ndarray  # float32 (num_frames, 1), raised cosine from 0 to 1
+    fade_out: np.ndarray  # 1 - fade_in
+    # scratch frames for crossfade_seam()
+    head: np.ndarray = field(repr=False)
+    tail: np.ndarray = field(repr=False)
+
+    @classmethod
+    def create(cls, num_frames: int, channels: int = 1) -> Fade:
+        """num_frames : length of the fades (0 : no fades)"""
+        t = (np.arange(num_frames) + 0.5) / max(num_frames, 1)
+        fade_in = (0.5 - 0.5 * np.cos(np.pi * t)).astype(np.float32)[:, None]
+        return cls(
+            fade_in=fade_in,
+            fade_out=1.0 - fade_in,
+            head=np.empty((num_frames, channels), np.float32),
+            tail=np.empty((num_frames, channels), np.float32),
+        )
+
+    @property
+    def num_frames(self) -> int:
+        return len(self.fade_in)
+
+    def apply(self, take: np.ndarray) -> int:
+        """fades the start of take (int16 frames) in and its end out, in place.
+        returns the number of frames faded at either end"""
+        n = min(self.num_frames, len(take) // 2)
+        if n == 0:
+            return 0
+        # note : a take shorter than both fades gets the end of the fade only
+        fade_in = self.fade_in[self.num_frames - n :]
+        take[:n] = np.rint(take[:n] * fade_in)
+        take[len(take) - n :] = np.rint(take[len(take) - n :] * fade_in[::-1])
+        return n
+
+    def crossfade_seam(
+        self, dst: np.ndarray, src: np.ndarray, gain: float = 1.0, offset: int = 0
+    ) -> np.ndarray | None:
+        """crossfades the loop seam of src tiled over dst, which has to hold
+        dst[i] += gain * src[(offset + i) % len(src)] already (float32 dst)
+
+        unless len(dst) is a multiple of len(src), src is cut off mid-way at
+        the end of dst and jumps back to where it started on every loop. the
+        start of dst is crossfaded from how src would have gone on past the end
+        to how it starts, which makes the seam as continuous as src itself.
+        returns the correction added to dst (None : the seam lines up), its
+        scratch : copy it to keep it
+        """
+        n = min(self.num_frames, len(dst))
+        if n == 0 or len(dst) % len(src) == 0:
+            return None
+        head, tail = self.head[:n], self.tail[:n]
+        copy_tiled(tail, src, offset + len(dst))
+        copy_tiled(head, src, offset)
+        tail -= head
+        tail *= self.fade_out[:n]
+        if gain != 1.0:
+            tail *= gain
+        dst[:n] += tail
+        return tail
+
+
+def samples_per_beat(bpm: float, sample_rate: int) -> float:
+    """length of a beat in samples, not rounded : round multiples of it instead"""
+    return sample_rate * 60 / bpm
@@ -0,0 +1,633 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import Lock
+import atexit
+import logging
+import multiprocessing as mp
+import multiprocessing.queues
+import queue
+import time
+import numpy as np
+import pyaudio
+from pilooper.audio_format import DEFAULT_FORMAT, AudioFormat
+from pilooper.buffer_size import BufferSizer, load_buffer_sizes, save_buffer_size
+from pilooper.instrument import CallbackStats
+from pilooper.latency import (
+    CalibrationError,
+    LatencyCalibration,
+    latency_key,
+    load_latencies,
+    save_latency,
+)
+from pilooper.metrics import MetricsExporter
+from pilooper.mixer import Mixer
+from pilooper.playback import Speaker
+from pilooper.record import Mic
+from pilooper.session import SESSION_DIR, load_session, save_session
+from pilooper.track import SHM_DIR, SharedStorage, attach
+from pilooper.wire import Wire
+
+# replies should be instant (mixing a long loop / calibrating takes a while though)
+COMMAND_TIMEOUT_SECONDS = 30.0
+CALIBRATION_TIMEOUT_SECONDS = 10.0
+STARTUP_TIMEOUT_SECONDS = 60.0
+# how often a caller waiting on a reply checks the engine process is still alive
+ALIVE_POLL_SECONDS = 0.5
+# how often the engine process adapts the buffer size (see Engine.adapt_buffer_size())
+ADAPT_PERIOD_SECONDS = 1.0
+# buffer sizes and latencies are stored under this until an output device is set
+DEFAULT_DEVICE = "default"
+
+# the Engine methods that can be called from another process
+COMMANDS = frozenset(
+    {
+        "start_speaker",
+        "record",
+        "stop",
+        "mix",
+        "reset",
+        "add_metronome",
+        "start_metronome",
+        "stop_metronome",
+        "set_bpm",
+        "set_clip50",
+        "set_master_gain",
+        "set_monitor_gain",
+        "has_metronome",
+        "callback_stats",
+        "dump_callback_stats",
+        "track_info",
+        "set_output_device",
+        "calibrate_latency",
+        "save_session",
+        "load_session",
+    }
+)
+
+
+class EngineError(RuntimeError):
+    """a command failed in the engine process"""
+
+
+@dataclass
+class Engine:
+    """owns the audio devices and the mixer
+
+    the mic / speaker callbacks only ever run next to the engine, see
+    EngineProcess for running it (and nothing else) in its own process
+    """
+
+    mixer: Mixer
+    mic: Mic | None
+    speaker: Speaker | None
+    # one full duplex stream instead of mic and speaker (see Mixer.duplex_callback)
+    wire: Wire | None = None
+    duplex: bool = True
+    storage: SharedStorage | None = None
+    metrics: MetricsExporter | None = None
+    recording: bool = False
+    # latencies are measured and stored per output device
+    output_device: str | None = None
+    # adapts the frames per buffer of the streams (None : portaudio picks it)
+    buffer_sizer: BufferSizer | None = None
+    # frames per buffer the streams were opened at (None : portaudio picked it)
+    frames_per_buffer: int | None = None
+    # opens every stream, reopening them (see adapt_buffer_size()) reuses it
+    pyaud: pyaudio.PyAudio | None = field(default=None, repr=False)
+
+    @classmethod
+    def create(
+        cls,
+        track_length_seconds: int,
+        storage_dir: Path | None = None,
+        metrics_port: int | None = None,
+        shared: bool = False,
+        open_devices: bool = True,
+        duplex: bool = True,
+        format: AudioFormat = DEFAULT_FORMAT,
+        adaptive_buffer: bool = False,
+    ) -> Engine:
+        """format : of the devices and tracks (see AudioFormat)
+        shared : tracks are allocated in shared memory (see track_info()),
+        in storage_dir if its set
+        open_devices : opens the audio streams (False : the callbacks are driven
+        by the caller)
+        duplex : one full duplex stream, takes line up with the loop to the
+        sample (False : separate mic and speaker streams)
+        adaptive_buffer : adapt the frames per buffer of the streams to the
+        output device (see adapt_buffer_size())
+        """
+        storage = None
+        if shared:
+            storage = SharedStorage.create(storage_dir or SHM_DIR)
+        mixer = Mixer.create_mixer(
+            track_length_seconds=track_length_seconds,
+            stream_overdubs=True,
+            storage_dir=storage_dir,
+            allocator=storage.allocate if storage is not None else None,
+            format=format,
+        )
+        engine = cls(
+            mixer=mixer,
+            mic=None,
+            speaker=None,
+            duplex=duplex,
+            storage=storage,
+        )
+        if adaptive_buffer:
+            stored = load_buffer_sizes().get(DEFAULT_DEVICE)
+            engine.buffer_sizer = BufferSizer.create(stored)
+        if open_devices:
+            engine._open_streams()
+        if metrics_port is not None:
+            engine.metrics = MetricsExporter.create(
+                mixer, is_recording=lambda: engine.recording
+            )
+            engine.metrics.serve(metrics_port)
+        return engine
+
+    def _open_streams(self):
+        """opens the streams at the frames per buffer of the sizer, and
+        switches to the latency stored for that size"""
+        mixer, format = self.mixer, self.mixer.format
+        frames_per_buffer = None
+        if self.buffer_sizer is not None:
+            frames_per_buffer = self.buffer_sizer.frames_per_buffer
+        self.frames_per_buffer = frames_per_buffer
+        self._load_latency()
+        if self.pyaud is None:
+            self.pyaud = pyaudio.PyAudio()
+        if self.duplex:
+            self.wire = Wire.from_defaults(
+                callback=mixer.duplex_callback,
+                format=format,
+                frames_per_buffer=frames_per_buffer,
+                pyaud=self.pyaud,
+            )
+        else:
+            self.mic = Mic.from_blueyeti(
+                callback=mixer.mic_callback,
+                format=format,
+                frames_per_buffer=frames_per_buffer,
+                pyaud=self.pyaud,
+            )
+            self.speaker = Speaker.from_bt_headphones(
+                callback=mixer.speaker_callback,
+                format=format,
+                frames_per_buffer=frames_per_buffer,
+                pyaud=self.pyaud,
+            )
+
+    def _load_latency(self):
+        """switches to the stored latency of the output device at the frames
+        per buffer of the streams (0 : not calibrated at that size)"""
+        key = latency_key(self.output_device or DEFAULT_DEVICE, self.frames_per_buffer)
+        self.mixer.set_latency(load_latencies().get(key, 0))
+
+    def _reopen_streams(self):
+        """reopens the streams at the current frames per buffer, the loop goes
+        on playing from where it was"""
+        assert not self.recording, "cant reopen the streams while recording"
+        streams = [s for s in [self.wire, self.speaker] if s is not None]
+        if not streams:
+            return
+        playing = any(s.stream.is_active() for s in streams)
+        for stream in streams:
+            stream.stop()
+        if self.wire is not None:
+            self.wire.stream.close()
+        # note : mic / speaker close their streams when theyre dropped
+        self.wire = self.mic = self.speaker = None
+        self._open_streams()
+        if playing:
+            self.start_speaker()
+
+    def adapt_buffer_size(self):
+        """moves the frames per buffer towards the smallest size that plays
+        without glitches (see BufferSizer), reopening the streams if it
+        changes. the size the output device settles on is stored
+
+        call this every now and then, never from the audio callbacks. the
+        engine process does (every ADAPT_PERIOD_SECONDS), nothing changes
+        while recording
+        """
+        sizer = self.buffer_sizer
+        if sizer is None or self.recording:
+            return
+        settled = sizer.settled
+        frames_per_buffer = sizer.poll(self.mixer.instrumentation)
+        if sizer.settled is not None and sizer.settled != settled:
+            save_buffer_size(self.output_device or DEFAULT_DEVICE, sizer.settled)
+        if frames_per_buffer is not None:
+            self.mixer.logger.info(
+                f"reopening the streams at {frames_per_buffer} frames"
+            )
+            self._reopen_streams()
+
+    def start_speaker(self):
+        if self.wire is not None:
+            self.wire.start()
+        if self.speaker is not None:
+            self.speaker.start()
+
+    def _stop_mic(self):
+        if not self.recording:
+            return
+        if self.duplex:
+            self.mixer.stop_recording()
+        elif self.mic is not None:
+            self.mic.stop()
+        self.recording = False
+
+    def record(self):
+        if self.duplex:
+            self.mixer.start_recording()
+        elif self.mic is not None:
+            self.mixer.reserve_take()
+            self.mic.start()
+        self.recording = True
+
+    def stop(self):
+        """stops recording, throwing the take away"""
+        self._stop_mic()
+        self.mixer.reset_mic_track()
+
+    def mix(self):
+        """stops recording and mixes the take into the loop"""
+        self._stop_mic()
+        self.mixer.mix()
+
+    def reset(self):
+        self._stop_mic()
+        self.mixer.reset()
+
+    def add_metronome(self, bpm: int):
+        self.mixer.add_metronome(bpm)
+
+    def start_metronome(self):
+        self.mixer.start_metronome()
+
+    def stop_metronome(self):
+        self.mixer.stop_metronome()
+
+    def has_metronome(self) -> bool:
+        return self.mixer.metronome is not None
+
+    def set_bpm(self, bpm: int | None):
+        self.mixer.set_bpm(bpm)
+
+    def set_clip50(self, clip: bool | None):
+        self.mixer.set_clip50(clip)
+
+    def set_master_gain(self, gain: float):
+        self.mixer.set_master_gain(gain)
+
+    def set_monitor_gain(self, gain: float):
+        """hear the input through the output (0 : off), duplex only"""
+        if not self.duplex:
+            self.mixer.logger.warning("input monitoring needs a duplex stream")
+        self.mixer.set_monitor_gain(gain)
+
+    def set_output_device(self, device: str):
+        """switches to the stored round trip latency (and buffer size, if its
+        adapted) of device"""
+        self.output_device = device
+        if self.buffer_sizer is not None:
+            # start over from the stored buffer size of the device
+            frames_per_buffer = self.buffer_sizer.frames_per_buffer
+            self.buffer_sizer = BufferSizer.create(load_buffer_sizes().get(device))
+            if (
+                self.buffer_sizer.frames_per_buffer != frames_per_buffer
+                and not self.recording
+            ):
+                self._reopen_streams()
+        self._load_latency()
+
+    def calibrate_latency(self) -> int:
+        """measures (and stores) the round trip latency of the output device
+        at the frames per buffer of the streams
+
+        the test signal is played and recorded on a stream of its own, the
+        loop stops playing meanwhile
+        """
+        if self.mic is None and self.wire is None:
+            raise CalibrationError("no audio devices to calibrate")
+        assert not self.recording, "cant calibrate while recording"
+
+        streams = [s for s in [self.wire, self.speaker] if s is not None]
+        playing = [s for s in streams if s.stream.is_active()]
+        for stream in playing:
+            stream.stop()
+
+        format = self.mixer.format
+        calibration = LatencyCalibration.create(format)
+        wire = Wire.from_defaults(
+            callback=calibration.callback,
+            format=format,
+            frames_per_buffer=self.frames_per_buffer,
+            pyaud=self.pyaud,
+        )
+        try:
+            wire.start()
+            finished = calibration.done.wait(CALIBRATION_TIMEOUT_SECONDS)
+            wire.stop()
+        finally:
+            wire.stream.close()
+            for stream in playing:
+                stream.start()
+        if not finished:
+            raise CalibrationError("calibration timed out")
+
+        latency = calibration.latency()
+        save_latency(
+            latency_key(self.output_device or DEFAULT_DEVICE, self.frames_per_buffer),
+            latency,
+        )
+        self.mixer.set_latency(latency)
+        return latency
+
+    def save_session(self, session_dir: Path = SESSION_DIR):
+        save_session(self.mixer, session_dir)
+
+    def load_session(self, session_dir: Path = SESSION_DIR) -> dict:
+        """loads a saved loop and its settings (see session.py), stops
+        recording. returns the session metadata"""
+        self._stop_mic()
+        # note : shared tracks stay in shared memory (see track_info())
+        return load_session(self.mixer, session_dir, map_loop=self.storage is None)
+
+    def callback_stats(self, window: int | None = None) -> list[CallbackStats]:
+        return self.mixer.instrumentation.stats(window)
+
+    def dump_callback_stats(self, path: Path, window: int | None = None):
+        self.mixer.instrumentation.dump(path, window)
+
+    def audio_format(self) -> AudioFormat:
+        return self.mixer.format
+
+    def track_info(self) -> dict[str, tuple[Path | None, int]]:
+        """(shared memory path, length in frames) of the recording (mic) and
+        the loop thats playing (loop)"""
+        storage = self.storage
+        format = self.mixer.format
+        mic_track, loop_track = self.mixer.mic_track, self.mixer.speaker_track.track
+        return {
+            "mic": (
+                storage.path_of(mic_track.track.data) if storage else None,
+                format.to_frames(mic_track.ring.write_idx),
+            ),
+            "loop": (
+                storage.path_of(loop_track.data) if storage else None,
+                loop_track.length,
+            ),
+        }
+
+    def track(self, name: str) -> np.ndarray:
+        """the (interleaved) samples of track name (see track_info()), a view,
+        not a copy. the loop is float32 (the mix bus), the mic int16"""
+        mic_track, loop_track = self.mixer.mic_track, self.mixer.speaker_track.track
+        track, length = {
+            "mic": (
+                mic_track.track,
+                mic_track.track.format.to_frames(mic_track.ring.write_idx),
+            ),
+            "loop": (loop_track, loop_track.length),
+        }[name]
+        format = track.format
+        return np.frombuffer(track.data, dtype=format.dtype)[: length * format.channels]
+
+    def close(self):
+        self._stop_mic()
+        if self.wire is not None:
+            self.wire.stop()
+        if self.speaker is not None:
+            self.speaker.stop()
+        # note : mic / speaker close their streams when theyre dropped, the
+        # rest are closed by terminate()
+        self.wire = self.mic = self.speaker = None
+        if self.pyaud is not None:
+            self.pyaud.terminate()
+            self.pyaud = None
+        if self.metrics is not None:
+            self.metrics.stop()
+        self.mixer.stop_stream()
+        if self.mixer.exporter is not None:
+            self.mixer.exporter.close()
+        if self.storage is not None:
+            self.storage.unlink()
+
+
+def _serve(commands: mp.queues.Queue, replies: mp.queues.Queue, engine_kwargs: dict):
+    """engine process main loop : executes commands until it gets None
+
+    commands are (id, method, args), replies (id, ok, result) so a caller can
+    tell the reply to its command from a late one (see EngineProcess._call())
+    """
+    try:
+        engine = Engine.create(shared=True, **engine_kwargs)
+    except Exception as e:
+        replies.put((False, repr(e)))
+        return
+    replies.put((True, None))
+
+    try:
+        adapted = time.monotonic()
+        while True:
+            # note : adapted between commands, so the streams never change
+            # under one
+            if time.monotonic() - adapted >= ADAPT_PERIOD_SECONDS:
+                engine.adapt_buffer_size()
+                adapted = time.monotonic()
+            try:
+                command = commands.get(timeout=ADAPT_PERIOD_SECONDS)
+            except queue.Empty:
+                continue
+            if command is None:
+                break
+            command_id, method, args = command
+            try:
+                replies.put((command_id, True, getattr(engine, method)(*args)))
+            except Exception as e:
+                logging.getLogger("engine").exception(f"{method} failed")
+                replies.put((command_id, False, repr(e)))
+    finally:
+        engine.close()
+
+
+@dataclass
+class EngineProcess:
+    """runs an Engine in a separate process
+
+    the ui (streamlit reruns, gpio callbacks, bluetoothctl ...) then no longer
+    competes with the audio callbacks for the gil. commands go over a queue,
+    one at a time, the tracks are read straight from shared memory
+    """
+
+    process: mp.process.BaseProcess
+    commands: mp.queues.Queue
+    replies: mp.queues.Queue
+    # one outstanding command at a time (the ui calls from several threads)
+    lock: Lock = field(default_factory=Lock)
+    # id of the last command sent
+    command_id: int = 0
+    format: AudioFormat = DEFAULT_FORMAT
+    # mappings of the shared tracks, by path
+    attached: dict[Path, np.ndarray] = field(repr=False, default_factory=dict)
+
+    @classmethod
+    def start(
+        cls,
+        track_length_seconds: int,
+        storage_dir: Path | None = None,
+        metrics_port: int | None = None,
+        open_devices: bool = True,
+        duplex: bool = True,
+        format: AudioFormat = DEFAULT_FORMAT,
+        adaptive_buffer: bool = False,
+    ) -> EngineProcess:
+        # note : spawn, forking a process with threads (streamlit, gpiozero)
+        # isnt safe
+        ctx = mp.get_context("spawn")
+        commands, replies = ctx.Queue(), ctx.Queue()
+        process = ctx.Process(
+            target=_serve,
+            args=(
+                commands,
+                replies,
+                dict(
+                    track_length_seconds=track_length_seconds,
+                    storage_dir=storage_dir,
+                    metrics_port=metrics_port,
+                    open_devices=open_devices,
+                    duplex=duplex,
+                    format=format,
+                    adaptive_buffer=adaptive_buffer,
+                ),
+            ),
+            name="pilooper-engine",
+            daemon=True,
+        )
+        process.start()
+        ok, error = replies.get(timeout=STARTUP_TIMEOUT_SECONDS)
+        if not ok:
+            process.join()
+            raise EngineError(f"engine failed to start : {error}")
+
+        engine = cls(process=process, commands=commands, replies=replies, format=format)
+        atexit.register(engine.close)
+        return engine
+
+    def _call(self, method: str, *args):
+        assert method in COMMANDS, f"{method} isnt an engine command"
+        with self.lock:
+            if not self.process.is_alive():
+                raise EngineError(f"{method}{args} : the engine process isnt running")
+            self.command_id += 1
+            self.commands.put((self.command_id, method, args))
+            ok, result = self._reply(method, args)
+        if not ok:
+            raise EngineError(f"{method}{args} : {result}")
+        return result
+
+    def _reply(self, method: str, args: tuple) -> tuple[bool, object]:
+        """waits for the reply to the last command
+
+        note : a command that timed out still replies eventually, such late
+        replies are dropped instead of being taken for the reply to a later
+        command
+        """
+        deadline = time.monotonic() + COMMAND_TIMEOUT_SECONDS
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise EngineError(f"{method}{args} : timed out")
+            try:
+                command_id, ok, result = self.replies.get(
+                    timeout=min(timeout, ALIVE_POLL_SECONDS)
+                )
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise EngineError(f"{method}{args} : the engine process died")
+                continue
+            if command_id == self.command_id:
+                return ok, result
+
+    def start_speaker(self):
+        self._call("start_speaker")
+
+    def record(self):
+        self._call("record")
+
+    def stop(self):
+        self._call("stop")
+
+    def mix(self):
+        self._call("mix")
+
+    def reset(self):
+        self._call("reset")
+
+    def add_metronome(self, bpm: int):
+        self._call("add_metronome", bpm)
+
+    def start_metronome(self):
+        self._call("start_metronome")
+
+    def stop_metronome(self):
+        self._call("stop_metronome")
+
+    def has_metronome(self) -> bool:
+        return self._call("has_metronome")
+
+    def set_bpm(self, bpm: int | None):
+        self._call("set_bpm", bpm)
+
+    def set_clip50(self, clip: bool | None):
+        self._call("set_clip50", clip)
+
+    def set_master_gain(self, gain: float):
+        self._call("set_master_gain", gain)
+
+    def set_monitor_gain(self, gain: float):
+        self._call("set_monitor_gain", gain)
+
+    def save_session(self, session_dir: Path = SESSION_DIR):
+        self._call("save_session", session_dir)
+
+    def load_session(self, session_dir: Path = SESSION_DIR) -> dict:
+        return self._call("load_session", session_dir)
+
+    def callback_stats(self, window: int | None = None) -> list[CallbackStats]:
+        return self._call("callback_stats", window)
+
+    def dump_callback_stats(self, path: Path, window: int | None = None):
+        self._call("dump_callback_stats", path, window)
+
+    def track_info(self) -> dict[str, tuple[Path | None, int]]:
+        return self._call("track_info")
+
+    def audio_format(self) -> AudioFormat:
+        return self.format
+
+    def set_output_device(self, device: str):
+        self._call("set_output_device", device)
+
+    def calibrate_latency(self) -> int:
+        return self._call("calibrate_latency")
+
+    def track(self, name: str) -> np.ndarray:
+        """the samples of track name (see Engine.track()), read-only and
+        straight out of the engines memory : they change while its running"""
+        path, length = self.track_info()[name]
+        assert path is not None
+        format = self.format.bus if name == "loop" else self.format
+        if path not in self.attached:
+            self.attached[path] = np.frombuffer(attach(path), dtype=format.dtype)
+        return self.attached[path][: length * format.channels]
+
+    def close(self):
+        if not self.process.is_alive():
+            return
+        self.commands.put(None)
+        self.process.join(timeout=COMMAND_TIMEOUT_SECONDS)
@@ -0,0 +1,245 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+from queue import Queue
+from threading import Lock, Thread
+import importlib.util
+import logging
+import re
+import wave
+import numpy as np
+import pilooper.constants as constants
+from pilooper.dsp import Limiter
+from pilooper.track import Buffer
+
+EXPORT_DIR = Path("./saved_tracks")
+# samples written to disk at a time (~1.5s), the only copy an export makes
+# unless the track is changed before its written out
+CHUNK_SAMPLES = 1 << 16
+
+
+class ExportFormat(Enum):
+    WAV = "wav"
+    # needs the soundfile package (libsndfile)
+    FLAC = "flac"
+
+
+class ExportError(RuntimeError):
+    """an export couldnt be written"""
+
+
+@dataclass
+class Snapshot:
+    """the samples of a track at the time of the export
+
+    shares the track buffer until the track is about to be written to, see
+    preserve(). only then the part thats still to be written out is copied
+    """
+
+    source: Buffer | None  # the track buffer, None once its copied
+    data: np.ndarray  # frames, a view of source or a private copy
+    path: Path
+    # samples written out so far, data starts at sample base
+    written: int = 0
+    base: int = 0
+    length: int = 0
+    lock: Lock = field(repr=False, default_factory=Lock)
+
+    def preserve(self):
+        """copies the samples that arent written out yet, call before the
+        source is changed"""
+        with self.lock:
+            if self.source is None:
+                return
+            self.data = self.data[self.written - self.base :].copy()
+            self.base = self.written
+            self.source = None
+
+    def read(self, num_samples: int) -> np.ndarray:
+        """copy of the next num_samples to write out"""
+        with self.lock:
+            start = self.written - self.base
+            chunk = self.data[start : start + num_samples].copy()
+            self.written += len(chunk)
+        return chunk
+
+    def release(self):
+        with self.lock:
+            self.source = None
+            self.data = self.data[:0]
+
+
+def _wav_writer(path: Path, sample_rate: int, channels: int):
+    wf = wave.open(str(path), "wb")
+    wf.setnchannels(channels)
+    wf.setsampwidth(2)
+    wf.setframerate(sample_rate)
+    return wf.writeframes, wf.close
+
+
+def _flac_writer(path: Path, sample_rate: int, channels: int):
+    import soundfile
+
+    sf = soundfile.SoundFile(
+        str(path),
+        mode="w",
+        samplerate=sample_rate,
+        channels=channels,
+        subtype="PCM_16",
+        format="FLAC",
+    )
+    return sf.write, sf.close
+
+
+WRITERS = {ExportFormat.WAV: _wav_writer, ExportFormat.FLAC: _flac_writer}
+
+
+def _check_format(format: ExportFormat):
+    if format is ExportFormat.FLAC and importlib.util.find_spec("soundfile") is None:
+        raise ExportError("flac export needs the soundfile package")
+
+
+def write_file(
+    path: Path,
+    data: np.ndarray,
+    format: ExportFormat = ExportFormat.WAV,
+    sample_rate: int = constants.SAMPLING_RATE,
+):
+    """writes data (int16 samples, or (num_frames, channels) frames) to path,
+    on the calling thread. float32 data (the mix bus) is limited to int16"""
+    _check_format(format)
+    channels = data.shape[1] if data.ndim == 2 else 1
+    write, close = WRITERS[format](path, sample_rate, channels)
+    limiter = Limiter()
+    try:
+        for start in range(0, len(data), CHUNK_SAMPLES):
+            chunk = data[start : start + CHUNK_SAMPLES]
+            # note : the limiter works in place, data isnt ours to change
+            write(
+                _to_int16(chunk if chunk.dtype == np.int16 else chunk.copy(), limiter)
+            )
+    finally:
+        close()
+
+
+def _to_int16(chunk: np.ndarray, limiter: Limiter) -> np.ndarray:
+    """chunk as int16, through limiter if its float (chunk is overwritten)"""
+    if chunk.dtype == np.int16:
+        return chunk
+    out = np.empty(chunk.shape, dtype=np.int16)
+    limiter.process(out, chunk)
+    return out
+
+
+def _last_index(out_dir: Path) -> int:
+    """highest track_<idx> in out_dir (-1 if there are none)"""
+    idx = [
+        int(match.group(1))
+        for path in out_dir.iterdir()
+        if (match := re.fullmatch(r"track_(\d+)\.\w+", path.name))
+    ]
+    return max(idx, default=-1)
+
+
+@dataclass
+class Exporter:
+    """writes mixes to out_dir on a background thread
+
+    export() only takes a snapshot (O(1), no copy), the mixer has to call
+    preserve() before it changes a track buffer thats exported. files are
+    numbered track_0, track_1 ... continuing from whats in out_dir when the
+    exporter is created
+    """
+
+    out_dir: Path
+    format: ExportFormat = ExportFormat.WAV
+    sample_rate: int = constants.SAMPLING_RATE
+    channels: int = 1
+    next_idx: int = 0
+    # snapshots that arent written out yet
+    pending: list[Snapshot] = field(default_factory=list)
+    pending_lock: Lock = field(repr=False, default_factory=Lock)
+    queue: Queue[Snapshot | None] = field(repr=False, default_factory=Queue)
+    thread: Thread | None = None
+    logger: logging.Logger = field(
+        repr=False, default_factory=lambda: logging.getLogger("export")
+    )
+
+    @classmethod
+    def create(
+        cls,
+        out_dir: Path = EXPORT_DIR,
+        format: ExportFormat = ExportFormat.WAV,
+        sample_rate: int = constants.SAMPLING_RATE,
+        channels: int = 1,
+    ) -> Exporter:
+        _check_format(format)
+        out_dir.mkdir(exist_ok=True, parents=True)
+        # note : the only directory scan, later exports just count up
+        exporter = cls(
+            out_dir=out_dir,
+            format=format,
+            sample_rate=sample_rate,
+            channels=channels,
+            next_idx=_last_index(out_dir) + 1,
+        )
+        exporter.thread = Thread(target=exporter._worker, daemon=True)
+        exporter.thread.start()
+        return exporter
+
+    def export(self, source: Buffer, data: np.ndarray) -> Path:
+        """queues data (a view of the track buffer source) to be written out,
+        returns the path its written to"""
+        path = self.out_dir / f"track_{self.next_idx}.{self.format.value}"
+        self.next_idx += 1
+        snapshot = Snapshot(source=source, data=data, path=path, length=len(data))
+        with self.pending_lock:
+            self.pending.append(snapshot)
+        self.queue.put(snapshot)
+        return path
+
+    def preserve(self, source: Buffer):
+        """call before changing the track buffer source : pending exports of
+        it take a copy of what they still have to write"""
+        with self.pending_lock:
+            for snapshot in self.pending:
+                if snapshot.source is source:
+                    snapshot.preserve()
+
+    def _write(self, snapshot: Snapshot):
+        write, close = WRITERS[self.format](
+            snapshot.path, self.sample_rate, self.channels
+        )
+        # note : the mix bus is only converted to int16 here, a chunk at a time
+        limiter = Limiter()
+        try:
+            while snapshot.written < snapshot.length:
+                write(_to_int16(snapshot.read(CHUNK_SAMPLES), limiter))
+        finally:
+            close()
+
+    def _worker(self):
+        while (snapshot := self.queue.get()) is not None:
+            try:
+                self._write(snapshot)
+                self.logger.info(f"exported {snapshot.path}")
+            except Exception:
+                self.logger.exception(f"exporting {snapshot.path} failed")
+            finally:
+                with self.pending_lock:
+                    self.pending.remove(snapshot)
+                snapshot.release()
+                self.queue.task_done()
+
+    def join(self):
+        """waits for the queued exports to be written"""
+        self.queue.join()
+
+    def close(self):
+        """writes the queued exports and stops the worker"""
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
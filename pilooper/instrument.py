@@ -0,0 +1,244 @@
+from __future__ import annotations
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from enum import IntEnum
+from pathlib import Path
+import json
+import time
+import numpy as np
+import pyaudio
+import pilooper.constants as constants
+
+
+class Column(IntEnum):
+    """columns of a CallbackRing record"""
+
+    START_NS = 0  # perf_counter_ns at the start of the callback
+    RUNTIME_NS = 1
+    FRAME_COUNT = 2
+    STATUS = 3  # portaudio status flags
+    LOCK_WAIT_NS = 4
+    LOCK_BUSY = 5  # number of times a lock was busy (and skipped)
+    # input : current_time - input_buffer_adc_time
+    # output : output_buffer_dac_time - current_time
+    STREAM_LATENCY_NS = 6
+    # duplex output : output_buffer_dac_time - input_buffer_adc_time, from the
+    # input of a block to its output (what monitored input lags by). 0 for
+    # streams without input
+    END_TO_END_LATENCY_NS = 7
+
+
+NUM_COLUMNS = len(Column)
+# ~1 minute of callbacks at 1024 frames / 44.1kHz
+DEFAULT_CAPACITY = 4096
+
+
+@dataclass
+class CallbackRing:
+    """fixed size ring of per-callback records
+
+    written from the audio callback (one row of ints, no allocations) and read
+    from anywhere else. theres a single writer : readers only ever look at rows
+    below write_idx, a row might be overwritten while its read if the reader is
+    slower than a full lap of the ring
+    """
+
+    name: str
+    is_output: bool
+    records: np.ndarray = field(repr=False)  # int64, (capacity, NUM_COLUMNS)
+    write_idx: int = 0
+
+    @classmethod
+    def create(
+        cls, name: str, is_output: bool, capacity: int = DEFAULT_CAPACITY
+    ) -> CallbackRing:
+        records = np.zeros((capacity, NUM_COLUMNS), dtype=np.int64)
+        return cls(name=name, is_output=is_output, records=records)
+
+    @property
+    def capacity(self) -> int:
+        return len(self.records)
+
+    def record(
+        self,
+        start_ns: int,
+        frame_count: int,
+        time_info: dict | None,
+        status: int | None,
+        lock_wait_ns: int = 0,
+        lock_busy: int = 0,
+    ):
+        """called at the end of the callback"""
+        runtime_ns = time.perf_counter_ns() - start_ns
+        stream_latency = end_to_end_latency = 0.0
+        if time_info:
+            if self.is_output:
+                stream_latency = time_info.get(
+                    "output_buffer_dac_time", 0.0
+                ) - time_info.get("current_time", 0.0)
+                if time_info.get("input_buffer_adc_time"):
+                    end_to_end_latency = time_info.get(
+                        "output_buffer_dac_time", 0.0
+                    ) - time_info.get("input_buffer_adc_time", 0.0)
+            else:
+                stream_latency = time_info.get("current_time", 0.0) - time_info.get(
+                    "input_buffer_adc_time", 0.0
+                )
+        self.records[self.write_idx % self.capacity] = (
+            start_ns,
+            runtime_ns,
+            frame_count,
+            status or 0,
+            lock_wait_ns,
+            lock_busy,
+            round(stream_latency * 1e9),
+            round(end_to_end_latency * 1e9),
+        )
+        # publish the row only once its written
+        self.write_idx += 1
+
+    def snapshot(self, window: int | None = None) -> np.ndarray:
+        """copy of the (up to) window most recent records, oldest first"""
+        write_idx = self.write_idx
+        num = min(write_idx, self.capacity)
+        if window is not None:
+            num = min(num, window)
+        idx = np.arange(write_idx - num, write_idx) % self.capacity
+        return self.records[idx]
+
+    def read_from(self, read_idx: int) -> tuple[np.ndarray, int, int]:
+        """records written since read_idx, for readers that consume the ring
+        incrementally. returns (records, next read_idx, number of records that
+        were overwritten before they could be read)"""
+        write_idx = self.write_idx
+        if write_idx < read_idx:
+            # the ring was reset
+            read_idx = 0
+        num_dropped = max(0, write_idx - read_idx - self.capacity)
+        read_idx += num_dropped
+        idx = np.arange(read_idx, write_idx) % self.capacity
+        return self.records[idx], write_idx, num_dropped
+
+    def reset(self):
+        self.write_idx = 0
+
+
+@dataclass
+class CallbackStats:
+    """rolling stats over the last records of a callback"""
+
+    name: str
+    count: int = 0
+    deadline_us: float = 0.0  # of the latest callback (frame_count / sample rate)
+    runtime_p50_us: float = 0.0
+    runtime_p99_us: float = 0.0
+    runtime_max_us: float = 0.0
+    # runtime / deadline
+    max_load: float = 0.0
+    deadline_misses: int = 0
+    # largest gap between the start of two callbacks relative to the deadline,
+    # the callback thread not running in time (gil, scheduling) shows up here
+    max_interval_ratio: float = 0.0
+    input_underflows: int = 0
+    input_overflows: int = 0
+    output_underflows: int = 0
+    output_overflows: int = 0
+    lock_wait_max_us: float = 0.0
+    lock_busy: int = 0
+    stream_latency_ms: float = 0.0
+    end_to_end_latency_ms: float = 0.0
+
+    @classmethod
+    def from_records(
+        cls, name: str, records: np.ndarray, sample_rate: int
+    ) -> CallbackStats:
+        if len(records) == 0:
+            return cls(name=name)
+
+        runtime_us = records[:, Column.RUNTIME_NS] / 1e3
+        deadline_us = records[:, Column.FRAME_COUNT] / sample_rate * 1e6
+        load = runtime_us / deadline_us
+        intervals_us = np.diff(records[:, Column.START_NS]) / 1e3
+        interval_ratio = intervals_us / deadline_us[:-1]
+        status = records[:, Column.STATUS]
+
+        def num_flagged(flag: int) -> int:
+            return int(np.count_nonzero(status & flag))
+
+        return cls(
+            name=name,
+            count=len(records),
+            deadline_us=float(deadline_us[-1]),
+            runtime_p50_us=float(np.percentile(runtime_us, 50)),
+            runtime_p99_us=float(np.percentile(runtime_us, 99)),
+            runtime_max_us=float(runtime_us.max()),
+            max_load=float(load.max()),
+            deadline_misses=int(np.count_nonzero(load > 1.0)),
+            max_interval_ratio=float(interval_ratio.max(initial=0.0)),
+            input_underflows=num_flagged(pyaudio.paInputUnderflow),
+            input_overflows=num_flagged(pyaudio.paInputOverflow),
+            output_underflows=num_flagged(pyaudio.paOutputUnderflow),
+            output_overflows=num_flagged(pyaudio.paOutputOverflow),
+            lock_wait_max_us=float(records[:, Column.LOCK_WAIT_NS].max() / 1e3),
+            lock_busy=int(records[:, Column.LOCK_BUSY].sum()),
+            stream_latency_ms=float(records[-1, Column.STREAM_LATENCY_NS] / 1e6),
+            end_to_end_latency_ms=float(
+                records[-1, Column.END_TO_END_LATENCY_NS] / 1e6
+            ),
+        )
+
+
+@dataclass
+class Instrumentation:
+    """deadline instrumentation for the mic / speaker callbacks"""
+
+    mic: CallbackRing
+    speaker: CallbackRing
+    sample_rate: int = constants.SAMPLING_RATE
+    # durations of the latest mixes (not on the audio thread), consumers pop
+    # from the left
+    mix_seconds: deque[float] = field(default_factory=lambda: deque(maxlen=256))
+
+    @classmethod
+    def create(
+        cls,
+        capacity: int = DEFAULT_CAPACITY,
+        sample_rate: int = constants.SAMPLING_RATE,
+    ) -> Instrumentation:
+        return cls(
+            mic=CallbackRing.create("mic", is_output=False, capacity=capacity),
+            speaker=CallbackRing.create("speaker", is_output=True, capacity=capacity),
+            sample_rate=sample_rate,
+        )
+
+    @property
+    def rings(self) -> list[CallbackRing]:
+        return [self.mic, self.speaker]
+
+    def stats(self, window: int | None = None) -> list[CallbackStats]:
+        return [
+            CallbackStats.from_records(
+                ring.name, ring.snapshot(window), self.sample_rate
+            )
+            for ring in self.rings
+        ]
+
+    def dump(self, path: Path, window: int | None = None):
+        """saves the stats and the raw records as json"""
+        report = {
+            "sample_rate": self.sample_rate,
+            "stats": [asdict(stats) for stats in self.stats(window)],
+            "records": {
+                ring.name: {
+                    "columns": [column.name.lower() for column in Column],
+                    "rows": ring.snapshot(window).tolist(),
+                }
+                for ring in self.rings
+            },
+        }
+        path.write_text(json.dumps(report, indent=2))
+
+    def reset(self):
+        for ring in self.rings:
+            ring.reset()
+        self.mix_seconds.clear()
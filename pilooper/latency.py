@@ -0,0 +1,144 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import Event
+import json
+import numpy as np
+import pyaudio
+import pilooper.constants as constants
+from pilooper.audio_format import DEFAULT_FORMAT, AudioFormat
+
+# the test signal is played this many times, the latency is the median
+CALIBRATION_REPEATS = 4
+# time between test signals, has to be longer than the latency
+CALIBRATION_PERIOD_SECONDS = 0.5
+SIGNAL_SECONDS = 0.02
+# the correlation peak has to stand out this much from the median
+MIN_PEAK_RATIO = 8.0
+# the repeats have to agree to within this
+MAX_SPREAD_SECONDS = 0.002
+# largest callback the calibration can serve
+MAX_FRAME_COUNT = 8192
+
+
+class CalibrationError(RuntimeError):
+    """the test signal wasnt picked up (consistently) by the mic"""
+
+
+def calibration_signal(sample_rate: int = constants.SAMPLING_RATE) -> np.ndarray:
+    """a short windowed chirp (500Hz - 8kHz), int16
+
+    broadband, so its correlation with itself has a single narrow peak, unlike
+    a click its loud enough to survive bluetooth codecs
+    """
+    num_samples = int(SIGNAL_SECONDS * sample_rate)
+    t = np.arange(num_samples) / sample_rate
+    f0, f1 = 500.0, 8000.0
+    phase = 2 * np.pi * (f0 * t + (f1 - f0) * t**2 / (2 * SIGNAL_SECONDS))
+    signal = np.sin(phase) * np.hanning(num_samples) * 16_000
+    return signal.astype(np.int16)
+
+
+def measure_latency(
+    signal: np.ndarray, recorded: np.ndarray, sample_rate: int = constants.SAMPLING_RATE
+) -> int:
+    """round trip latency (in samples) of signal, played every
+    CALIBRATION_PERIOD_SECONDS from the start of recorded
+
+    the cross-correlation is computed once for the whole recording (fft), the
+    peak of each repeat is searched in the period after it was played
+    """
+    period = int(CALIBRATION_PERIOD_SECONDS * sample_rate)
+    assert len(recorded) >= CALIBRATION_REPEATS * period
+
+    num_fft = 1 << (len(recorded) + len(signal) - 1).bit_length()
+    spectrum = np.fft.rfft(recorded.astype(np.float32), num_fft) * np.conj(
+        np.fft.rfft(signal.astype(np.float32), num_fft)
+    )
+    # note : abs, the round trip might flip the polarity
+    correlation = np.abs(np.fft.irfft(spectrum, num_fft)[: len(recorded)])
+
+    starts = np.arange(CALIBRATION_REPEATS) * period
+    windows = correlation[starts[:, None] + np.arange(period - len(signal))]
+    lags = windows.argmax(axis=1)
+    peaks = windows.max(axis=1)
+    floors = np.median(windows, axis=1)
+    if np.any(peaks < MIN_PEAK_RATIO * floors) or not np.all(peaks > 0):
+        raise CalibrationError("test signal wasnt picked up by the mic")
+    if lags.max() - lags.min() > MAX_SPREAD_SECONDS * sample_rate:
+        raise CalibrationError(f"inconsistent latencies : {lags.tolist()} samples")
+    return int(np.median(lags))
+
+
+@dataclass
+class LatencyCalibration:
+    """plays the test signal and records it back from a full duplex callback
+
+    the signal is played on every channel, only the first input channel is
+    recorded
+    """
+
+    signal: np.ndarray
+    # played (zero padded for the last callback) frames / recorded audio
+    output: np.ndarray = field(repr=False)
+    recorded: np.ndarray = field(repr=False)
+    format: AudioFormat = DEFAULT_FORMAT
+    position: int = 0
+    done: Event = field(default_factory=Event)
+
+    @classmethod
+    def create(cls, format: AudioFormat = DEFAULT_FORMAT) -> LatencyCalibration:
+        signal = calibration_signal(format.sample_rate)
+        period = int(CALIBRATION_PERIOD_SECONDS * format.sample_rate)
+        num_samples = CALIBRATION_REPEATS * period
+        output = np.zeros(
+            (num_samples + MAX_FRAME_COUNT, format.channels), dtype=format.dtype
+        )
+        for start in range(0, num_samples, period):
+            output[start : start + len(signal)] = signal[:, None]
+        return cls(
+            signal=signal,
+            output=output,
+            recorded=np.zeros(num_samples, dtype=format.dtype),
+            format=format,
+        )
+
+    def callback(
+        self, in_data: bytes, frame_count: int, _: dict, __: int
+    ) -> tuple[bytes, int]:
+        assert frame_count <= MAX_FRAME_COUNT
+        start = self.position
+        end = min(start + frame_count, len(self.recorded))
+        self.recorded[start:end] = self.format.frames(in_data)[: end - start, 0]
+        self.position = end
+        out_data = self.output[start : start + frame_count].tobytes()
+        if end == len(self.recorded):
+            self.done.set()
+            return out_data, pyaudio.paComplete
+        return out_data, pyaudio.paContinue
+
+    def latency(self) -> int:
+        assert self.done.is_set(), "calibration hasnt finished"
+        return measure_latency(self.signal, self.recorded, self.format.sample_rate)
+
+
+def latency_key(device: str, frames_per_buffer: int | None = None) -> str:
+    """latencies are stored by output device and frames per buffer, the
+    buffers are part of the round trip (None : portaudio picks the size)"""
+    if frames_per_buffer is None:
+        return device
+    return f"{device}@{frames_per_buffer}"
+
+
+def load_latencies(path: Path = constants.LATENCY_FILE) -> dict[str, int]:
+    """round trip latencies (in samples) by latency_key()"""
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def save_latency(device: str, latency: int, path: Path = constants.LATENCY_FILE):
+    latencies = load_latencies(path)
+    latencies[device] = latency
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(latencies, indent=2))
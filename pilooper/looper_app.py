@@ -31,6 +31,7 @@ class Looper(App):
     def action_start_record(self) -> None:
         log = self.query_one(Log)
         log.write_line("start recording new track...")
+        self.mixer.reserve_take()
         self.mic.start()
 
     def action_stop_record(self) -> None:
@@ -0,0 +1,275 @@
+from __future__ import annotations
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from threading import Event, Thread
+import numpy as np
+import prometheus_client as prom
+import pyaudio
+from pilooper.instrument import CallbackRing, Column
+from pilooper.mixer import Mixer
+
+METRICS_PORT = 9105
+# how often the instrumentation rings are drained into the metrics
+POLL_SECONDS = 1.0
+
+RUNTIME_BUCKETS = (
+    50e-6,
+    100e-6,
+    250e-6,
+    500e-6,
+    1e-3,
+    2.5e-3,
+    5e-3,
+    10e-3,
+    25e-3,
+    50e-3,
+)
+LOAD_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0)
+MIX_BUCKETS = (1e-3, 5e-3, 10e-3, 50e-3, 100e-3, 250e-3, 500e-3, 1.0, 2.5, 5.0)
+
+XRUN_FLAGS = {
+    "input_underflow": pyaudio.paInputUnderflow,
+    "input_overflow": pyaudio.paInputOverflow,
+    "output_underflow": pyaudio.paOutputUnderflow,
+    "output_overflow": pyaudio.paOutputOverflow,
+}
+
+
+@dataclass
+class Metrics:
+    """the prometheus metrics of a looper, in their own registry"""
+
+    registry: prom.CollectorRegistry
+    callback_runtime: prom.Histogram
+    callback_load: prom.Histogram
+    deadline_misses: prom.Counter
+    xruns: prom.Counter
+    lock_busy: prom.Counter
+    records_dropped: prom.Counter
+    stream_latency: prom.Gauge
+    end_to_end_latency: prom.Gauge
+    mix_duration: prom.Histogram
+    loop_length: prom.Gauge
+    take_length: prom.Gauge
+    buffer_bytes: prom.Gauge
+    metronome_enabled: prom.Gauge
+    metronome_bpm: prom.Gauge
+    beat_sync_bpm: prom.Gauge
+    recording: prom.Gauge
+
+    @classmethod
+    def create(cls, registry: prom.CollectorRegistry | None = None) -> Metrics:
+        if registry is None:
+            registry = prom.CollectorRegistry()
+            # process cpu / resident memory
+            prom.ProcessCollector(registry=registry)
+        return cls(
+            registry=registry,
+            callback_runtime=prom.Histogram(
+                "pilooper_callback_runtime_seconds",
+                "time spent in the audio callback",
+                ["callback"],
+                buckets=RUNTIME_BUCKETS,
+                registry=registry,
+            ),
+            callback_load=prom.Histogram(
+                "pilooper_callback_load_ratio",
+                "callback runtime / deadline (frame_count / sample rate)",
+                ["callback"],
+                buckets=LOAD_BUCKETS,
+                registry=registry,
+            ),
+            deadline_misses=prom.Counter(
+                "pilooper_callback_deadline_misses",
+                "callbacks that ran longer than their deadline",
+                ["callback"],
+                registry=registry,
+            ),
+            xruns=prom.Counter(
+                "pilooper_xruns",
+                "portaudio under / overflows",
+                ["callback", "kind"],
+                registry=registry,
+            ),
+            lock_busy=prom.Counter(
+                "pilooper_callback_lock_busy",
+                "locks found busy (and skipped) by the audio callback",
+                ["callback"],
+                registry=registry,
+            ),
+            records_dropped=prom.Counter(
+                "pilooper_instrumentation_records_dropped",
+                "callback records overwritten before they were collected",
+                ["callback"],
+                registry=registry,
+            ),
+            stream_latency=prom.Gauge(
+                "pilooper_stream_latency_seconds",
+                "latency of the audio stream as reported by portaudio",
+                ["callback"],
+                registry=registry,
+            ),
+            end_to_end_latency=prom.Gauge(
+                "pilooper_end_to_end_latency_seconds",
+                "input to output latency of a duplex stream (monitored input) as"
+                " reported by portaudio",
+                ["callback"],
+                registry=registry,
+            ),
+            mix_duration=prom.Histogram(
+                "pilooper_mix_duration_seconds",
+                "time taken by Mixer.mix",
+                buckets=MIX_BUCKETS,
+                registry=registry,
+            ),
+            loop_length=prom.Gauge(
+                "pilooper_loop_length_seconds",
+                "length of the loop thats playing",
+                registry=registry,
+            ),
+            take_length=prom.Gauge(
+                "pilooper_take_length_seconds",
+                "length of the take thats being recorded",
+                registry=registry,
+            ),
+            buffer_bytes=prom.Gauge(
+                "pilooper_buffer_bytes",
+                "bytes of the audio buffers in use : backed ahead of the mic, holding"
+                " the loop, mixed into by the overdub stream or held by the layers",
+                ["buffer"],
+                registry=registry,
+            ),
+            metronome_enabled=prom.Gauge(
+                "pilooper_metronome_enabled",
+                "1 if the metronome is playing",
+                registry=registry,
+            ),
+            metronome_bpm=prom.Gauge(
+                "pilooper_metronome_bpm",
+                "bpm of the metronome (0 : no metronome)",
+                registry=registry,
+            ),
+            beat_sync_bpm=prom.Gauge(
+                "pilooper_beat_sync_bpm",
+                "bpm takes are synced to (0 : beat sync is off)",
+                registry=registry,
+            ),
+            recording=prom.Gauge(
+                "pilooper_recording",
+                "1 while a take is being recorded",
+                registry=registry,
+            ),
+        )
+
+
+@dataclass
+class MetricsExporter:
+    """collects metrics from a mixer on a background thread
+
+    the audio callbacks only write to the instrumentation rings, the rings are
+    drained into the metrics here (every POLL_SECONDS), so nothing on the audio
+    thread allocates or takes a lock for the metrics
+    """
+
+    mixer: Mixer
+    metrics: Metrics
+    # returns True while recording (the controller knows, the mixer doesnt)
+    is_recording: Callable[[], bool] | None = None
+    read_idx: dict[str, int] = field(default_factory=dict)
+    stop_event: Event = field(repr=False, default_factory=Event)
+    thread: Thread | None = None
+
+    @classmethod
+    def create(
+        cls, mixer: Mixer, is_recording: Callable[[], bool] | None = None
+    ) -> MetricsExporter:
+        return cls(mixer=mixer, metrics=Metrics.create(), is_recording=is_recording)
+
+    def serve(self, port: int = METRICS_PORT):
+        """starts the http endpoint (/metrics) and the collection thread"""
+        prom.start_http_server(port, registry=self.metrics.registry)
+        self.thread = Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _worker(self):
+        while not self.stop_event.wait(POLL_SECONDS):
+            self.poll()
+
+    def _collect_ring(self, ring: CallbackRing, sample_rate: int):
+        records, self.read_idx[ring.name], num_dropped = ring.read_from(
+            self.read_idx.get(ring.name, 0)
+        )
+        metrics = self.metrics
+        if num_dropped:
+            metrics.records_dropped.labels(ring.name).inc(num_dropped)
+        if len(records) == 0:
+            return
+
+        runtime = records[:, Column.RUNTIME_NS] / 1e9
+        load = runtime / (records[:, Column.FRAME_COUNT] / sample_rate)
+        runtime_histogram = metrics.callback_runtime.labels(ring.name)
+        load_histogram = metrics.callback_load.labels(ring.name)
+        for runtime_s, load_ratio in zip(runtime.tolist(), load.tolist()):
+            runtime_histogram.observe(runtime_s)
+            load_histogram.observe(load_ratio)
+
+        metrics.deadline_misses.labels(ring.name).inc(int(np.count_nonzero(load > 1.0)))
+        status = records[:, Column.STATUS]
+        for kind, flag in XRUN_FLAGS.items():
+            metrics.xruns.labels(ring.name, kind).inc(
+                int(np.count_nonzero(status & flag))
+            )
+        metrics.lock_busy.labels(ring.name).inc(int(records[:, Column.LOCK_BUSY].sum()))
+        metrics.stream_latency.labels(ring.name).set(
+            records[-1, Column.STREAM_LATENCY_NS] / 1e9
+        )
+        metrics.end_to_end_latency.labels(ring.name).set(
+            records[-1, Column.END_TO_END_LATENCY_NS] / 1e9
+        )
+
+    def poll(self):
+        mixer, metrics = self.mixer, self.metrics
+        instrumentation = mixer.instrumentation
+        for ring in instrumentation.rings:
+            self._collect_ring(ring, instrumentation.sample_rate)
+        while instrumentation.mix_seconds:
+            metrics.mix_duration.observe(instrumentation.mix_seconds.popleft())
+
+        # note : no locks, these are single reads of values the mixer replaces
+        sample_rate = mixer.format.sample_rate
+        metrics.loop_length.set(mixer.speaker_track.track.length / sample_rate)
+        take_frames = mixer.format.to_frames(mixer.mic_track.ring.write_idx)
+        metrics.take_length.set(take_frames / sample_rate)
+
+        # note : the capacities are fixed, what counts is how much of them is
+        # backed / holds audio. a streamed loop is shared by mixed and speaker
+        bus = mixer.format.bus
+        buffers = {
+            "mic": mixer.mic_track.reserved_idx,
+            "mixed": mixer.mixed_track.length_bytes,
+            "speaker_front": mixer.speaker_track.track.length_bytes,
+        }
+        if mixer.speaker_track.back is not None:
+            buffers["speaker_back"] = mixer.speaker_track.back.length_bytes
+        if mixer.stream is not None:
+            buffers["pending"] = bus.to_bytes(mixer.stream.num_mixed)
+        if mixer.layers is not None:
+            layers = mixer.layers
+            buffers["layers"] = bus.to_bytes(layers.length) + sum(
+                layer.data.nbytes for layer in layers.layers + layers.undone
+            )
+        for name, num_bytes in buffers.items():
+            metrics.buffer_bytes.labels(name).set(num_bytes)
+
+        metronome = mixer.metronome
+        metrics.metronome_enabled.set(metronome is not None and metronome.enabled)
+        metrics.metronome_bpm.set(metronome.bpm if metronome is not None else 0)
+        metrics.beat_sync_bpm.set(mixer.bpm or 0)
+        if self.is_recording is not None:
+            metrics.recording.set(self.is_recording())
@@ -1,61 +1,111 @@
 from __future__ import annotations
-from dataclasses import dataclass
-from pilooper.track import SpeakerTrack, Track
-import pilooper.constants as constants
+from dataclasses import dataclass, field
+import math
+import pilooper.dsp as dsp
+from pilooper.audio_format import DEFAULT_FORMAT, AudioFormat
 import wave
 from pathlib import Path
 import numpy as np
-from threading import Lock
+
+# the click is precomputed at NUM_PHASES fractional delays, which places beats
+# to within 1 / NUM_PHASES of a sample
+NUM_PHASES = 16
+
+
+def _fractional_delays(click: np.ndarray, channels: int = 1) -> np.ndarray:
+    """returns click delayed by 0, 1 / NUM_PHASES, ... samples (linear interpolation),
+    as a NUM_PHASES x (len(click) + 1) x channels float32 array"""
+    phases = np.zeros((NUM_PHASES, len(click) + 1), dtype=np.float32)
+    for phase in range(NUM_PHASES):
+        frac = phase / NUM_PHASES
+        phases[phase, :-1] += (1 - frac) * click
+        phases[phase, 1:] += frac * click
+    # note : the same click on every channel
+    return np.repeat(phases[..., None], channels, axis=2)
+
+
+def _resample(x: np.ndarray, from_rate: int, to_rate: int) -> np.ndarray:
+    """linear interpolation, good enough for a click"""
+    if from_rate == to_rate:
+        return x
+    t = np.arange(round(len(x) * to_rate / from_rate)) * from_rate / to_rate
+    return np.interp(t, np.arange(len(x)), x)
 
 
 @dataclass
-class Metronome(SpeakerTrack):
+class Metronome:
+    """plays a click on every beat, rendered straight into the speaker output
+
+    beat k starts at k * samples_per_beat, which is a float : theres no drift
+    for bpms that dont divide the sampling rate, and no buffer the size of the
+    loop to re-tile when the bpm changes
+    """
+
+    click: np.ndarray  # int16, mono
     bpm: int
     enabled: bool
+    format: AudioFormat = DEFAULT_FORMAT
+    phases: np.ndarray = field(init=False, repr=False)
+    samples_per_beat: float = field(init=False)
+
+    def __post_init__(self):
+        self.phases = _fractional_delays(self.click, self.format.channels)
+        self.set_bpm(self.bpm)
 
     @classmethod
     def from_file(
-        cls, wav_file: Path, bpm: int, track_length_seconds: int
+        cls, wav_file: Path, bpm: int, format: AudioFormat = DEFAULT_FORMAT
     ) -> Metronome:
+        """the click is mixed down to mono and resampled to format"""
         wav_audio = bytearray(0)
         with wave.open(str(wav_file), "rb") as wf:
             while len(data := wf.readframes(1024)):  # Requires Python 3.8+ for :=
                 wav_audio.extend(data)
-        # assert (
-        #    len(wav_audio) < constants.SAMPLING_RATE
-        # ), "this method assumes wav file duration < 1s"
-        samples_per_minute = constants.SAMPLING_RATE * 60
-        samples_per_beat = (
-            samples_per_minute // bpm
-        )  # TODO : is this the right thing to do?
-
-        # clip / extend wav audio to samples per beat
-        num_wav_samples = len(wav_audio) // 2
-        if num_wav_samples < samples_per_beat:
-            padding = samples_per_beat - num_wav_samples
-            zeros = np.zeros(padding, dtype=np.int16)
-            wav_audio.extend(zeros.tobytes())
-        else:
-            clip_bytes = samples_per_beat * 2
-            wav_audio = wav_audio[:clip_bytes]
-        assert (
-            len(wav_audio) / 2 == samples_per_beat
-        ), f"havent clipped / padded correctly : {len(wav_audio) / 2}, {samples_per_beat}"
-        np_wav_audio = np.frombuffer(wav_audio, dtype=np.int16)
-
-        np_track = np.zeros(
-            constants.SAMPLING_RATE * track_length_seconds, dtype=np.int16
-        )
-        num_track_filled = len(np_track) - len(np_track) % samples_per_beat
-        num_tile = num_track_filled // samples_per_beat
-        np_track[:num_track_filled] = np.tile(np_wav_audio, num_tile)
-
+            channels, sample_rate = wf.getnchannels(), wf.getframerate()
+        click = np.frombuffer(wav_audio, dtype=np.int16).reshape(-1, channels)
+        click = _resample(click.mean(axis=1), sample_rate, format.sample_rate)
         return cls(
+            click=np.rint(click).astype(np.int16),
             bpm=bpm,
             enabled=True,
-            track=Track(
-                data=bytearray(np_track.tobytes()),
-                mutex=Lock(),
-                length_bytes=num_track_filled * 2,
-            ),
+            format=format,
         )
+
+    @classmethod
+    def from_synth(cls, bpm: int, format: AudioFormat = DEFAULT_FORMAT) -> Metronome:
+        """a short, decaying 1khz click"""
+        t = np.arange(format.sample_rate // 20) / format.sample_rate
+        click = 8_000 * np.sin(2 * np.pi * 1_000 * t) * np.exp(-t * 200)
+        return cls(click=click.astype(np.int16), bpm=bpm, enabled=True, format=format)
+
+    def set_bpm(self, bpm: int):
+        # note : a single attribute store, so the speaker callback never sees
+        # a half updated beat grid
+        self.samples_per_beat = dsp.samples_per_beat(bpm, self.format.sample_rate)
+        self.bpm = bpm
+
+    def mix_into(self, out: np.ndarray, position: int):
+        """adds the clicks that fall into [position, position + len(out)) of the
+        beat grid to out (float32 frames of the mix bus)"""
+        if not self.enabled:
+            return
+
+        samples_per_beat = self.samples_per_beat
+        click_len = self.phases.shape[1]
+        end = position + len(out)
+        first_beat = max(0, math.floor((position - click_len) / samples_per_beat))
+        last_beat = math.ceil(end / samples_per_beat)
+        for beat in range(first_beat, last_beat + 1):
+            beat_start = beat * samples_per_beat
+            start = math.floor(beat_start)
+            phase = round((beat_start - start) * NUM_PHASES)
+            if phase == NUM_PHASES:
+                start, phase = start + 1, 0
+
+            lo = max(start, position)
+            hi = min(start + click_len, end)
+            if hi <= lo:
+                continue
+            out[lo - position : hi - position] += self.phases[
+                phase, lo - start : hi - start
+            ]
@@ -1,13 +1,24 @@
 from __future__ import annotations
+from contextlib import AbstractContextManager, nullcontext
 from pathlib import Path
+from enum import Enum
+import math
+from typing import assert_never
+from collections.abc import Callable
 import numpy as np
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import pyaudio
 import pilooper.constants as constants
-from threading import Lock
+from threading import Event, Lock, RLock, Thread
 import logging
-from pilooper.track import SpeakerTrack, MicTrack, Track
+import time
+from pilooper.audio_format import DEFAULT_FORMAT, AudioFormat
+from pilooper.track import Buffer, SpeakerTrack, MicTrack, Track, allocate
 from pilooper.metronome import Metronome
+from pilooper.instrument import Instrumentation
+from pilooper.export import Exporter
+import pilooper.dsp as dsp
+import pilooper.onset as onset
 
 Pa_Callback_Flags = (
     pyaudio.paInputUnderflow
@@ -17,8 +28,228 @@ Pa_Callback_Flags = (
 )
 
 
+class TileMode(Enum):
+    # the shorter of loop / take is repeated to the length of the longer one
+    LONGEST = 0
+    # both are repeated to their least common multiple, so that phrases of
+    # different lengths (say 3 beats over 4 beats) line up
+    LCM = 1
+
+
+# how often the overdub stream picks up newly recorded audio, roughly one
+# callback period
+STREAM_PERIOD_SECONDS = 0.02
+# memory thats kept backed ahead of the recording position of the mic
+RESERVE_SECONDS = 2
+# length of the fades at the ends of every take and across loop seams
+# (see dsp.Fade)
+FADE_SECONDS = 0.005
+
+
+@dataclass
+class OverdubStream:
+    """state for mixing a take into the loop while its still being recorded
+
+    a worker thread mixes every block the mic has recorded into pending_track
+    (pending[i] = mixed[i % mixed_len] + mic[i]). mixed_track isnt touched, so
+    a take can still be thrown away. at mix time only the samples recorded
+    since the last step (and the tail, if the loop is longer than the take)
+    are left to mix, then pending and mixed tracks swap buffers and the new
+    loop is published to the speaker as is (see Mixer._publish_mixed())
+    """
+
+    pending_track: Track
+    # number of mic frames already mixed into pending_track
+    num_mixed: int = 0
+    # buffer that isnt in use while mixed_track is shared with the speaker
+    spare: Buffer | None = field(repr=False, default=None)
+    lock: RLock = field(default_factory=RLock)
+    scratch: np.ndarray = field(repr=False, default_factory=dsp.make_float_scratch)
+    stop_event: Event = field(repr=False, default_factory=Event)
+    thread: Thread | None = None
+
+
+@dataclass
+class Layer:
+    data: np.ndarray  # int16 copy of the take, (num_frames, channels)
+    gain: float = 1.0
+    muted: bool = False
+    # loop length (in frames) before / after this layer was added
+    length_before: int = 0
+    length_after: int = 0
+    # the layer is tiled from data[offset] at the start of the loop
+    offset: int = 0
+    # seam crossfade of the loop, if adding the layer made it longer (see
+    # LayerStack._set_length())
+    seam: np.ndarray | None = None
+
+    @property
+    def weight(self) -> float:
+        return 0.0 if self.muted else self.gain
+
+
+@dataclass
+class LayerStack:
+    """keeps every take as a separate layer on top of a running sum
+
+    the sum (float32, so that it can be subtracted from exactly) is what gets
+    played, so playback stays a single read and undo / mute / gain changes are
+    a single (tiled) add or subtract of one layer instead of re-summing all of
+    them. a layer added before the loop grew is replayed the way the loop grew
+    over it instead (see _laid_down()). once the layers take up more than
+    budget_bytes, the oldest ones are frozen : they stay in the sum but cant be
+    changed anymore, which keeps the memory bounded
+    """
+
+    sum: np.ndarray  # float32, (track capacity, channels)
+    budget_bytes: int
+    length: int = 0  # loop length in frames
+    layers: list[Layer] = field(default_factory=list)
+    undone: list[Layer] = field(default_factory=list)
+    fade: dsp.Fade = field(repr=False, default_factory=lambda: dsp.Fade.create(0))
+    scratch: np.ndarray = field(repr=False, default_factory=dsp.make_float_scratch)
+
+    @classmethod
+    def create(
+        cls, num_frames: int, budget_bytes: int, channels: int = 1, fade_frames: int = 0
+    ) -> LayerStack:
+        """fade_frames : length of the loop seam crossfades (see dsp.Fade)"""
+        return cls(
+            sum=np.zeros((num_frames, channels), dtype=np.float32),
+            budget_bytes=budget_bytes,
+            fade=dsp.Fade.create(fade_frames, channels),
+        )
+
+    def _accumulate(self, layer: Layer, weight: float):
+        """sum += weight * layer, for a layer added to a loop of the current
+        length (see _laid_down() otherwise)"""
+        assert layer.length_after == self.length
+        if weight != 0.0:
+            loop = self.sum[: self.length]
+            dsp.accumulate_tiled(loop, layer.data, weight, self.scratch, layer.offset)
+            self.fade.crossfade_seam(loop, layer.data, weight, layer.offset)
+
+    def _laid_down(self, idx: int) -> np.ndarray:
+        """what layer idx adds to the sum (at weight 1), float32 frames
+
+        the layer was tiled over the loop it was added to, every later take
+        that made the loop longer then repeated that (with a seam crossfade,
+        see _set_length()) instead of tiling the layer afresh. both are linear,
+        so they're replayed on the layer alone. note : allocates a loop
+        """
+        layer = self.layers[idx]
+        out = np.zeros((self.length, self.sum.shape[1]), dtype=np.float32)
+        length = layer.length_after
+        dsp.accumulate_tiled(out[:length], layer.data, 1.0, self.scratch, layer.offset)
+        self.fade.crossfade_seam(out[:length], layer.data, 1.0, layer.offset)
+        for later in self.layers[idx + 1 :]:
+            if later.length_after > length:
+                dsp.tile_into(out[: later.length_after], length)
+                self.fade.crossfade_seam(out[: later.length_after], out[:length])
+                length = later.length_after
+        assert length == self.length
+        return out
+
+    def _reweight(self, idx: int, prev_weight: float):
+        """updates the sum after the weight of layer idx changed"""
+        num_layers = len(self.layers)
+        assert -num_layers <= idx < num_layers, f"no layer {idx}"
+        layer = self.layers[idx]
+        delta = layer.weight - prev_weight
+        if delta == 0.0:
+            return
+        if layer.length_after == self.length:
+            self._accumulate(layer, delta)
+            return
+        # note : _laid_down() replays the layers after idx, it needs idx >= 0
+        laid_down = self._laid_down(idx % num_layers)
+        laid_down *= delta
+        self.sum[: self.length] += laid_down
+
+    def _set_length(self, length: int) -> np.ndarray | None:
+        """everything mixed so far is repeated to the new length, returns the
+        crossfade of the new seam (see dsp.Fade.crossfade_seam())"""
+        if self.length == 0:
+            self.sum[:length] = 0
+            self.length = length
+            return None
+        dsp.tile_into(self.sum[:length], self.length)
+        seam = self.fade.crossfade_seam(self.sum[:length], self.sum[: self.length])
+        self.length = length
+        return None if seam is None else seam.copy()
+
+    def push(self, take: np.ndarray, length: int, offset: int = 0):
+        """adds a copy of take (int16 frames) as a new layer, the loop becomes
+        length frames long. offset : see Layer"""
+        layer = Layer(
+            data=take.copy(),
+            length_before=self.length,
+            length_after=length,
+            offset=offset,
+        )
+        layer.seam = self._set_length(length)
+        self._accumulate(layer, layer.weight)
+        self.layers.append(layer)
+        self.undone.clear()
+        self._freeze()
+
+    def _freeze(self):
+        num_bytes = sum(layer.data.nbytes for layer in self.layers)
+        while self.layers and num_bytes > self.budget_bytes:
+            num_bytes -= self.layers.pop(0).data.nbytes
+
+    def undo(self) -> bool:
+        if not self.layers:
+            return False
+        layer = self.layers.pop()
+        self._accumulate(layer, -layer.weight)
+        if layer.seam is not None:
+            self.sum[: len(layer.seam)] -= layer.seam
+        self.length = layer.length_before
+        self.undone.append(layer)
+        return True
+
+    def redo(self) -> bool:
+        if not self.undone:
+            return False
+        layer = self.undone.pop()
+        layer.seam = self._set_length(layer.length_after)
+        self._accumulate(layer, layer.weight)
+        self.layers.append(layer)
+        return True
+
+    def set_gain(self, idx: int, gain: float):
+        layer = self.layers[idx]
+        prev_weight = layer.weight
+        layer.gain = gain
+        self._reweight(idx, prev_weight)
+
+    def set_muted(self, idx: int, muted: bool):
+        layer = self.layers[idx]
+        prev_weight = layer.weight
+        layer.muted = muted
+        self._reweight(idx, prev_weight)
+
+    def render_into(self, dst: np.ndarray):
+        """writes the mix of all layers into dst[:length] (float32, the mix bus)"""
+        np.copyto(dst[: self.length], self.sum[: self.length])
+
+    def reset(self):
+        self.length = 0
+        self.layers.clear()
+        self.undone.clear()
+
+
 @dataclass
 class Mixer:
+    """mixes the takes recorded by the mic into the loop played by the speaker
+
+    the mixed (and speaker / pending) tracks are a float32 mix bus in int16
+    units (see AudioFormat.bus) : overdubs are summed without clipping or
+    rounding, however many there are. only the speaker callback (a block at a
+    time) and the exporter limit / round the bus back to int16
+    """
+
     mic_track: MicTrack
     speaker_track: SpeakerTrack
     mixed_track: Track
@@ -28,140 +259,449 @@ class Mixer:
     bpm: int | None
     clip_50: bool | None  # mic tracks are clipped to 50% to avoid pedal clicks
     save_on_mix: bool = False
+    # new mixes start playing at the end of the current loop instead of
+    # right away (at the current play position)
+    swap_at_boundary: bool = False
+    tile_mode: TileMode = TileMode.LONGEST
+    # mix takes while theyre being recorded (see OverdubStream)
+    stream: OverdubStream | None = None
+    # keep takes as separate layers that can be undone (see LayerStack)
+    layers: LayerStack | None = None
+    # directory for memory mapped tracks (None : tracks are kept in ram)
+    storage_dir: Path | None = None
+    metronome_wav: Path = constants.METRONOME_WAV
+    # round trip (output -> input) latency in frames : takes are recorded this
+    # late compared to the loop that was played along to (see latency.py)
+    latency: int = 0
+    # duplex_callback only records while this is set (see start_recording())
+    recording: bool = False
+    record_lock: Lock = field(repr=False, default_factory=Lock)
+    # writes the mixes to disk in the background (see save_mix_track())
+    exporter: Exporter | None = None
+    # per-callback runtime / xrun records (see Instrumentation)
+    instrumentation: Instrumentation = field(default_factory=Instrumentation.create)
+    format: AudioFormat = DEFAULT_FORMAT
+    # length of the take fades / loop seam crossfades (see dsp.Fade)
+    fade_seconds: float = FADE_SECONDS
+    fade: dsp.Fade = field(init=False, repr=False)
+    # scratch block for the mixing kernels
+    scratch: np.ndarray = field(
+        init=False, repr=False, default_factory=dsp.make_float_scratch
+    )
 
     @classmethod
-    def create_mixer(cls, track_length_seconds: int, log_level=logging.INFO):
-        buff_len = constants.SAMPLING_RATE * track_length_seconds * 2  # int16
+    def create_mixer(
+        cls,
+        track_length_seconds: int,
+        log_level=logging.INFO,
+        stream_overdubs: bool = False,
+        layer_budget_seconds: int | None = None,
+        storage_dir: Path | None = None,
+        allocator: Callable[[int], Buffer] | None = None,
+        format: AudioFormat = DEFAULT_FORMAT,
+        fade_seconds: float = FADE_SECONDS,
+    ):
+        """format : sample rate / channels / bit depth of the devices and tracks
+        fade_seconds : length of the take fades / loop seam crossfades (0 : off)
+        layer_budget_seconds : enables layers (undo / redo / per-layer gain),
+        keeping up to this many seconds of takes before freezing the oldest ones
+        storage_dir : memory maps the tracks to files in this directory instead
+        of keeping them in ram (see track.allocate())
+        allocator : allocates the track buffers instead (say SharedStorage)
+        """
+        assert not (
+            stream_overdubs and layer_budget_seconds is not None
+        ), "streaming overdubs and layers cant be combined"
+        assert format.dtype == np.int16, "the devices are int16 (see AudioFormat.bus)"
+        num_frames = format.frames_in(track_length_seconds)
         logger = logging.getLogger("mixer")
         logger.setLevel(log_level)
+        # note : front and back speaker buffers share the mutex, since they swap
+        speaker_mutex = Lock()
+
+        def _allocate(num_bytes: int):
+            if allocator is not None:
+                return allocator(num_bytes)
+            return allocate(num_bytes, storage_dir)
+
+        def _track(mutex: Lock, format: AudioFormat = format.bus) -> Track:
+            data = _allocate(format.to_bytes(num_frames))
+            return Track(data=data, mutex=mutex, format=format)
+
         return cls(
-            mic_track=MicTrack(track=Track(data=bytearray(buff_len), mutex=Lock())),
+            mic_track=MicTrack(track=_track(Lock(), format)),
             speaker_track=SpeakerTrack(
-                track=Track(data=bytearray(buff_len), mutex=Lock())
+                track=_track(speaker_mutex),
+                back=_track(speaker_mutex),
+                format=format,
             ),
-            mixed_track=Track(data=bytearray(buff_len), mutex=Lock()),
+            mixed_track=_track(Lock()),
             track_length_seconds=track_length_seconds,
             logger=logger,
             metronome=None,
             bpm=None,
             clip_50=False,
             save_on_mix=False,
+            stream=(
+                OverdubStream(pending_track=_track(Lock())) if stream_overdubs else None
+            ),
+            layers=(
+                LayerStack.create(
+                    num_frames=num_frames,
+                    budget_bytes=format.to_bytes(
+                        format.frames_in(layer_budget_seconds)
+                    ),
+                    channels=format.channels,
+                    fade_frames=format.frames_in(fade_seconds),
+                )
+                if layer_budget_seconds is not None
+                else None
+            ),
+            storage_dir=storage_dir,
+            instrumentation=Instrumentation.create(sample_rate=format.sample_rate),
+            format=format,
+            fade_seconds=fade_seconds,
         )
 
     def __post_init__(self):
-        import shutil
+        self.fade = dsp.Fade.create(
+            self.format.frames_in(self.fade_seconds), self.format.channels
+        )
+        # note : saved tracks are kept, the exporter numbers on from them
+        if self.save_on_mix and self.exporter is None:
+            self.exporter = self._create_exporter()
+        self.mic_track.reserve(self._reserve_bytes())
+        if self.stream is not None:
+            self.stream.thread = Thread(target=self._stream_worker, daemon=True)
+            self.stream.thread.start()
+
+    def _reserve_bytes(self) -> int:
+        return self.format.to_bytes(self.format.frames_in(RESERVE_SECONDS))
+
+    def _create_exporter(self) -> Exporter:
+        return Exporter.create(
+            sample_rate=self.format.sample_rate, channels=self.format.channels
+        )
 
-        if self.save_on_mix:
-            out = Path("./saved_tracks")
-            if out.exists():
-                shutil.rmtree(Path("./saved_tracks"))
+    def stop_stream(self):
+        """stops the overdub stream worker (if any)"""
+        if self.stream is None or self.stream.thread is None:
+            return
+        self.stream.stop_event.set()
+        self.stream.thread.join()
+        self.stream.thread = None
+
+    def _stream_worker(self):
+        assert self.stream is not None
+        while not self.stream.stop_event.wait(STREAM_PERIOD_SECONDS):
+            self.stream_step()
+
+    def stream_step(self):
+        """mixes everything the mic recorded since the last step into the pending loop"""
+        assert self.stream is not None
+        # keep memory reserved ahead of the mic while its recording
+        self.mic_track.reserve(self._reserve_bytes())
+        with self.stream.lock:
+            # note : length_bytes is published by the mic callback after the data
+            mic_len = self.mic_track.track.length
+            if mic_len <= self.stream.num_mixed:
+                return
+            # the take is mixed in from loop position offset on. only samples
+            # that land before the end of the current loop have a known place,
+            # the rest (which depends on the final loop length) is left to mix()
+            offset = self._take_offset()
+            mixed_len = self.mixed_track.length
+            end = offset + mic_len
+            if mixed_len:
+                end = min(end, mixed_len)
+            start = offset + self.stream.num_mixed
+            if end <= start:
+                return
+            self._preserve_exports(self.stream.pending_track.data)
+            np_pending = self.stream.pending_track.frames()
+            self._mix_take_into(np_pending, start, end, mic_len, self.stream.scratch)
+            self.stream.num_mixed = end - offset
+
+    def _stream_lock(self) -> AbstractContextManager:
+        """hold this while changing the take, so that the overdub stream (if
+        any) doesnt mix it half changed"""
+        return self.stream.lock if self.stream is not None else nullcontext()
+
+    def _remix_stream(self, ranges: list[tuple[int, int]]):
+        """mixes the [start, end) ranges of the take (frames) into the pending
+        loop again, where theyve been streamed already but changed since"""
+        assert self.stream is not None
+        offset = self._take_offset()
+        mic_len = self.mic_track.track.length
+        np_pending = self.stream.pending_track.frames()
+        for start, end in ranges:
+            end = min(end, self.stream.num_mixed, mic_len)
+            if start < end:
+                self._mix_take_into(
+                    np_pending, offset + start, offset + end, mic_len, self.scratch
+                )
 
-    def reset_mic_track(self):
+    def _mix_take_into(
+        self, dst: np.ndarray, start: int, end: int, mic_len: int, scratch: np.ndarray
+    ):
+        """dst[i] = mixed[i % mixed_len] + mic[(i - offset) % mic_len] for i in
+        [start, end), offset : see _take_offset()"""
+        mixed_len = self.mixed_track.length
+        offset = self._take_offset()
+        np_mixed = self.mixed_track.frames()
+        np_mic = self.mic_track.track.frames()
+        block = dst[start:end]
+        if mixed_len == 0:
+            block[:] = 0
+        else:
+            dsp.copy_tiled(block, np_mixed[:mixed_len], offset=start)
+        dsp.accumulate_tiled(
+            block, np_mic[:mic_len], 1.0, scratch, offset=start - offset
+        )
+
+    def _take_offset(self) -> int:
+        """loop position the take is mixed in at : where the loop was when the
+        take started, less the round trip latency (0 for the first take)"""
+        if self.mixed_track.length_bytes == 0:
+            return 0
+        offset = self.mic_track.loop_offset - self.latency
+        return offset % self.mixed_track.length
+
+    def set_latency(self, latency: int):
+        """round trip latency in frames, not to be changed while recording"""
         with self.mic_track.track.mutex:
+            self.latency = latency
+
+    def _reset_take(self):
+        if self.stream is None:
             self.mic_track.reset()
+        else:
+            with self.stream.lock:
+                self.mic_track.reset()
+                self.stream.num_mixed = 0
+        # note : without a stream, the rest is reserved once recording starts
+        # (see reserve_take())
+        self.mic_track.reserve(self._reserve_bytes())
+
+    def reset_mic_track(self):
+        with self.mic_track.track.mutex:
+            self._reset_take()
 
     def mic_callback(
-        self, in_data: bytes, frame_count: int, _: dict, __: Pa_Callback_Flags
+        self,
+        in_data: bytes,
+        frame_count: int,
+        time_info: dict,
+        status: Pa_Callback_Flags,
     ):
+        start_ns = time.perf_counter_ns()
         self.mic_track.save(in_data, frame_count)
+        self.instrumentation.mic.record(start_ns, frame_count, time_info, status)
         return None, pyaudio.paContinue
 
+    def reserve_take(self):
+        """backs the whole take with memory, call before the mic starts
+
+        the overdub stream (if any) keeps memory reserved ahead of the mic
+        while its recording (see stream_step()), without one nothing would
+        and the mic callback would page fault past RESERVE_SECONDS
+        """
+        if self.stream is None:
+            self.mic_track.reserve(len(self.mic_track.track.data))
+
+    def start_recording(self):
+        """starts recording takes from duplex_callback"""
+        self.reserve_take()
+        with self.record_lock:
+            self.recording = True
+
+    def stop_recording(self):
+        """once this returns, duplex_callback doesnt touch the take anymore"""
+        with self.record_lock:
+            self.recording = False
+
+    def duplex_callback(
+        self,
+        in_data: bytes,
+        frame_count: int,
+        time_info: dict,
+        status: Pa_Callback_Flags,
+    ):
+        """plays the loop and records (while recording) in the same callback
+
+        input and output share a clock and frame index : the first recorded
+        sample of a take was played along to the first sample of the output
+        block, which sets where the take is mixed into the loop. the input is
+        also monitored from here (see set_monitor_gain())
+        """
+        start_ns = time.perf_counter_ns()
+        out_data = self.speaker_track.next(frame_count=frame_count, in_data=in_data)
+
+        # note : never waits, the block isnt recorded if start / stop_recording
+        # holds the lock (its starting or stopping anyway)
+        lock_busy = self.speaker_track.lock_busy
+        if self.record_lock.acquire(blocking=False):
+            if self.recording:
+                if self.mic_track.ring.write_idx == 0:
+                    self.mic_track.loop_offset = self.speaker_track.block_position
+                self.mic_track.save(in_data, frame_count)
+            self.record_lock.release()
+        else:
+            lock_busy += 1
+
+        # note : recorded as the speaker, its the output deadline that matters
+        self.instrumentation.speaker.record(
+            start_ns,
+            frame_count,
+            time_info,
+            status,
+            lock_wait_ns=self.speaker_track.lock_wait_ns,
+            lock_busy=lock_busy,
+        )
+        return out_data, pyaudio.paContinue
+
     def speaker_callback(
-        self, _: None, frame_count: int, __: dict, ___: Pa_Callback_Flags
+        self, _: None, frame_count: int, time_info: dict, status: Pa_Callback_Flags
     ):
+        start_ns = time.perf_counter_ns()
         out_data = self.speaker_track.next(frame_count=frame_count)
+        self.instrumentation.speaker.record(
+            start_ns,
+            frame_count,
+            time_info,
+            status,
+            lock_wait_ns=self.speaker_track.lock_wait_ns,
+            lock_busy=self.speaker_track.lock_busy,
+        )
         return out_data, pyaudio.paContinue
 
-    def add_metronome(self, bpm: int):
-        with self.speaker_track.track.mutex:
-            wav_file = Path("/home/acharyahemanth/dev/drumstick_16.wav")
-            self.metronome = Metronome.from_file(
-                bpm=bpm,
-                wav_file=wav_file,
-                track_length_seconds=self.track_length_seconds,
+    def add_metronome(self, bpm: int, wav_file: Path | None = None):
+        """sets up the metronome at bpm, the click is loaded from wav_file
+        (default : metronome_wav, or a synthesized click if that doesnt exist)
+
+        changing the bpm of an existing metronome (no wav_file) is O(1)
+        """
+        if self.metronome is not None and wav_file is None:
+            self.metronome.set_bpm(bpm)
+            return
+
+        wav_file = wav_file or self.metronome_wav
+        if wav_file.exists():
+            metronome = Metronome.from_file(
+                wav_file=wav_file, bpm=bpm, format=self.format
             )
-            self._update_speaker()
+        else:
+            self.logger.warning(f"{wav_file} not found, using a synthesized click")
+            metronome = Metronome.from_synth(bpm=bpm, format=self.format)
+        self.metronome = metronome
+        self.speaker_track.overlay = metronome.mix_into
 
     def start_metronome(self):
         if self.metronome is None:
             return
-
-        with self.metronome.track.mutex:
-            self.metronome.enabled = True
-
-        self._update_speaker()
+        self.metronome.enabled = True
 
     def stop_metronome(self):
         if self.metronome is None:
             return
-
-        with self.metronome.track.mutex:
-            self.metronome.enabled = False
-
-        self._update_speaker()
+        self.metronome.enabled = False
 
     def _update_speaker(self):
-        def _no_metronome():
-            self.speaker_track.track.data = self.mixed_track.data
-            self.speaker_track.track.length_bytes = self.mixed_track.length_bytes
-
-        self.speaker_track.reset_playback()
-        match self.metronome:
-            case None:
-                _no_metronome()
-            case Metronome():
-                with self.metronome.track.mutex:
-                    if not self.metronome.enabled:
-                        _no_metronome()
-                        return
-                    if self.mixed_track.length_bytes == 0:
-                        # nothing mixed yet, just copy over the metronome
-                        self.speaker_track.track.data = self.metronome.track.data
-                        self.speaker_track.track.length_bytes = (
-                            self.metronome.track.length_bytes
-                        )
-                    else:
-                        # mix metronome with mixed_track
-                        np_mixed = np.frombuffer(self.mixed_track.data, dtype=np.int16)
-                        np_metronome = np.frombuffer(
-                            self.metronome.track.data, dtype=np.int16
-                        )
-                        new_mixed = np_mixed.astype(np.int32) + np_metronome.astype(
-                            np.int32
-                        )
-                        new_mixed = np.clip(
-                            new_mixed,
-                            a_min=np.iinfo(np.int16).min,
-                            a_max=np.iinfo(np.int16).max,
-                        )
-                        new_mixed = new_mixed.astype(np.int16)
-                        self.speaker_track.track.data = bytearray(new_mixed.tobytes())
-                        self.speaker_track.track.data[
-                            self.mixed_track.length_bytes :
-                        ] = bytearray(
-                            len(self.speaker_track.track.data)
-                            - self.mixed_track.length_bytes
-                        )
-                        self.speaker_track.track.length_bytes = (
-                            self.mixed_track.length_bytes
-                        )
-            case _:
-                assert False
-
-    def save_mix_track(self):
-        import wave
-
-        out = Path("./saved_tracks")
-        out.mkdir(exist_ok=True, parents=True)
-
-        idx = len(list(out.glob("**/*.wav")))
-        fname = f"track_{idx}.wav"
+        """copies mixed_track into the speakers back buffer and publishes it
+
+        note : needs to be called with speaker_track.track.mutex held. the
+        metronome is rendered by the speaker callback, on top of the loop.
+        O(loop length), streamed mixes publish without a copy (see
+        _publish_mixed())
+        """
+        back = self.speaker_track.back_buffer()
+        length_bytes = self.mixed_track.length_bytes
+        if back is not self.mixed_track.data:
+            # note : the back buffer might be a mix thats been exported
+            self._preserve_exports(back)
+            with memoryview(self.mixed_track.data) as data:
+                back[:length_bytes] = data[:length_bytes]
+        self.speaker_track.publish(length_bytes, at_boundary=self.swap_at_boundary)
+
+    def _publish_mixed(self):
+        """publishes the mixed_track buffer itself as the speakers back buffer,
+        O(1) unlike _update_speaker()
+
+        mixed_track and the speaker then share the buffer, which is fine as
+        long as nobody writes to it : streamed takes are mixed into pending_track.
+        the two buffers that are neither playing nor the new loop become
+        pending_track and the spare (see _unshare_mixed())
+
+        note : needs to be called with speaker_track.track.mutex held
+        """
+        assert self.stream is not None
+        speaker = self.speaker_track
+        assert speaker.back is not None, "speaker track isnt double buffered"
+        with self.stream.lock:
+            back = speaker.back_buffer()
+            mixed = self.mixed_track.data
+            free: list[Buffer] = []
+            for data in (self.stream.pending_track.data, back, self.stream.spare):
+                if (
+                    data is not None
+                    and data is not mixed
+                    and data is not speaker.track.data
+                    and all(data is not other for other in free)
+                ):
+                    free.append(data)
+            assert len(free) == 2, f"expected 2 free buffers, got {len(free)}"
+            self.stream.pending_track.data, self.stream.spare = free
+            speaker.back.data = mixed
+        speaker.publish(
+            self.mixed_track.length_bytes, at_boundary=self.swap_at_boundary
+        )
 
-        with wave.open(str(out / fname), "wb") as wf:
-            wf.setnchannels(1)
-            wf.setsampwidth(2)
-            wf.setframerate(constants.SAMPLING_RATE)
-            wf.writeframes(self.mixed_track.data[: self.mixed_track.length_bytes])
+    def _unshare_mixed(self):
+        """gives mixed_track a buffer of its own if its shared with the speaker
+        (see _publish_mixed()), call before writing to mixed_track in place
+
+        note : the new buffer holds garbage, not the loop
+        """
+        speaker = self.speaker_track
+        mixed = self.mixed_track.data
+        if mixed is not speaker.track.data and (
+            speaker.back is None or mixed is not speaker.back.data
+        ):
+            return
+        assert self.stream is not None and self.stream.spare is not None
+        self.mixed_track.data, self.stream.spare = self.stream.spare, None
+
+    def save_mix_track(self) -> Path:
+        """queues the mix to be written to disk, returns the path of the file
+
+        note : O(1), the mix isnt copied unless its changed before the
+        exporter (see Exporter) gets to it
+        """
+        if self.exporter is None:
+            self.exporter = self._create_exporter()
+        length = self.mixed_track.length
+        np_mixed = self.mixed_track.frames()
+        return self.exporter.export(self.mixed_track.data, np_mixed[:length])
+
+    def _preserve_exports(self, data: Buffer):
+        """call before changing the track buffer data (see Exporter.preserve())"""
+        if self.exporter is not None:
+            self.exporter.preserve(data)
+
+    def set_master_gain(self, gain: float):
+        """gain of the output, ramped in by the speaker callback (see
+        SpeakerTrack.gain)"""
+        self.speaker_track.gain.set(gain)
+
+    def set_monitor_gain(self, gain: float):
+        """gain of the input in the output (0 : not monitored), ramped in by the
+        speaker callback
+
+        note : only with a duplex stream (see duplex_callback()), which has
+        input and output in the same callback. separate mic / speaker streams
+        would have to buffer the input between them
+        """
+        self.speaker_track.monitor.set(gain)
 
     def set_bpm(self, bpm: int | None):
         with self.mic_track.track.mutex, self.speaker_track.track.mutex:
@@ -171,6 +711,64 @@ class Mixer:
         with self.mic_track.track.mutex, self.speaker_track.track.mutex:
             self.clip_50 = clip
 
+    def _trim_take(self):
+        """trims the take to whole beats and cuts the pedal clicks (see
+        onset.trim_take()). overdubs keep their start, the first take starts
+        on a metronome click (or its first note, without a metronome)"""
+        assert self.bpm is not None
+        samples_per_beat = dsp.samples_per_beat(self.bpm, self.format.sample_rate)
+        first_take = self.mixed_track.length_bytes == 0
+        # take index of a beat : the metronome plays them at free running
+        # positions before theres a loop. overdubs keep their start and are
+        # whole beats long from there, so that the loop stays whole beats
+        phase = None
+        if first_take and self.metronome is not None and self.metronome.enabled:
+            phase = (self.latency - self.mic_track.loop_offset) % samples_per_beat
+
+        mic_len = self.mic_track.track.length
+        np_mic = self.mic_track.track.frames()
+        trim = onset.trim_take(
+            np_mic[:mic_len],
+            samples_per_beat,
+            phase,
+            self.format.sample_rate,
+            keep_start=not first_take,
+        )
+        self.mic_track.trim(trim)
+
+        if self.stream is None:
+            return
+        # the streamed part of the take has to be mixed again where it changed
+        if trim.start:
+            self.stream.num_mixed = 0
+            return
+        self._remix_stream(trim.mute)
+
+    def _fade_take(self):
+        """fades the ends of the take in / out (see dsp.Fade.apply()), so that
+        it doesnt click where it starts and ends in the loop"""
+        mic_len = self.mic_track.track.length
+        num_faded = self.fade.apply(self.mic_track.track.frames()[:mic_len])
+        if self.stream is not None and num_faded:
+            self._remix_stream([(0, num_faded), (mic_len - num_faded, mic_len)])
+
+    def _new_loop_length(self, mixed_len: int, mic_len: int) -> int:
+        """length (in frames) of the loop after mixing in a take"""
+        longest = max(mixed_len, mic_len)
+        match self.tile_mode:
+            case TileMode.LONGEST:
+                return longest
+            case TileMode.LCM:
+                lcm = math.lcm(mixed_len, mic_len)
+                if lcm > self.mixed_track.capacity:
+                    self.logger.warning(
+                        f"lcm of {mixed_len} and {mic_len} frames doesnt fit the track, using the longest instead"
+                    )
+                    return longest
+                return lcm
+            case _:
+                assert_never(self.tile_mode)
+
     def mix(self):
         # TODO: this pattern of external mutex access seems quite risky in terms
         # of creating dead-locks
@@ -178,103 +776,177 @@ class Mixer:
             if self.mic_track.track.length_bytes == 0:
                 return
             self.logger.debug("mix()")
+            start = time.perf_counter()
+            self._preserve_exports(self.mixed_track.data)
+            if self.stream is not None:
+                self._preserve_exports(self.stream.pending_track.data)
+
+            with self._stream_lock():
+                # snap the take to the beat grid, without the pedal clicks
+                if self.bpm is not None:
+                    self._trim_take()
+
+                # clip to first half of the track to avoid pedal click
+                if self.clip_50:
+                    self.mic_track.clip_50()
+
+                if self.mic_track.track.length_bytes == 0:
+                    self.logger.warning(
+                        "nothing left to mix after clipping the mic track"
+                    )
+                    self._reset_take()
+                    return
+
+                # note : once per take, the callbacks play the faded loop as is
+                self._fade_take()
+
+            if self.layers is not None:
+                self._mix_layer()
+            elif self.stream is not None:
+                self._mix_stream()
+            else:
+                self._mix_in_place()
 
-            # use bpm to correct for recording delays
-            if self.bpm is not None:
-                self.mic_track.clip_to_beat_boundary(self.bpm)
-
-            # clip to first half of the track to avoid pedal click
-            if self.clip_50:
-                self.mic_track.clip_50()
-
-            # no speaker track so far, just copy over the mic track
-            if self.mixed_track.length_bytes == 0:
-                num_bytes = self.mic_track.track.length_bytes
-                self.mixed_track.data[:num_bytes] = self.mic_track.track.data[
-                    :num_bytes
-                ]
-                self.mixed_track.length_bytes = num_bytes
-                self.mic_track.reset()
+            if self.save_on_mix:
+                self.save_mix_track()
+
+            # update speaker track
+            self._reset_take()
+            if self.layers is None and self.stream is not None:
+                self._publish_mixed()
+            else:
                 self._update_speaker()
-                if self.save_on_mix:
-                    self.save_mix_track()
-                self.logger.debug(
-                    f"init speaker track by copying over mic track, mixed_track_len : {self.mixed_track.length_bytes}"
-                )
+            self.instrumentation.mix_seconds.append(time.perf_counter() - start)
+
+    def _mix_layer(self):
+        """adds the take as a new layer and re-renders mixed_track"""
+        assert self.layers is not None
+        mixed_len = self.layers.length
+        mic_len = self.mic_track.track.length
+        new_mixed_len = (
+            self._new_loop_length(mixed_len, mic_len) if mixed_len else mic_len
+        )
+        np_mic = self.mic_track.track.frames()
+        self.layers.push(np_mic[:mic_len], new_mixed_len, offset=-self._take_offset())
+        self._render_layers()
+
+    def _render_layers(self):
+        assert self.layers is not None
+        self.layers.render_into(self.mixed_track.frames())
+        self.mixed_track.length = self.layers.length
+
+    def _update_layers(self, update: Callable[[LayerStack], bool | None]):
+        assert self.layers is not None, "mixer was created without layers"
+        with self.mic_track.track.mutex, self.speaker_track.track.mutex:
+            if update(self.layers) is False:
                 return
+            self._preserve_exports(self.mixed_track.data)
+            self._render_layers()
+            self._update_speaker()
 
-            print("mixing mic track with speaker track")
-            print(
-                f"prev mixed track len : {self.mixed_track.length_bytes}, mic track len : {self.mic_track.track.length_bytes}"
-            )
+    def undo(self):
+        """removes the last layer"""
+        self._update_layers(LayerStack.undo)
 
-            # create np buffers (no copies at this point)
-            np_mixed = np.frombuffer(self.mixed_track.data, dtype=np.int16)
-            np_mic = np.frombuffer(self.mic_track.track.data, np.int16)
-            assert (
-                len(np_mixed) == len(np_mic)
-            ), f"mixed and mic tracs arent of same length : {np_mixed.nbytes} / {np_mic.nbytes}"
-
-            # extend smaller track to the size of the larger one
-            def _extend(x: np.ndarray, x_length_bytes: int, by_bytes: int):
-                x_length = x_length_bytes // 2
-                by = by_bytes // 2
-                extend_to = min(x_length + by, len(x))
-                num_tile = extend_to // x_length
-                extended = np.zeros_like(x)
-                extended[: num_tile * x_length] = np.tile(x[:x_length], num_tile)
-                num_pad = extend_to - num_tile * x_length
-                if num_pad > 0:
-                    pad_start = num_tile * x_length
-                    extended[pad_start : pad_start + num_pad] = x[:num_pad]
-
-                print(f"_extend() : extend_to : {extend_to}, num_tile : {num_tile}")
-                return extended, extend_to * 2
-
-            extend_mixed_track = (
-                self.mixed_track.length_bytes < self.mic_track.track.length_bytes
-            )
-            extend_by_bytes = abs(
-                self.mixed_track.length_bytes - self.mic_track.track.length_bytes
-            )
-            print(
-                f"extend_mixed_track : {extend_mixed_track} extend_mic_track : {not extend_mixed_track} extend_by : {extend_by_bytes}"
-            )
-            new_mixed_len_bytes = self.mixed_track.length_bytes
-            if extend_mixed_track:
-                np_mixed, new_mixed_len_bytes = _extend(
-                    np_mixed, self.mixed_track.length_bytes, extend_by_bytes
-                )
-            else:
-                np_mic, _ = _extend(
-                    np_mic, self.mic_track.track.length_bytes, extend_by_bytes
-                )
+    def redo(self):
+        """adds back the last undone layer"""
+        self._update_layers(LayerStack.redo)
+
+    def set_layer_gain(self, idx: int, gain: float):
+        self._update_layers(lambda layers: layers.set_gain(idx, gain))
 
-            assert (
-                len(np_mixed) == len(np_mic)
-            ), f"mixed and mic tracs arent of same length_bytes : {np_mixed.nbytes} / {np_mic.nbytes}"
+    def set_layer_muted(self, idx: int, muted: bool):
+        self._update_layers(lambda layers: layers.set_muted(idx, muted))
 
-            # mix new track
-            new_mixed = np_mixed.astype(np.int32) + np_mic.astype(np.int32)
-            new_mixed = np.clip(
-                new_mixed, a_min=np.iinfo(np.int16).min, a_max=np.iinfo(np.int16).max
+    def _mix_stream(self):
+        """finishes the take thats been mixed into the pending loop while recording"""
+        assert self.stream is not None
+        with self.stream.lock:
+            mixed_len = self.mixed_track.length
+            mic_len = self.mic_track.track.length
+            new_mixed_len = (
+                self._new_loop_length(mixed_len, mic_len) if mixed_len else mic_len
+            )
+            # note : the take might have been clipped since it was streamed
+            num_mixed = min(self.stream.num_mixed, mic_len)
+            self.logger.debug(
+                f"finishing streamed mix : {num_mixed} / {new_mixed_len} frames already mixed"
             )
-            new_mixed = new_mixed.astype(np.int16)
 
-            # store mixed track
-            self.mixed_track.data = bytearray(new_mixed.tobytes())
-            self.mixed_track.length_bytes = new_mixed_len_bytes
+            # pending[offset : offset + num_mixed] is done, mix the rest
+            offset = self._take_offset()
+            np_pending = self.stream.pending_track.frames()
+            self._mix_take_into(np_pending, 0, offset, mic_len, self.scratch)
+            self._mix_take_into(
+                np_pending, offset + num_mixed, new_mixed_len, mic_len, self.scratch
+            )
+            # crossfade the seams of the old loop and the take (see _mix_in_place())
+            loop = np_pending[:new_mixed_len]
+            if mixed_len:
+                self.fade.crossfade_seam(loop, self.mixed_track.frames()[:mixed_len])
+            np_mic = self.mic_track.track.frames()
+            self.fade.crossfade_seam(loop, np_mic[:mic_len], offset=-offset)
+
+            # the pending loop becomes the mixed loop, the old mixed buffer is
+            # reused for the next take
+            self.mixed_track.data, self.stream.pending_track.data = (
+                self.stream.pending_track.data,
+                self.mixed_track.data,
+            )
+            self.mixed_track.length = new_mixed_len
+
+    def _mix_in_place(self):
+        """mixes the take into mixed_track, in place"""
+        # no speaker track so far, just copy over the mic track
+        if self.mixed_track.length_bytes == 0:
+            mic_len = self.mic_track.track.length
+            np_mixed = self.mixed_track.frames()
+            np_mixed[:mic_len] = self.mic_track.track.frames()[:mic_len]
+            self.mixed_track.length = mic_len
+            self.logger.debug(
+                f"init speaker track by copying over mic track, mixed_track_len : {self.mixed_track.length_bytes}"
+            )
+            return
 
-            if self.save_on_mix:
-                self.save_mix_track()
+        mixed_len = self.mixed_track.length
+        mic_len = self.mic_track.track.length
+        self.logger.debug(
+            f"mixing mic track with speaker track : mixed track len : {mixed_len}, mic track len : {mic_len}"
+        )
 
-            # update speaker track
-            self.mic_track.reset()
-            self._update_speaker()
+        # note : np buffers are views, the mix is done in place in mixed_track
+        np_mixed = self.mixed_track.frames()
+        np_mic = self.mic_track.track.frames()
+        assert len(np_mixed) == len(
+            np_mic
+        ), f"mixed and mic tracs arent of same length : {len(np_mixed)} / {len(np_mic)}"
+
+        new_mixed_len = self._new_loop_length(mixed_len, mic_len)
+        self.logger.debug(f"new loop length : {new_mixed_len}")
+
+        # the shorter track(s) are repeated to the new loop length : the
+        # mixed track in place and the mic track virtually
+        # the seams of both are crossfaded where they dont fit the new loop a
+        # whole number of times. note : the old loops before the take is mixed in
+        dsp.tile_into(np_mixed[:new_mixed_len], mixed_len)
+        self.fade.crossfade_seam(np_mixed[:new_mixed_len], np_mixed[:mixed_len])
+        dsp.accumulate_tiled(
+            np_mixed[:new_mixed_len],
+            np_mic[:mic_len],
+            1.0,
+            self.scratch,
+            offset=-self._take_offset(),
+        )
+        self.fade.crossfade_seam(
+            np_mixed[:new_mixed_len], np_mic[:mic_len], offset=-self._take_offset()
+        )
+        self.mixed_track.length = new_mixed_len
 
     def reset(self):
         """resets both mic and speaker tracks (without releasing their memory)"""
         with self.mic_track.track.mutex, self.speaker_track.track.mutex:
-            self.mic_track.reset()
+            self._reset_take()
             self.speaker_track.reset()
             self.mixed_track.reset()
+            if self.layers is not None:
+                self.layers.reset()
@@ -0,0 +1,148 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+import numpy as np
+
+# analysis block : ~6ms at 44.1kHz, a pedal click spans a few of them
+BLOCK_SAMPLES = 256
+# pedal clicks (and the first note) are only looked for this close to either
+# end of the take : the analysis costs the same for a 1s and a 30min take
+WINDOW_SECONDS = 0.5
+# onset : spectral flux this many times the median flux of the window
+ONSET_RATIO = 4.0
+# blocks quieter than this (int16 rms, ~-50dBFS) have no onsets
+MIN_RMS = 100.0
+# click : an onset whose level drops back within CLICK_SECONDS, to below
+# CLICK_DECAY of its peak or close to the level before it (a note sustains)
+CLICK_SECONDS = 0.03
+CLICK_DECAY = 0.25
+
+
+@dataclass
+class Trim:
+    """what to keep of a take : take[start:end], with mute[i] (start, end)
+    ranges of the take silenced first"""
+
+    start: int
+    end: int
+    mute: list[tuple[int, int]] = field(default_factory=list)
+
+
+def _frames(x: np.ndarray) -> np.ndarray:
+    """float32 (num_blocks, BLOCK_SAMPLES) blocks of x, the tail is dropped. the
+    channels of (num_frames, channels) frames are averaged"""
+    num_blocks = len(x) // BLOCK_SAMPLES
+    x = x[: num_blocks * BLOCK_SAMPLES]
+    if x.ndim == 2:
+        return x.mean(axis=1, dtype=np.float32).reshape(num_blocks, BLOCK_SAMPLES)
+    return x.reshape(num_blocks, BLOCK_SAMPLES).astype(np.float32)
+
+
+def block_rms(frames: np.ndarray) -> np.ndarray:
+    return np.sqrt(np.einsum("ij,ij->i", frames, frames) / frames.shape[1])
+
+
+def spectral_flux(frames: np.ndarray) -> np.ndarray:
+    """sum of the magnitude increases of every frequency bin since the previous
+    block (0 for the first block)"""
+    magnitudes = np.abs(np.fft.rfft(frames * np.hanning(frames.shape[1]), axis=1))
+    rise = np.diff(magnitudes, axis=0, prepend=magnitudes[:1])
+    return np.maximum(rise, 0).sum(axis=1)
+
+
+def _onsets(flux: np.ndarray, rms: np.ndarray) -> np.ndarray:
+    """blocks where the flux rises above the onset threshold"""
+    above = (flux > ONSET_RATIO * np.median(flux)) & (rms > MIN_RMS)
+    return np.flatnonzero(above & ~np.concatenate(([False], above[:-1])))
+
+
+def _analyse(
+    x: np.ndarray, sample_rate: int
+) -> tuple[list[tuple[int, int]], list[int]]:
+    """(clicks, other onsets) in x, clicks as (start, end) and onsets as start
+    sample indices, in order"""
+    frames = _frames(x)
+    if len(frames) < 2:
+        return [], []
+    rms = block_rms(frames)
+    click_blocks = max(1, round(CLICK_SECONDS * sample_rate / BLOCK_SAMPLES))
+
+    clicks, onsets = [], []
+    for block in _onsets(spectral_flux(frames), rms).tolist():
+        after = block + click_blocks
+        peak = rms[block:after].max()
+        before = rms[block - 1] if block else 0.0
+        level = rms[after] if after < len(rms) else 0.0
+        if level < max(CLICK_DECAY * peak, 2 * before):
+            clicks.append((block * BLOCK_SAMPLES, after * BLOCK_SAMPLES))
+        else:
+            onsets.append(block * BLOCK_SAMPLES)
+    return clicks, onsets
+
+
+def _nearest(position: float, phase: float, samples_per_beat: float) -> float:
+    """grid point (phase + k * samples_per_beat) nearest to position"""
+    return phase + round((position - phase) / samples_per_beat) * samples_per_beat
+
+
+def trim_take(
+    take: np.ndarray,
+    samples_per_beat: float,
+    phase: float | None,
+    sample_rate: int,
+    keep_start: bool = False,
+) -> Trim:
+    """cuts the pedal clicks off a take (int16 samples or frames) and snaps it
+    to the beat grid
+
+    phase : take index of a beat, the grid is phase + k * samples_per_beat
+    (None : the first note after the start click is on the beat), unused with
+    keep_start
+    keep_start : the take has to start at index 0 (overdubs are placed by the
+    loop position they started at), the start click is only silenced then
+
+    the start moves to the grid point nearest the first note (but after the
+    click), the end to the whole number of beats from the start nearest the
+    stop click. if thats past the click, the click is silenced instead of cut.
+    an overdub that starts between beats is still whole beats long : tiled
+    over, its length becomes the loop length
+    """
+    num_samples = len(take)
+    window = min(num_samples, round(WINDOW_SECONDS * sample_rate))
+    head_clicks, head_onsets = _analyse(take[:window], sample_rate)
+    tail_clicks, _ = _analyse(take[num_samples - window :], sample_rate)
+
+    mute = []
+    click_end = 0
+    if head_clicks:
+        click_start, click_end = head_clicks[0]
+        if keep_start:
+            mute.append((click_start, click_end))
+    cut = num_samples
+    if tail_clicks:
+        cut = num_samples - window + tail_clicks[-1][0]
+    if cut <= click_end:
+        # nothing but clicks
+        return Trim(start=0, end=num_samples)
+
+    if keep_start:
+        start = 0.0
+    else:
+        notes = [onset for onset in head_onsets if onset >= click_end]
+        if phase is None:
+            phase = notes[0] if notes else click_end
+        start = _nearest(notes[0] if notes else click_end, phase, samples_per_beat)
+        if start < click_end:
+            start += samples_per_beat
+
+    # note : a whole number of beats long, rounded like the metronome grid
+    num_beats = round((cut - start) / samples_per_beat)
+    if start + num_beats * samples_per_beat > num_samples:
+        num_beats -= 1
+    end = round(start) + round(num_beats * samples_per_beat)
+    start = round(start)
+
+    if end <= start:
+        return Trim(start=0, end=cut, mute=mute)
+    if end > cut:
+        mute.append((cut, end))
+    return Trim(start=start, end=end, mute=mute)
@@ -8,7 +8,7 @@ import pyaudio
 import rich
 from typer import Typer
 
-from pilooper.constants import SAMPLING_RATE
+from pilooper.audio_format import DEFAULT_FORMAT, AudioFormat
 from pilooper.mixer import Mixer
 
 app = Typer()
@@ -24,21 +24,31 @@ class Speaker:
     sample_format: int
 
     @classmethod
-    def from_bt_headphones(cls, callback: Callable | None = None):
-        pyaud = pyaudio.PyAudio()
+    def from_bt_headphones(
+        cls,
+        callback: Callable | None = None,
+        format: AudioFormat = DEFAULT_FORMAT,
+        frames_per_buffer: int | None = None,
+        pyaud: pyaudio.PyAudio | None = None,
+    ):
+        """frames_per_buffer : of the stream (None : portaudio picks, see
+        buffer_size.py)
+        pyaud : opens the stream (None : a PyAudio of its own)"""
+        pyaud = pyaud or pyaudio.PyAudio()
         def_device_info = pyaud.get_default_output_device_info()
         print("using default audio device : ")
         rich.print(def_device_info)
 
-        channels = 1
-        sample_rate = SAMPLING_RATE
-        sample_format = pyaudio.paInt16
+        channels = format.channels
+        sample_rate = format.sample_rate
+        sample_format = format.pa_format
         stream = pyaud.open(
             rate=sample_rate,
             channels=channels,
             format=sample_format,
             output=True,
             start=False,
+            frames_per_buffer=frames_per_buffer or pyaudio.paFramesPerBufferUnspecified,
             stream_callback=callback,  # pyright: ignore
         )
 
@@ -10,7 +10,7 @@ from tqdm import tqdm
 from typer import Typer
 import time
 
-from pilooper.constants import SAMPLING_RATE
+from pilooper.audio_format import DEFAULT_FORMAT, AudioFormat
 from pilooper.mixer import Mixer
 
 app = Typer()
@@ -26,22 +26,31 @@ class Mic:
     sample_format: int
 
     @classmethod
-    def from_blueyeti(cls, callback: Callable | None = None):
-        pyaud = pyaudio.PyAudio()
+    def from_blueyeti(
+        cls,
+        callback: Callable | None = None,
+        format: AudioFormat = DEFAULT_FORMAT,
+        frames_per_buffer: int | None = None,
+        pyaud: pyaudio.PyAudio | None = None,
+    ):
+        """frames_per_buffer : of the stream (None : portaudio picks, see
+        buffer_size.py)
+        pyaud : opens the stream (None : a PyAudio of its own)"""
+        pyaud = pyaud or pyaudio.PyAudio()
         def_device_info = pyaud.get_default_input_device_info()
         print("using default audio device : ")
         rich.print(def_device_info)
 
-        channels = 1
-        sample_rate = SAMPLING_RATE
-        sample_format = pyaudio.paInt16
-        pyaud = pyaudio.PyAudio()
+        channels = format.channels
+        sample_rate = format.sample_rate
+        sample_format = format.pa_format
         stream = pyaud.open(
             rate=sample_rate,
             channels=channels,
             format=sample_format,
             input=True,
             start=False,
+            frames_per_buffer=frames_per_buffer or pyaudio.paFramesPerBufferUnspecified,
             stream_callback=callback,  # pyright: ignore
         )
 
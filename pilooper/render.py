@@ -0,0 +1,182 @@
+"""renders takes (wav files) through the mixer offline, as fast as it goes
+
+the takes go through the same callbacks and mix() as live audio (beat sync
+trimming, clip 50, metronome), one frame_count block at a time, so that mixes
+can be reproduced and the mixer benchmarked on big inputs without a sound card
+
+    python -m pilooper.render take_0.wav take_1.wav --bpm 100 --out mix.wav
+"""
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Optional
+import logging
+import math
+import time
+import wave
+import numpy as np
+from typer import Typer
+from pilooper.audio_format import DEFAULT_FORMAT, AudioFormat
+from pilooper.export import ExportFormat, write_file
+from pilooper.mixer import FADE_SECONDS, Mixer
+
+app = Typer()
+
+
+class RenderError(RuntimeError):
+    """the takes cant be rendered"""
+
+
+def wav_format(path: Path) -> AudioFormat:
+    """the format of a wav file"""
+    with wave.open(str(path), "rb") as wf:
+        try:
+            return AudioFormat(
+                sample_rate=wf.getframerate(),
+                channels=wf.getnchannels(),
+                bit_depth=wf.getsampwidth() * 8,
+            )
+        except ValueError as e:
+            raise RenderError(f"{path} : {e}") from None
+
+
+def read_wav(path: Path, format: AudioFormat = DEFAULT_FORMAT) -> np.ndarray:
+    """the (num_frames, channels) frames of a wav file in format"""
+    if wav_format(path) != format:
+        raise RenderError(f"{path} isnt {format}")
+    with wave.open(str(path), "rb") as wf:
+        return format.frames(wf.readframes(wf.getnframes()))
+
+
+@dataclass
+class RenderStats:
+    take_seconds: float = 0.0  # audio recorded
+    record_seconds: float = 0.0  # time spent in the mic callbacks
+    mix_seconds: list[float] = field(default_factory=list)
+    bounce_seconds: float = 0.0  # time spent in the speaker callbacks
+
+    @property
+    def realtime_factor(self) -> float:
+        """audio seconds processed per second"""
+        busy = self.record_seconds + sum(self.mix_seconds) + self.bounce_seconds
+        return self.take_seconds / busy if busy else math.inf
+
+
+def render(
+    takes: list[np.ndarray],
+    bpm: int | None = None,
+    clip_50: bool = False,
+    metronome_bpm: int | None = None,
+    latency: int = 0,
+    frame_count: int = 1024,
+    stream_overdubs: bool = False,
+    num_loops: int = 1,
+    format: AudioFormat = DEFAULT_FORMAT,
+    fade_seconds: float = FADE_SECONDS,
+) -> tuple[np.ndarray, RenderStats]:
+    """records and mixes takes (int16 frames, or samples if mono) one after
+    the other, returns num_loops passes of the resulting loop as played by the
+    speaker callback (with the metronome, if any) as (num_frames, channels).
+    fade_seconds : see Mixer.create_mixer()"""
+    if not takes:
+        raise RenderError("nothing to render")
+    if format.dtype != np.int16:
+        raise RenderError(f"{format.bit_depth} bit takes cant be recorded")
+    takes = [take.reshape(len(take), -1) for take in takes]
+    if any(take.shape[1] != format.channels for take in takes):
+        raise RenderError(f"takes arent {format.channels} channel")
+    longest = max(len(take) for take in takes)
+    mixer = Mixer.create_mixer(
+        track_length_seconds=math.ceil(longest / format.sample_rate),
+        log_level=logging.WARNING,
+        stream_overdubs=stream_overdubs,
+        format=format,
+        fade_seconds=fade_seconds,
+    )
+    mixer.set_bpm(bpm)
+    mixer.set_clip50(clip_50)
+    mixer.set_latency(latency)
+    if metronome_bpm is not None:
+        mixer.add_metronome(metronome_bpm)
+        mixer.start_metronome()
+
+    stats = RenderStats()
+    try:
+        for take in takes:
+            # note : the last (partial) block is dropped, like a stopped stream
+            num_blocks = len(take) // frame_count
+            start = time.perf_counter()
+            for block in range(num_blocks):
+                data = take[block * frame_count : (block + 1) * frame_count]
+                mixer.mic_callback(data.tobytes(), frame_count, {}, 0)
+                if stream_overdubs:
+                    mixer.stream_step()
+            stats.record_seconds += time.perf_counter() - start
+            stats.take_seconds += num_blocks * frame_count / format.sample_rate
+
+            start = time.perf_counter()
+            mixer.mix()
+            stats.mix_seconds.append(time.perf_counter() - start)
+    finally:
+        mixer.stop_stream()
+
+    loop_len = mixer.mixed_track.length
+    if loop_len == 0:
+        raise RenderError("the takes were clipped to nothing")
+    num_frames = loop_len * num_loops
+    out = np.empty(
+        (math.ceil(num_frames / frame_count) * frame_count, format.channels),
+        format.dtype,
+    )
+    start = time.perf_counter()
+    for pos in range(0, len(out), frame_count):
+        out_data, _ = mixer.speaker_callback(None, frame_count, {}, 0)
+        out[pos : pos + frame_count] = format.frames(out_data)
+    stats.bounce_seconds = time.perf_counter() - start
+    return out[:num_frames], stats
+
+
+@app.command()
+def bounce(
+    takes: List[Path],
+    out: Path = Path("mix.wav"),
+    bpm: Optional[int] = None,
+    clip_50: bool = False,
+    metronome_bpm: Optional[int] = None,
+    latency: int = 0,
+    frame_count: int = 1024,
+    stream_overdubs: bool = False,
+    loops: int = 1,
+):
+    """mixes takes in order and writes loops passes of the loop to out (.wav
+    or .flac), in the format of the first take"""
+    try:
+        export_format = ExportFormat(out.suffix.lstrip(".").lower())
+    except ValueError:
+        raise RenderError(f"cant write {out.suffix} files") from None
+    if not takes:
+        raise RenderError("nothing to render")
+    format = wav_format(takes[0])
+    mix, stats = render(
+        [read_wav(take, format) for take in takes],
+        bpm=bpm,
+        clip_50=clip_50,
+        metronome_bpm=metronome_bpm,
+        latency=latency,
+        frame_count=frame_count,
+        stream_overdubs=stream_overdubs,
+        num_loops=loops,
+        format=format,
+    )
+    write_file(out, mix, export_format, format.sample_rate)
+
+    mix_ms = ", ".join(f"{seconds * 1e3:.1f}" for seconds in stats.mix_seconds)
+    print(
+        f"{len(takes)} takes ({stats.take_seconds:.1f}s) -> {out}"
+        f" ({len(mix) / format.sample_rate:.1f}s)"
+        f" | mixes {mix_ms} ms | x{stats.realtime_factor:.0f} real time"
+    )
+
+
+if __name__ == "__main__":
+    app()
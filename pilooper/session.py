@@ -0,0 +1,222 @@
+"""saving / loading the state of a looper
+
+a session is a directory with a session.json (settings and layer metadata)
+and the audio as raw (headerless) sample files, so that loading maps them
+straight into the track buffers instead of reading and decoding them :
+
+    session.json
+    loop.raw      float32, the mixed loop (the mix bus, see Mixer)
+    layer_<i>.raw int16, one per layer (mixers with layers only)
+    layers.raw    float32, the running sum of the layers
+
+samples are interleaved frames of the mixer's format (num_samples in the
+json counts frames). loop.raw and layers.raw are padded (sparse) to the
+capacity of the tracks
+"""
+
+from __future__ import annotations
+from pathlib import Path
+import json
+import mmap
+import os
+import numpy as np
+from pilooper.audio_format import AudioFormat
+from pilooper.mixer import Layer, Mixer, TileMode
+from pilooper.track import map_file
+
+SESSION_DIR = Path("~/.local/share/pilooper/session").expanduser()
+SESSION_FILE = "session.json"
+# 2 : the loop is float32 (it was int16 in version 1)
+FORMAT_VERSION = 2
+
+
+class SessionError(RuntimeError):
+    """a session cant be loaded"""
+
+
+def _write(path: Path, data: np.ndarray, num_bytes: int = 0):
+    """writes data to path through a temporary file : a loaded session maps
+    its files, which mustnt change under it. the file is padded (sparse, with
+    zeros) to num_bytes, so that it can be mapped as a whole track"""
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        f.write(memoryview(data).cast("B"))
+        if num_bytes > data.nbytes:
+            f.truncate(num_bytes)
+    os.replace(tmp, path)
+
+
+def save_session(mixer: Mixer, session_dir: Path = SESSION_DIR):
+    """saves the loop, the layers and the settings of mixer to session_dir
+
+    note : holds the track mutexes (so the take / loop cant change), the audio
+    callbacks dont wait on them
+    """
+    session_dir.mkdir(parents=True, exist_ok=True)
+    with mixer.mic_track.track.mutex, mixer.speaker_track.track.mutex:
+        loop_len = mixer.mixed_track.length
+        np_mixed = mixer.mixed_track.frames()
+        _write(session_dir / "loop.raw", np_mixed[:loop_len], np_mixed.nbytes)
+
+        layers = None
+        if mixer.layers is not None:
+            stack = mixer.layers
+            _write(
+                session_dir / "layers.raw", stack.sum[: stack.length], stack.sum.nbytes
+            )
+            layers = {"length": stack.length, "layers": []}
+            for idx, layer in enumerate(stack.layers):
+                name = f"layer_{idx}.raw"
+                _write(session_dir / name, layer.data)
+                layers["layers"].append(
+                    {
+                        "file": name,
+                        "num_samples": len(layer.data),
+                        "gain": layer.gain,
+                        "muted": layer.muted,
+                        "length_before": layer.length_before,
+                        "length_after": layer.length_after,
+                        "offset": layer.offset,
+                        "seam": None if layer.seam is None else layer.seam.tolist(),
+                    }
+                )
+
+        metronome = mixer.metronome
+        session = {
+            "version": FORMAT_VERSION,
+            "sample_rate": mixer.format.sample_rate,
+            "channels": mixer.format.channels,
+            "loop": {"file": "loop.raw", "num_samples": loop_len},
+            "layers": layers,
+            "bpm": mixer.bpm,
+            "clip_50": mixer.clip_50,
+            "tile_mode": mixer.tile_mode.name,
+            "master_gain": mixer.speaker_track.gain.target,
+            "metronome": (
+                {"bpm": metronome.bpm, "enabled": metronome.enabled}
+                if metronome is not None
+                else None
+            ),
+        }
+        tmp = session_dir / f"{SESSION_FILE}.tmp"
+        tmp.write_text(json.dumps(session, indent=2))
+        os.replace(tmp, session_dir / SESSION_FILE)
+
+        # files of an earlier save (with more layers) that session.json no
+        # longer refers to. note : a loaded session keeps its mappings of them
+        written = set() if layers is None else {"layers.raw"}
+        if layers is not None:
+            written.update(layer["file"] for layer in layers["layers"])
+        for path in session_dir.glob("layer*.raw"):
+            if path.name not in written:
+                path.unlink()
+
+
+def _map_layer(path: Path, num_frames: int, format: AudioFormat) -> np.ndarray:
+    # note : layers are never written to, a read-only mapping is enough
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), format.to_bytes(num_frames), prot=mmap.PROT_READ)
+    return format.frames(data)
+
+
+def load_session(
+    mixer: Mixer, session_dir: Path = SESSION_DIR, map_loop: bool = True
+) -> dict:
+    """replaces the loop, layers and settings of mixer with the session in
+    session_dir, returns the session metadata (see save_session())
+
+    the audio isnt read here : the files are mapped (copy on write) as the
+    track buffers, pages are read in as the loop plays / is mixed
+    map_loop : False reads the loop into the mixed track buffer instead, for
+    tracks that have to stay in their (shared) memory
+    """
+    path = session_dir / SESSION_FILE
+    if not path.exists():
+        raise SessionError(f"no session in {session_dir}")
+    session = json.loads(path.read_text())
+    if session["version"] not in (1, FORMAT_VERSION):
+        raise SessionError(f"unsupported session version {session['version']}")
+    format = mixer.format
+    # note : sessions saved before the format was configurable are mono
+    if (session["sample_rate"], session.get("channels", 1)) != (
+        format.sample_rate,
+        format.channels,
+    ):
+        raise SessionError(
+            f"session is at {session['sample_rate']}Hz / {session.get('channels', 1)}"
+            f" channels, the looper at {format.sample_rate}Hz / {format.channels}"
+        )
+    capacity = len(mixer.mixed_track.data)
+    loop_len = session["loop"]["num_samples"]
+    if loop_len > mixer.mixed_track.capacity:
+        raise SessionError(
+            f"the loop ({loop_len} frames) doesnt fit the tracks"
+            f" ({mixer.mixed_track.capacity})"
+        )
+
+    with mixer.mic_track.track.mutex, mixer.speaker_track.track.mutex:
+        mixer._reset_take()
+        loop_path = session_dir / session["loop"]["file"]
+        # note : the speaker keeps playing the current loop until its updated
+        mixer._unshare_mixed()
+        if session["version"] == 1 or not map_loop:
+            # note : an int16 loop is converted, not mapped
+            dtype = format.dtype if session["version"] == 1 else format.bus.dtype
+            loop = np.fromfile(loop_path, dtype=dtype, count=loop_len * format.channels)
+            loop = loop.reshape(-1, format.channels)
+            mixer._preserve_exports(mixer.mixed_track.data)
+            mixer.mixed_track.frames()[:loop_len] = loop
+        else:
+            mixer.mixed_track.data = map_file(loop_path, capacity)
+        mixer.mixed_track.length = loop_len
+
+        stack, layers = mixer.layers, session["layers"]
+        if stack is not None:
+            stack.reset()
+            if layers is None:
+                # the loop becomes the (frozen) base of the layers
+                np_mixed = mixer.mixed_track.frames()
+                stack.sum[:loop_len] = np_mixed[:loop_len]
+                stack.length = loop_len
+            else:
+                sum_data = map_file(session_dir / "layers.raw", stack.sum.nbytes)
+                stack.sum = np.frombuffer(sum_data, dtype=np.float32).reshape(
+                    stack.sum.shape
+                )
+                stack.length = layers["length"]
+                stack.layers = [
+                    Layer(
+                        data=_map_layer(
+                            session_dir / layer["file"], layer["num_samples"], format
+                        ),
+                        gain=layer["gain"],
+                        muted=layer["muted"],
+                        length_before=layer["length_before"],
+                        length_after=layer["length_after"],
+                        offset=layer["offset"],
+                        seam=(
+                            np.array(layer["seam"], dtype=np.float32)
+                            if layer.get("seam") is not None
+                            else None
+                        ),
+                    )
+                    for layer in layers["layers"]
+                ]
+                stack._freeze()
+
+        mixer.bpm = session["bpm"]
+        mixer.clip_50 = session["clip_50"]
+        mixer.tile_mode = TileMode[session["tile_mode"]]
+        mixer.set_master_gain(session.get("master_gain", 1.0))
+        mixer._update_speaker()
+
+    metronome = session["metronome"]
+    if metronome is None:
+        mixer.stop_metronome()
+    else:
+        mixer.add_metronome(metronome["bpm"])
+        if metronome["enabled"]:
+            mixer.start_metronome()
+        else:
+            mixer.stop_metronome()
+    return session
@@ -1,109 +1,498 @@
-from dataclasses import dataclass
+from __future__ import annotations
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from pathlib import Path
 from threading import Lock
-import pilooper.constants as constants
+import mmap
+import os
+import tempfile
+import time
+import numpy as np
+from pilooper.audio_format import DEFAULT_FORMAT, AudioFormat
+from pilooper.dsp import GainRamp, Limiter
+from pilooper.onset import Trim
+
+# track storage : a memory map (see allocate()), or a plain bytearray
+Buffer = bytearray | mmap.mmap
+
+# linux >= 5.14, not exported by the mmap module
+MADV_POPULATE_WRITE = 23
+# changes of the master gain (see SpeakerTrack.gain) are ramped over this many
+# frames, about 20ms at 44.1kHz
+MASTER_RAMP_FRAMES = 1024
+# posix shared memory (what multiprocessing.shared_memory maps on linux)
+SHM_DIR = Path("/dev/shm")
+
+
+def allocate(num_bytes: int, storage_dir: Path | None = None) -> Buffer:
+    """allocates num_bytes (zeroed) of storage for a track
+
+    the storage is a memory map, either anonymous or (with a storage_dir) over a
+    sparse file in that directory (say /dev/shm, or a disk for very long tracks).
+    either way pages are only backed by memory once theyre written to : startup
+    doesnt have to touch the whole capacity, and memory grows with the length of
+    the loops that are actually recorded. a disk backed track can also be paged
+    out. see prefault() for keeping page faults out of the audio callbacks
+    """
+    if num_bytes == 0:
+        return bytearray(0)
+    if storage_dir is None:
+        return mmap.mmap(-1, num_bytes)
+    storage_dir.mkdir(parents=True, exist_ok=True)
+    # note : the file is deleted on close, the mapping keeps the storage alive
+    with tempfile.TemporaryFile(dir=storage_dir, prefix="track_") as f:
+        f.truncate(num_bytes)
+        return mmap.mmap(f.fileno(), num_bytes)
+
+
+@dataclass
+class SharedStorage:
+    """track storage that other processes can attach to (see attach())
+
+    the same lazily backed memory maps as allocate(storage_dir=...), but over
+    named files in shared memory, so that the ui process can read the tracks
+    the engine process records / plays without copies. buffers are looked up
+    by identity, since tracks swap buffers around (see path_of())
+    """
+
+    prefix: str
+    storage_dir: Path = SHM_DIR
+    paths: dict[int, Path] = field(default_factory=dict)
+    # keeps the buffers (and so their ids) alive
+    buffers: list[Buffer] = field(repr=False, default_factory=list)
+
+    @classmethod
+    def create(cls, storage_dir: Path = SHM_DIR) -> SharedStorage:
+        return cls(prefix=f"pilooper_{os.getpid()}", storage_dir=storage_dir)
+
+    def allocate(self, num_bytes: int) -> Buffer:
+        if num_bytes == 0:
+            return bytearray(0)
+        path = self.storage_dir / f"{self.prefix}_{len(self.buffers)}"
+        with open(path, "x+b") as f:
+            f.truncate(num_bytes)
+            data = mmap.mmap(f.fileno(), num_bytes)
+        self.paths[id(data)] = path
+        self.buffers.append(data)
+        return data
+
+    def path_of(self, data: Buffer) -> Path | None:
+        return self.paths.get(id(data))
+
+    def unlink(self):
+        """removes the files, mappings stay valid until theyre closed"""
+        for path in self.paths.values():
+            path.unlink(missing_ok=True)
+
+
+def attach(path: Path) -> mmap.mmap:
+    """read-only mapping of a SharedStorage buffer"""
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+
+
+def map_file(path: Path, num_bytes: int) -> mmap.mmap:
+    """private (copy on write) mapping of num_bytes of the file at path
+
+    pages are read from the file when theyre first touched and copied when
+    theyre first written to, the file itself never changes. a shorter file is
+    extended (sparse, with zeros) to num_bytes first
+    """
+    with open(path, "r+b") as f:
+        if os.fstat(f.fileno()).st_size < num_bytes:
+            f.truncate(num_bytes)
+        return mmap.mmap(f.fileno(), num_bytes, access=mmap.ACCESS_COPY)
+
+
+def prefault(data: Buffer, start: int, end: int):
+    """backs data[start:end] with memory, without changing its contents
+
+    writing to a page of a memory map for the first time page faults (the
+    kernel allocates and zeroes it), which shouldnt happen in an audio
+    callback. this is a no-op for bytearrays (always backed) and on kernels
+    that dont support MADV_POPULATE_WRITE
+    """
+    if not isinstance(data, mmap.mmap):
+        return
+    start -= start % mmap.PAGESIZE
+    end = min(end, len(data))
+    if end <= start:
+        return
+    try:
+        data.madvise(MADV_POPULATE_WRITE, start, end - start)
+    except OSError:
+        pass
 
 
 @dataclass
 class Track:
-    data: bytearray
+    data: Buffer
     mutex: Lock
     # index to start reading / writing (depending on speaker / mic)
     rw_idx: int = 0
-    # length of data thats filled (in bytes)
+    # length of data thats filled (in bytes, see length for frames)
     length_bytes: int = 0
+    format: AudioFormat = DEFAULT_FORMAT
+
+    @property
+    def length(self) -> int:
+        """length in frames"""
+        return self.format.to_frames(self.length_bytes)
+
+    @length.setter
+    def length(self, num_frames: int):
+        self.length_bytes = self.format.to_bytes(num_frames)
+
+    @property
+    def position(self) -> int:
+        """rw_idx in frames"""
+        return self.format.to_frames(self.rw_idx)
+
+    @property
+    def capacity(self) -> int:
+        """capacity in frames"""
+        return self.format.to_frames(len(self.data))
+
+    def frames(self) -> np.ndarray:
+        """(capacity, channels) view of data"""
+        return self.format.frames(self.data)
 
     def reset(self):
         self.rw_idx = 0
         self.length_bytes = 0
 
 
+@dataclass
+class RingBuffer:
+    """lock-free single-producer / single-consumer ring buffer
+
+    the producer only ever moves write_idx and the consumer only ever moves
+    read_idx. both are monotonically increasing byte counts (wrapped into data
+    on access) and storing an int attribute is atomic under the gil, so
+    neither side has to take a lock. data is always copied in / out before the
+    index that publishes it is moved.
+    """
+
+    data: Buffer
+    read_idx: int = 0
+    write_idx: int = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self.data)
+
+    def readable(self) -> int:
+        return self.write_idx - self.read_idx
+
+    def writable(self) -> int:
+        return self.capacity - self.readable()
+
+    def write(self, in_data: bytes | memoryview) -> int:
+        """producer : writes as much of in_data as fits, returns #bytes written"""
+        num_bytes = min(len(in_data), self.writable())
+        start = self.write_idx % self.capacity
+        first = min(num_bytes, self.capacity - start)
+        with memoryview(in_data) as src:
+            self.data[start : start + first] = src[:first]
+            self.data[: num_bytes - first] = src[first:num_bytes]
+        self.write_idx += num_bytes
+        return num_bytes
+
+    def read_into(self, out: bytearray | memoryview) -> int:
+        """consumer : fills out with as much data as is available, returns #bytes read"""
+        num_bytes = min(len(out), self.readable())
+        start = self.read_idx % self.capacity
+        first = min(num_bytes, self.capacity - start)
+        with memoryview(self.data) as src, memoryview(out) as dst:
+            dst[:first] = src[start : start + first]
+            dst[first:num_bytes] = src[: num_bytes - first]
+        self.read_idx += num_bytes
+        return num_bytes
+
+    def reset(self):
+        """drops all data, only safe while the producer is stopped"""
+        self.read_idx = 0
+        self.write_idx = 0
+
+
 @dataclass
 class SpeakerTrack:
-    track: Track
+    """plays the loop (float32 mix bus frames, see AudioFormat.bus) as format
 
-    def next(self, frame_count: int) -> bytes:
-        if not self.track.mutex.acquire():
-            print("speaker_callback() : speaker blocked, returning...")
-            return bytes(0)
+    every callback the loop is copied into a block of the bus, the overlay is
+    added, the master gain applied and the block is limited / rounded to the
+    output (see dsp.Limiter) :
+    the only int16 conversion of the loop is per block, never of the whole loop
+    """
 
-        # no data yet, play nothing
-        if self.track.length_bytes == 0:
-            self.track.mutex.release()
-            return bytes(frame_count * 2)
+    # front buffer : the loop thats currently playing
+    track: Track
+    # back buffer : the next loop is rendered into this one by the mixer while
+    # the front is playing, and swapped in by the speaker callback
+    back: Track | None = field(default=None, kw_only=True)
+    # output format (the tracks are in format.bus)
+    format: AudioFormat = field(default=DEFAULT_FORMAT, kw_only=True)
+    # rendered on top of the loop (say a metronome) : called with a part of the
+    # bus block (float32 frames) and the position of its first sample in the
+    # loop. without a loop the position counts up from when the speaker started
+    overlay: Callable[[np.ndarray, int], None] | None = field(
+        default=None, kw_only=True
+    )
+    free_position: int = field(init=False, default=0)
+    # output buffer handed to portaudio and the bus block its rendered from,
+    # reused across callbacks so that the callback doesnt allocate (only
+    # re-allocated if the period changes)
+    out: bytearray = field(init=False, repr=False, default_factory=bytearray)
+    out_view: memoryview = field(init=False, repr=False, default=memoryview(b""))
+    np_out: np.ndarray = field(
+        init=False, repr=False, default_factory=lambda: np.zeros((0, 1), np.int16)
+    )
+    block: np.ndarray = field(
+        init=False, repr=False, default_factory=lambda: np.zeros((0, 1), np.float32)
+    )
+    block_bytes: memoryview = field(init=False, repr=False, default=memoryview(b""))
+    limiter: Limiter = field(init=False, repr=False, default_factory=Limiter)
+    # master gain, applied to the block (loop, overlay and monitored input)
+    # before the limiter
+    gain: GainRamp = field(
+        init=False, default_factory=lambda: GainRamp.create(MASTER_RAMP_FRAMES)
+    )
+    # gain of the input thats mixed into the block (see next()), 0 : off
+    monitor: GainRamp = field(
+        init=False,
+        default_factory=lambda: GainRamp.create(MASTER_RAMP_FRAMES, gain=0.0),
+    )
+    monitor_block: np.ndarray = field(
+        init=False, repr=False, default_factory=lambda: np.zeros((0, 1), np.float32)
+    )
+    # front / back swap handshake
+    swap_lock: Lock = field(init=False, repr=False, default_factory=Lock)
+    pending: bool = field(init=False, default=False)
+    pending_at_boundary: bool = field(init=False, default=False)
+    # loop position (in frames) of the first frame of the last next(),
+    # free_position while theres no loop
+    block_position: int = field(init=False, default=0)
+    # time spent on / number of busy swap_lock acquires during the last next()
+    lock_wait_ns: int = field(init=False, default=0)
+    lock_busy: int = field(init=False, default=0)
 
-        if self.track.length_bytes < frame_count * 2:
-            print(
-                f"warning : not enough speaker data, {len(self.track.data)/2}/{frame_count} speaker stream may stop!"
+    def _out_view(self, frame_count: int) -> memoryview:
+        if len(self.block) != frame_count:
+            self.out = bytearray(self.format.to_bytes(frame_count))
+            # note : portaudio only accepts read-only buffers
+            self.out_view = memoryview(self.out).toreadonly()
+            self.np_out = self.format.frames(self.out)
+            self.block = np.zeros(
+                (frame_count, self.format.channels), self.format.bus.dtype
             )
+            self.block_bytes = memoryview(self.block).cast("B")
+            self.monitor_block = np.zeros_like(self.block)
+        return self.out_view
 
-        num_bytes = min(frame_count * 2, self.track.length_bytes)
-        start = self.track.rw_idx
-        end = (self.track.rw_idx + num_bytes) % (self.track.length_bytes + 1)
-        if end < start:
-            end += 1
-            mem = memoryview(
-                self.track.data[start : self.track.length_bytes] + self.track.data[:end]
-            )
+    def swap(self, at_boundary: bool = False) -> bool:
+        """swaps in a pending back buffer, returns True if it did
+
+        called from the speaker callback, so it never waits on swap_lock : if
+        the mixer is holding it we just try again on the next call
+        """
+        if not self.pending:
+            return False
+        if self.pending_at_boundary and not at_boundary and self.track.length_bytes:
+            return False
+        start_ns = time.perf_counter_ns()
+        acquired = self.swap_lock.acquire(blocking=False)
+        self.lock_wait_ns += time.perf_counter_ns() - start_ns
+        if not acquired:
+            self.lock_busy += 1
+            return False
+
+        swapped = self.pending
+        if swapped:
+            assert self.back is not None
+            front, back = self.track, self.back
+            if at_boundary or back.length_bytes == 0:
+                back.rw_idx = 0
+            else:
+                # continue playing from the current position
+                back.rw_idx = front.rw_idx % back.length_bytes
+            self.track, self.back = back, front
+            self.pending = False
+        self.swap_lock.release()
+        return swapped
+
+    def next(self, frame_count: int, in_data: bytes | None = None) -> memoryview:
+        """returns the next frame_count frames of the loop
+
+        in_data : input frames (format) recorded in the same callback, mixed in
+        at the monitor gain. the input is played a callback period after it was
+        recorded, theres no buffering on top of portaudios
+
+        the returned view points into self.out and is overwritten by the next
+        call, callers have to consume it before asking for more data
+        """
+        out_view = self._out_view(frame_count)
+
+        # note : no lock on the front buffer, the mixer only ever writes to the
+        # back buffer
+        self.lock_wait_ns = self.lock_busy = 0
+        self.swap()
+        track = self.track
+        self.block_position = (
+            track.position if track.length_bytes else self.free_position
+        )
+
+        if track.length_bytes == 0:
+            # no data yet, play nothing
+            self.block.fill(0)
+            self._overlay(0, frame_count, None)
         else:
-            mem = memoryview(self.track.data[start:end])
-        assert (
-            len(mem) == num_bytes
-        ), f"didnt pick correct number of bytes : start : {start}, end : {end}, track_length : {self.track.length_bytes}, len(mem) : {len(mem)}"
+            self._copy_loop(track, frame_count)
+        if in_data is not None:
+            self._monitor(in_data)
+        self.gain.apply(self.block)
+        self.limiter.process(self.np_out, self.block)
+        return out_view
+
+    def _copy_loop(self, track: Track, frame_count: int):
+        """copies the loop into the block (and renders the overlay on top),
+        wrapping around the end of the loop as many times as needed"""
+        frame_bytes = track.format.frame_bytes
+        num_bytes = frame_count * frame_bytes
+        block = self.block_bytes
+        data = memoryview(track.data)
+        pos = track.rw_idx
+        filled = 0
+        while filled < num_bytes:
+            n = min(num_bytes - filled, track.length_bytes - pos)
+            block[filled : filled + n] = data[pos : pos + n]
+            self._overlay(
+                filled // frame_bytes, (filled + n) // frame_bytes, pos // frame_bytes
+            )
+            filled += n
+            pos += n
+            if pos == track.length_bytes:
+                pos = 0
+                if self.swap(at_boundary=True):
+                    track = self.track
+                    data = memoryview(track.data)
+                    if track.length_bytes == 0:
+                        self.block[filled // frame_bytes :] = 0
+                        self._overlay(filled // frame_bytes, frame_count, None)
+                        break
+        track.rw_idx = pos
+
+    def _monitor(self, in_data: bytes):
+        """adds the input to the block at the monitor gain"""
+        monitor = self.monitor
+        if monitor.gain == 0.0 and monitor.target == 0.0:
+            return
+        np.copyto(self.monitor_block, self.format.frames(in_data))
+        monitor.apply(self.monitor_block)
+        self.block += self.monitor_block
+
+    def _overlay(self, start: int, end: int, position: int | None):
+        """renders the overlay into block[start:end], position : in the loop
+        (None : no loop is playing)"""
+        if position is None:
+            position = self.free_position
+            self.free_position += end - start
+        if self.overlay is not None:
+            self.overlay(self.block[start:end], position)
 
-        self.track.rw_idx = end % self.track.length_bytes
-        self.track.mutex.release()
-        return bytes(mem)
+    def back_buffer(self) -> Buffer:
+        """returns the back buffer to render the next loop into
+
+        cancels a pending swap, so that the speaker doesnt pick up a half
+        rendered loop
+        """
+        assert self.back is not None, "speaker track isnt double buffered"
+        with self.swap_lock:
+            self.pending = False
+        return self.back.data
+
+    def publish(self, length_bytes: int, at_boundary: bool = False):
+        """queues the back buffer to be swapped in by the speaker callback
+
+        the swap happens either on the next callback (continuing from the
+        current play position), or at the end of the current loop if
+        at_boundary is set. this is O(1), independent of the loop length
+        """
+        assert self.back is not None, "speaker track isnt double buffered"
+        with self.swap_lock:
+            self.back.length_bytes = length_bytes
+            self.pending_at_boundary = at_boundary
+            self.pending = True
 
     def reset_playback(self):
         self.track.rw_idx = 0
 
     def reset(self):
-        self.track.reset()
+        self.back_buffer()
+        self.publish(0)
 
 
 @dataclass
 class MicTrack:
     track: Track
     is_full: bool = False
+    # loop position (in frames) that was playing when the take started, the
+    # take is mixed in at this position
+    loop_offset: int = 0
+    # track.data[:reserved_idx] is backed by memory (see reserve())
+    reserved_idx: int = field(init=False, default=0)
+
+    def __post_init__(self):
+        # the mic callback is the producer and the mixer the consumer of the
+        # recorded take. the consumer only releases the take (reset()) while
+        # the mic is stopped, so a take never wraps and track.data[:length_bytes]
+        # always holds it in order
+        self.ring = RingBuffer(data=self.track.data)
 
     def save(self, in_data: bytes, frame_count: int) -> bool:
         if self.is_full:
             return False
-        if not self.track.mutex.acquire():
-            print("mic_callback() : mic blocked, returning...")
-            return False
 
-        num_bytes = frame_count * 2
+        num_bytes = self.track.format.to_bytes(frame_count)
         assert (
             len(in_data) == num_bytes
-        ), f"not using int16? len(in_data): {len(in_data)}, frame_count: {frame_count}"
+        ), f"not using {self.track.format}? len(in_data): {len(in_data)}, frame_count: {frame_count}"
 
-        start = self.track.rw_idx
-        end = start + num_bytes
-        self.is_full = end >= len(self.track.data)
-        if self.is_full:
-            end = len(self.track.data)
+        self.ring.write(in_data)
+        self.is_full = self.ring.writable() == 0
 
-        num_bytes = end - start
-        self.track.data[start:end] = in_data[:num_bytes]
-        self.track.rw_idx = end
-        self.track.length_bytes = end
-        self.track.mutex.release()
+        # publish the new length to the mixer
+        self.track.rw_idx = self.ring.write_idx
+        self.track.length_bytes = self.ring.write_idx
 
         return True
 
     def reset(self):
+        self.ring.reset()
         self.track.reset()
         self.is_full = False
+        self.loop_offset = 0
+
+    def reserve(self, num_bytes: int):
+        """backs the next num_bytes of the take with memory, so that the mic
+        callback doesnt page fault. reserved memory is kept (and reused) across
+        takes. call this off the audio thread
+        """
+        end = min(self.track.length_bytes + num_bytes, len(self.track.data))
+        if end > self.reserved_idx:
+            prefault(self.track.data, self.reserved_idx, end)
+            self.reserved_idx = end
 
-    def clip_to_beat_boundary(self, bpm: int):
-        samples_per_minute = constants.SAMPLING_RATE * 60
-        samples_per_beat = samples_per_minute // bpm
-        bytes_per_beat = samples_per_beat * 2
-        self.track.length_bytes = (
-            self.track.length_bytes // bytes_per_beat
-        ) * bytes_per_beat
+    def trim(self, trim: Trim):
+        """keeps take[trim.start : trim.end] with the trim.mute ranges silenced
+        (see onset.trim_take()), the take moves to the start of the track"""
+        np_take = self.track.frames()
+        for start, end in trim.mute:
+            np_take[start:end] = 0
+        if trim.start:
+            # note : the ranges overlap, numpy copies through a temporary
+            np_take[: trim.end - trim.start] = np_take[trim.start : trim.end]
+            self.loop_offset += trim.start
+        self.track.length = trim.end - trim.start
 
     def clip_50(self):
-        num_samples = self.track.length_bytes // 2
-        self.track.length_bytes = (num_samples // 2) * 2
+        self.track.length = self.track.length // 2
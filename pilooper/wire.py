@@ -1,4 +1,5 @@
 import wave
+from collections.abc import Callable
 from dataclasses import dataclass
 from pathlib import Path
 
@@ -7,24 +8,44 @@ import rich
 from tqdm import tqdm
 from typer import Typer
 
+from pilooper.audio_format import DEFAULT_FORMAT, AudioFormat
+
 app = Typer()
 
 
 @dataclass
 class Wire:
+    """a full duplex (mic in, speaker out) stream
+
+    with a callback (say Mixer.duplex_callback), input and output are handled
+    in the same callback, on one clock : thats also where the input is
+    monitored (see Mixer.set_monitor_gain()). without one the stream is
+    blocking, see go() for a plain passthrough
+    """
+
     sample_rate: int
     channels: int
     stream: pyaudio.Stream
     sample_format: int
 
     @classmethod
-    def from_defaults(cls):
-        pyaud = pyaudio.PyAudio()
+    def from_defaults(
+        cls,
+        callback: Callable | None = None,
+        format: AudioFormat = DEFAULT_FORMAT,
+        frames_per_buffer: int | None = None,
+        pyaud: pyaudio.PyAudio | None = None,
+    ):
+        """frames_per_buffer : of the stream (None : portaudio picks, see
+        buffer_size.py)
+        pyaud : opens the stream (None : a PyAudio of its own)"""
+        pyaud = pyaud or pyaudio.PyAudio()
 
-        channels = 1
+        channels = format.channels
         # sample_rate = int(def_device_info['defaultSampleRate']) # pyright: ignore
-        sample_rate = 44_100  # reducing the sampling rate because of input overflows!
-        sample_format = pyaudio.paInt16
+        # note : 44.1kHz by default, higher rates gave input overflows
+        sample_rate = format.sample_rate
+        sample_format = format.pa_format
         stream = pyaud.open(
             rate=sample_rate,
             channels=channels,
@@ -32,6 +53,8 @@ class Wire:
             input=True,
             output=True,
             start=False,
+            frames_per_buffer=frames_per_buffer or pyaudio.paFramesPerBufferUnspecified,
+            stream_callback=callback,  # pyright: ignore
         )
 
         return cls(
@@ -41,6 +64,12 @@ class Wire:
             stream=stream,
         )  # pyright: ignore
 
+    def start(self):
+        self.stream.start_stream()
+
+    def stop(self):
+        self.stream.stop_stream()
+
     def go(self, record_seconds: int):
         self.stream.start_stream()
         print("* recording")
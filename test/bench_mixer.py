@@ -0,0 +1,220 @@
+"""headless benchmarks for the mixer / track hot paths
+
+drives the mic / speaker callbacks with synthetic audio (no audio device needed),
+sweeping loop length, callback frame size and the number of overdubs.
+
+    python -m test.bench_mixer run --out bench.json
+    python -m test.bench_mixer compare old.json new.json
+"""
+
+import json
+import logging
+import platform
+import resource
+import subprocess
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+import numpy as np
+from typer import Typer
+
+from pilooper.constants import SAMPLING_RATE
+from pilooper.mixer import Mixer
+
+app = Typer()
+
+DEFAULT_LOOP_SECONDS = [1, 10, 60, 300, 1800]
+DEFAULT_FRAME_SIZES = [256, 1024]
+DEFAULT_OVERDUBS = [1, 4]
+
+
+def _reset_peak_rss():
+    """resets the high water mark of the rss (linux only), so the next read of
+    the peak rss is the peak since this call"""
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_kb() -> int:
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    except OSError:
+        pass
+    # process lifetime peak, in kb on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _latency_stats(durations_ns: np.ndarray) -> dict:
+    durations_us = durations_ns / 1_000
+    return {
+        "count": len(durations_us),
+        "p50_us": float(np.percentile(durations_us, 50)),
+        "p99_us": float(np.percentile(durations_us, 99)),
+        "max_us": float(durations_us.max()),
+    }
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _config_key(result: dict) -> tuple:
+    return (
+        result["loop_seconds"],
+        result["frame_size"],
+        result["overdubs"],
+        result["stream_overdubs"],
+    )
+
+
+def bench_config(
+    loop_seconds: int, frame_size: int, overdubs: int, stream_overdubs: bool
+) -> dict:
+    """records `overdubs` loop-length takes through mic_callback while the speaker
+    callback plays, mixing after every take. every callback is timed"""
+    mixer = Mixer.create_mixer(
+        track_length_seconds=loop_seconds,
+        log_level=logging.WARNING,
+        stream_overdubs=stream_overdubs,
+    )
+
+    # one block of synthetic audio is reused for every callback, generating
+    # half an hour of random audio would dominate the benchmark
+    mic_block = np.random.randint(
+        low=np.iinfo(np.int16).min // 4,
+        high=np.iinfo(np.int16).max // 4,
+        dtype=np.int16,
+        size=frame_size,
+    ).tobytes()
+
+    num_callbacks = loop_seconds * SAMPLING_RATE // frame_size
+    mic_ns = np.empty(num_callbacks * overdubs, dtype=np.int64)
+    speaker_ns = np.empty(num_callbacks * overdubs, dtype=np.int64)
+    mixes = []
+
+    try:
+        for take in range(overdubs):
+            for i in range(take * num_callbacks, (take + 1) * num_callbacks):
+                start = time.perf_counter_ns()
+                mixer.mic_callback(mic_block, frame_size, {}, None)
+                mid = time.perf_counter_ns()
+                mixer.speaker_callback(None, frame_size, {}, None)
+                mic_ns[i] = mid - start
+                speaker_ns[i] = time.perf_counter_ns() - mid
+
+            _reset_peak_rss()
+            start = time.perf_counter_ns()
+            mixer.mix()
+            mix_ms = (time.perf_counter_ns() - start) / 1e6
+            mixes.append({"duration_ms": mix_ms, "peak_rss_kb": _peak_rss_kb()})
+
+        # mix() already updates the speaker, time the copy on its own as well
+        with mixer.mic_track.track.mutex, mixer.speaker_track.track.mutex:
+            start = time.perf_counter_ns()
+            mixer._update_speaker()
+            update_speaker_ms = (time.perf_counter_ns() - start) / 1e6
+    finally:
+        mixer.stop_stream()
+
+    return {
+        "loop_seconds": loop_seconds,
+        "frame_size": frame_size,
+        "overdubs": overdubs,
+        "stream_overdubs": stream_overdubs,
+        "deadline_us": frame_size / SAMPLING_RATE * 1e6,
+        "mic_callback": _latency_stats(mic_ns),
+        "speaker_callback": _latency_stats(speaker_ns),
+        "mix": mixes,
+        "update_speaker_ms": update_speaker_ms,
+    }
+
+
+def bench_sweep(
+    loop_seconds: list[int],
+    frame_sizes: list[int],
+    overdubs: list[int],
+    stream_overdubs: bool,
+) -> Iterator[dict]:
+    for loop_s in loop_seconds:
+        for frame_size in frame_sizes:
+            for num_overdubs in overdubs:
+                yield bench_config(loop_s, frame_size, num_overdubs, stream_overdubs)
+
+
+@app.command()
+def run(
+    loop_seconds: list[int] = DEFAULT_LOOP_SECONDS,
+    frame_size: list[int] = DEFAULT_FRAME_SIZES,
+    overdubs: list[int] = DEFAULT_OVERDUBS,
+    stream_overdubs: bool = False,
+    out: Optional[Path] = None,
+):
+    """runs the sweep and prints a summary, results are saved as json to `out`"""
+    results = []
+    for result in bench_sweep(loop_seconds, frame_size, overdubs, stream_overdubs):
+        results.append(result)
+        mic, speaker = result["mic_callback"], result["speaker_callback"]
+        max_mix_ms = max(mix["duration_ms"] for mix in result["mix"])
+        peak_rss_mb = max(mix["peak_rss_kb"] for mix in result["mix"]) / 1024
+        print(
+            f"loop {result['loop_seconds']:>5}s | frames {result['frame_size']:>5}"
+            f" | overdubs {result['overdubs']:>2}"
+            f" | mic p99 {mic['p99_us']:8.1f}us max {mic['max_us']:8.1f}us"
+            f" | speaker p99 {speaker['p99_us']:8.1f}us max {speaker['max_us']:8.1f}us"
+            f" | mix max {max_mix_ms:8.1f}ms | peak rss {peak_rss_mb:7.1f}MB"
+        )
+
+    if out is not None:
+        report = {
+            "commit": _commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "sampling_rate": SAMPLING_RATE,
+            "results": results,
+        }
+        out.write_text(json.dumps(report, indent=2))
+        print(f"saved results to {out}")
+
+
+@app.command()
+def compare(baseline: Path, candidate: Path):
+    """prints candidate / baseline ratios for the configs present in both files"""
+    old, new = json.loads(baseline.read_text()), json.loads(candidate.read_text())
+    print(f"{old['commit']} -> {new['commit']}")
+    old_results = {_config_key(result): result for result in old["results"]}
+    for result in new["results"]:
+        key = _config_key(result)
+        if key not in old_results:
+            continue
+        base = old_results[key]
+        ratios = {
+            f"{callback} p99": result[callback]["p99_us"] / base[callback]["p99_us"]
+            for callback in ["mic_callback", "speaker_callback"]
+        }
+        ratios["mix"] = max(mix["duration_ms"] for mix in result["mix"]) / max(
+            mix["duration_ms"] for mix in base["mix"]
+        )
+        ratios["peak rss"] = max(mix["peak_rss_kb"] for mix in result["mix"]) / max(
+            mix["peak_rss_kb"] for mix in base["mix"]
+        )
+        summary = " | ".join(f"{name} x{ratio:.2f}" for name, ratio in ratios.items())
+        print(
+            f"loop {key[0]:>5}s | frames {key[1]:>5} | overdubs {key[2]:>2} | {summary}"
+        )
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,129 @@
+import logging
+import tempfile
+from pathlib import Path
+import numpy as np
+from typer import Typer
+from pilooper.audio_format import AudioFormat
+from pilooper.mixer import Mixer
+from pilooper.render import bounce, read_wav, render
+from pilooper.export import write_file
+from pilooper.session import load_session, save_session
+
+app = Typer()
+
+STEREO_48K = AudioFormat(sample_rate=48_000, channels=2)
+
+
+def _take(rng: np.random.Generator, num_frames: int, channels: int) -> np.ndarray:
+    return rng.integers(-1000, 1000, (num_frames, channels), dtype=np.int16)
+
+
+@app.command()
+def test_format():
+    assert STEREO_48K.frame_bytes == 4
+    assert STEREO_48K.to_frames(STEREO_48K.to_bytes(100)) == 100
+    assert STEREO_48K.frames_in(0.5) == 24_000
+    frames = STEREO_48K.frames(np.arange(8, dtype=np.int16).tobytes())
+    assert frames.shape == (4, 2) and list(frames[1]) == [2, 3]
+    try:
+        AudioFormat(bit_depth=24)
+    except ValueError:
+        pass
+    else:
+        assert False, "24 bit isnt supported"
+
+
+@app.command()
+def test_stereo_mix():
+    rng = np.random.default_rng(0)
+    first, second = _take(rng, 4096, 2), _take(rng, 2048, 2)
+    expected = first.astype(np.int32)
+    expected[:2048] += second
+    expected[2048:] += second
+
+    for kwargs in [{}, {"stream_overdubs": True}, {"layer_budget_seconds": 1}]:
+        mixer = Mixer.create_mixer(
+            track_length_seconds=1,
+            log_level=logging.DEBUG,
+            format=STEREO_48K,
+            **kwargs,
+            fade_seconds=0,
+        )
+        assert mixer.mixed_track.capacity == 48_000
+        for take in [first, second]:
+            mixer.mic_callback(take.tobytes(), len(take), {}, 0)
+            if mixer.stream is not None:
+                mixer.stream_step()
+            mixer.mix()
+        mixer.stop_stream()
+        assert mixer.mixed_track.length == 4096
+        loop = mixer.mixed_track.frames()[:4096]
+        assert np.array_equal(loop, expected), kwargs
+
+        # the speaker plays interleaved frames, with the metronome on both channels
+        mixer.add_metronome(120)
+        out, _ = mixer.speaker_callback(None, 1024, {}, 0)
+        np_out = STEREO_48K.frames(out)
+        assert np_out.shape == (1024, 2)
+        assert np.array_equal(
+            np_out[:, 0] - expected[:1024, 0], np_out[:, 1] - expected[:1024, 1]
+        )
+        assert not np.array_equal(np_out, expected[:1024])
+
+
+@app.command()
+def test_stereo_session():
+    rng = np.random.default_rng(1)
+    mixer = Mixer.create_mixer(
+        track_length_seconds=1, format=STEREO_48K, fade_seconds=0
+    )
+    take = _take(rng, 4096, 2)
+    mixer.mic_callback(take.tobytes(), len(take), {}, 0)
+    mixer.mix()
+
+    with tempfile.TemporaryDirectory() as session_dir:
+        save_session(mixer, Path(session_dir))
+        loaded = Mixer.create_mixer(
+            track_length_seconds=1, format=STEREO_48K, fade_seconds=0
+        )
+        load_session(loaded, Path(session_dir))
+        assert np.array_equal(loaded.mixed_track.frames()[:4096], take)
+
+        mono = Mixer.create_mixer(track_length_seconds=1, fade_seconds=0)
+        try:
+            load_session(mono, Path(session_dir))
+        except RuntimeError:
+            pass
+        else:
+            assert False, "a stereo session cant be loaded into a mono mixer"
+
+
+@app.command()
+def test_render_formats():
+    rng = np.random.default_rng(2)
+    format = AudioFormat(sample_rate=22_050, channels=2)
+    takes = [_take(rng, 8192, 2), _take(rng, 4096, 2)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = [Path(tmp_dir) / f"take_{idx}.wav" for idx in range(len(takes))]
+        for path, take in zip(paths, takes):
+            write_file(path, take, sample_rate=format.sample_rate)
+        out = Path(tmp_dir) / "mix.wav"
+        bounce(
+            paths,
+            out=out,
+            bpm=None,
+            clip_50=False,
+            metronome_bpm=None,
+            latency=0,
+            frame_count=512,
+            stream_overdubs=False,
+            loops=1,
+        )
+        mix, stats = render(takes, frame_count=512, format=format)
+        assert mix.shape == (8192, 2)
+        assert stats.take_seconds == 12288 / 22_050
+        assert np.array_equal(read_wav(out, format), mix)
+
+
+if __name__ == "__main__":
+    app()
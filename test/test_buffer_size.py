@@ -0,0 +1,106 @@
+import tempfile
+import time
+from pathlib import Path
+import pyaudio
+from pilooper.buffer_size import (
+    MIN_FRAMES_PER_BUFFER,
+    SETTLE_SECONDS,
+    BufferSizer,
+    load_buffer_sizes,
+    save_buffer_size,
+)
+from pilooper.instrument import Instrumentation
+from typer import Typer
+
+app = Typer()
+
+
+def play(sizer: BufferSizer, min_glitch_free: int, seconds: float):
+    """simulates a device that underflows below min_glitch_free frames per
+    buffer, polling the sizer every 256 callbacks"""
+    instrumentation = Instrumentation.create()
+    played = 0
+    while played < seconds * instrumentation.sample_rate:
+        size = sizer.frames_per_buffer
+        for idx in range(256):
+            status = 0
+            if size < min_glitch_free and idx == 255:
+                status = pyaudio.paOutputUnderflow
+            instrumentation.speaker.record(time.perf_counter_ns(), size, None, status)
+        played += 256 * size
+        sizer.poll(instrumentation)
+
+
+@app.command()
+def test_grows_until_glitch_free():
+    sizer = BufferSizer.create()
+    assert sizer.frames_per_buffer == MIN_FRAMES_PER_BUFFER
+    play(sizer, min_glitch_free=256, seconds=30)
+    assert sizer.frames_per_buffer == 256
+    assert sizer.settled == 256
+
+
+@app.command()
+def test_shrinks_from_stored_size():
+    # a stored size is only a start, the device might do better now
+    sizer = BufferSizer.create(2048)
+    play(sizer, min_glitch_free=256, seconds=120)
+    assert sizer.frames_per_buffer == 256
+    assert sizer.settled == 256
+    assert sizer.glitched == 128
+
+
+@app.command()
+def test_overload():
+    instrumentation = Instrumentation.create()
+    sizer = BufferSizer.create(256)
+    deadline_ns = 256 / instrumentation.sample_rate * 1e9
+    # past the warmup, a callback close to its deadline counts as a glitch
+    for _ in range(100):
+        instrumentation.speaker.record(time.perf_counter_ns(), 256, None, 0)
+    instrumentation.speaker.record(
+        time.perf_counter_ns() - round(0.9 * deadline_ns), 256, None, 0
+    )
+    assert sizer.poll(instrumentation) == 512
+    assert sizer.settled is None
+
+
+@app.command()
+def test_separate_streams():
+    # the mic and speaker callbacks of separate streams play the same audio,
+    # not one after the other
+    instrumentation = Instrumentation.create()
+    sizer = BufferSizer.create(256)
+    seconds = 0.6 * SETTLE_SECONDS
+    for _ in range(4):
+        for _ in range(round(seconds / 4 * instrumentation.sample_rate / 256)):
+            start_ns = time.perf_counter_ns()
+            instrumentation.mic.record(start_ns, 256, None, 0)
+            instrumentation.speaker.record(start_ns, 256, None, 0)
+        assert sizer.poll(instrumentation) is None
+    assert sizer.settled is None
+
+    # a glitch of either stream counts
+    for _ in range(100):
+        instrumentation.mic.record(
+            time.perf_counter_ns(), 256, None, pyaudio.paInputOverflow
+        )
+    assert sizer.poll(instrumentation) == 512
+
+
+@app.command()
+def test_buffer_size_store():
+    with tempfile.TemporaryDirectory() as store_dir:
+        path = Path(store_dir) / "pilooper" / "buffer_size.json"
+        assert load_buffer_sizes(path) == {}
+        save_buffer_size("00:0C:8A:43:83:85", 1024, path)
+        save_buffer_size("2A:85:3F:3B:7B:D4", 256, path)
+        save_buffer_size("00:0C:8A:43:83:85", 2048, path)
+        assert load_buffer_sizes(path) == {
+            "00:0C:8A:43:83:85": 2048,
+            "2A:85:3F:3B:7B:D4": 256,
+        }
+
+
+if __name__ == "__main__":
+    app()
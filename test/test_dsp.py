@@ -0,0 +1,39 @@
+import pilooper.dsp as dsp
+from typer import Typer
+import numpy as np
+
+app = Typer()
+
+
+@app.command()
+def test_limiter():
+    limiter = dsp.Limiter()
+    frame_count = 1024
+
+    # transparent within int16 range
+    block = np.random.uniform(-32768, 32767, (frame_count, 2)).astype(np.float32)
+    expected = np.rint(block).astype(np.int16)
+    out = np.empty((frame_count, 2), dtype=np.int16)
+    limiter.process(out, block)
+    assert np.array_equal(out, expected)
+    assert limiter.gain == 1.0
+
+    # a block over full scale is scaled down (not clipped flat) past the ramp
+    t = np.arange(frame_count) / 64
+    loud = (60_000 * np.sin(t)).astype(np.float32)
+    limiter.process(out[:, 0], loud.copy())
+    ramp = dsp.LIMITER_RAMP_FRAMES
+    gain = limiter.gain
+    assert gain < 32767 / 59_000
+    assert np.allclose(out[ramp:, 0], np.rint(loud[ramp:] * gain), atol=1)
+    # note : clipped flat, more than half of it would be at full scale
+    assert np.count_nonzero(np.abs(out[ramp:, 0]) >= 32767) < 10
+
+    # and the gain recovers once its quiet again
+    for _ in range(100):
+        limiter.process(out[:, 0], loud.copy() / 4)
+    assert gain < limiter.gain <= 1.0
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,134 @@
+import tempfile
+import time
+from pathlib import Path
+from pilooper.engine import Engine, EngineError, EngineProcess
+from pilooper.track import attach
+from typer import Typer
+import numpy as np
+
+app = Typer()
+
+
+@app.command()
+def test_engine_shared_tracks():
+    with tempfile.TemporaryDirectory() as storage_dir:
+        engine = Engine.create(
+            track_length_seconds=1,
+            storage_dir=Path(storage_dir),
+            shared=True,
+            open_devices=False,
+        )
+
+        num_samples = 44_100 // 2
+        mic_audio = np.random.randint(
+            low=np.iinfo(np.int16).min,
+            high=np.iinfo(np.int16).max,
+            dtype=np.int16,
+            size=num_samples,
+        )
+        engine.record()
+        engine.mixer.mic_callback(mic_audio.tobytes(), num_samples, {}, 0)
+        assert np.array_equal(engine.track("mic"), mic_audio)
+        engine.mix()
+        assert not engine.recording
+        engine.mixer.speaker_track.swap()
+
+        # another process would attach to the same memory
+        path, length = engine.track_info()["loop"]
+        assert path is not None and path.parent == Path(storage_dir)
+        assert length == num_samples
+        # note : the take is faded in / out at its ends
+        expected = mic_audio.reshape(-1, 1).copy()
+        engine.mixer.fade.apply(expected)
+        shared_loop = np.frombuffer(attach(path), dtype=np.float32)[:length]
+        assert np.array_equal(shared_loop, expected[:, 0])
+        assert np.array_equal(engine.track("loop"), expected[:, 0])
+
+        engine.close()
+        assert not path.exists()
+
+
+@app.command()
+def test_engine_shared_session():
+    # a loaded loop stays in shared memory, however the buffers rotate
+    with (
+        tempfile.TemporaryDirectory() as storage_dir,
+        tempfile.TemporaryDirectory() as session_dir,
+    ):
+        engine = Engine.create(
+            track_length_seconds=1,
+            storage_dir=Path(storage_dir),
+            shared=True,
+            open_devices=False,
+        )
+        rng = np.random.default_rng(0)
+
+        def take(num_samples: int) -> np.ndarray:
+            audio = rng.integers(-1000, 1000, num_samples, dtype=np.int16)
+            engine.record()
+            engine.mixer.mic_callback(audio.tobytes(), num_samples, {}, 0)
+            engine.mix()
+            engine.mixer.speaker_track.swap()
+            return audio
+
+        take(4096)
+        loop = engine.track("loop").copy()
+        engine.save_session(Path(session_dir))
+        take(4096)
+        engine.load_session(Path(session_dir))
+        engine.mixer.speaker_track.swap()
+        assert np.array_equal(engine.track("loop"), loop)
+
+        for _ in range(4):
+            take(4096)
+            path, length = engine.track_info()["loop"]
+            assert path is not None and path.parent == Path(storage_dir)
+            shared_loop = np.frombuffer(attach(path), dtype=np.float32)[:length]
+            assert np.array_equal(shared_loop, engine.track("loop"))
+        engine.close()
+
+
+@app.command()
+def test_engine_process():
+    engine = EngineProcess.start(track_length_seconds=1, open_devices=False)
+    try:
+        assert not engine.has_metronome()
+        engine.add_metronome(100)
+        engine.start_metronome()
+        assert engine.has_metronome()
+        engine.set_bpm(100)
+
+        path, length = engine.track_info()["mic"]
+        assert path is not None and path.exists()
+        assert length == 0
+        assert len(engine.track("loop")) == 0
+        assert [stats.name for stats in engine.callback_stats()] == ["mic", "speaker"]
+
+        # errors in the engine are raised in the caller
+        try:
+            engine.dump_callback_stats(Path("/nonexistent/stats.json"))
+            assert False, "expected an EngineError"
+        except EngineError:
+            pass
+
+        # the late reply of a command that timed out isnt taken for the next one
+        engine.replies.put((engine.command_id, True, "late"))
+        time.sleep(0.1)
+        assert engine.track_info()["mic"][1] == 0
+    finally:
+        engine.close()
+    assert not engine.process.is_alive()
+    assert not path.exists()
+
+    # a dead engine fails the calls right away
+    start = time.monotonic()
+    try:
+        engine.has_metronome()
+        assert False, "expected an EngineError"
+    except EngineError:
+        pass
+    assert time.monotonic() - start < 1
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,72 @@
+import logging
+import tempfile
+import wave
+from pathlib import Path
+import numpy as np
+from typer import Typer
+from pilooper.export import Exporter
+from pilooper.mixer import Mixer
+
+app = Typer()
+
+
+def _read_wav(path: Path) -> np.ndarray:
+    with wave.open(str(path), "rb") as wf:
+        return np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+
+
+@app.command()
+def test_copy_on_write():
+    with tempfile.TemporaryDirectory() as out_dir:
+        # numbering continues from whats already there
+        (Path(out_dir) / "track_4.wav").touch()
+        # note : no worker thread, the exports are written below
+        exporter = Exporter(out_dir=Path(out_dir), next_idx=5)
+        source = bytearray(np.arange(200_000, dtype=np.int16).tobytes())
+        np_source = np.frombuffer(source, dtype=np.int16)
+        expected = np_source.copy()
+
+        path = exporter.export(source, np_source[:150_000])
+        assert path.name == "track_5.wav"
+        assert exporter.export(source, np_source[:10]).name == "track_6.wav"
+
+        # the track changes before its written out
+        exporter.preserve(source)
+        np_source[:] = 0
+        exporter.queue.put(None)
+        exporter._worker()
+
+        assert np.array_equal(_read_wav(path), expected[:150_000])
+        assert exporter.pending == []
+        assert Exporter.create(Path(out_dir)).next_idx == 7
+
+
+@app.command()
+def test_mixer_export():
+    for stream_overdubs in [False, True]:
+        mixer = Mixer.create_mixer(
+            track_length_seconds=1,
+            log_level=logging.DEBUG,
+            stream_overdubs=stream_overdubs,
+        )
+        with tempfile.TemporaryDirectory() as out_dir:
+            mixer.exporter = Exporter.create(Path(out_dir))
+            mixer.save_on_mix = True
+            num_samples = 4096
+            mixes = []
+            for _ in range(3):
+                mic_audio = np.random.randint(-1000, 1000, num_samples, dtype=np.int16)
+                mixer.mic_callback(mic_audio.tobytes(), num_samples, {}, 0)
+                mixer.mix()
+                mixes.append(mixer.mixed_track.frames()[:num_samples, 0].copy())
+            mixer.stop_stream()
+            mixer.exporter.close()
+
+            for idx, mix in enumerate(mixes):
+                assert np.array_equal(
+                    _read_wav(Path(out_dir) / f"track_{idx}.wav"), mix
+                )
+
+
+if __name__ == "__main__":
+    app()
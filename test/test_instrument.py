@@ -0,0 +1,80 @@
+import json
+import tempfile
+from pathlib import Path
+import pyaudio
+from pilooper.instrument import CallbackRing, CallbackStats, Column
+from pilooper.mixer import Mixer
+from typer import Typer
+import numpy as np
+
+app = Typer()
+
+
+@app.command()
+def test_callback_ring():
+    ring = CallbackRing.create("speaker", is_output=True, capacity=4)
+    assert len(ring.snapshot()) == 0
+
+    time_info = {"current_time": 1.0, "output_buffer_dac_time": 1.025}
+    for i in range(6):
+        status = pyaudio.paOutputUnderflow if i == 5 else 0
+        ring.record(i, frame_count=256 + i, time_info=time_info, status=status)
+
+    # only the latest capacity records are kept, oldest first
+    records = ring.snapshot()
+    assert records[:, Column.FRAME_COUNT].tolist() == [258, 259, 260, 261]
+    assert ring.snapshot(window=2)[:, Column.FRAME_COUNT].tolist() == [260, 261]
+    assert np.all(records[:, Column.STREAM_LATENCY_NS] == 25_000_000)
+
+    stats = CallbackStats.from_records("speaker", records, sample_rate=44_100)
+    assert stats.count == 4
+    assert stats.output_underflows == 1
+    assert stats.input_overflows == 0
+    assert stats.stream_latency_ms == 25.0
+
+
+@app.command()
+def test_end_to_end_latency():
+    mixer = Mixer.create_mixer(track_length_seconds=1)
+    mixer.set_monitor_gain(1.0)
+    num_samples = 512
+    in_data = np.zeros(num_samples, dtype=np.int16).tobytes()
+    time_info = {
+        "input_buffer_adc_time": 0.99,
+        "current_time": 1.0,
+        "output_buffer_dac_time": 1.02,
+    }
+    mixer.duplex_callback(in_data, num_samples, time_info, 0)
+    _, speaker_stats = mixer.instrumentation.stats()
+    assert speaker_stats.stream_latency_ms == 20.0
+    assert speaker_stats.end_to_end_latency_ms == 30.0
+
+
+@app.command()
+def test_mixer_instrumentation():
+    mixer = Mixer.create_mixer(track_length_seconds=1)
+
+    num_samples = 1024
+    mic_audio = np.zeros(num_samples, dtype=np.int16)
+    mixer.mic_callback(mic_audio.tobytes(), num_samples, {}, pyaudio.paInputOverflow)
+    mixer.mix()
+    for _ in range(3):
+        mixer.speaker_callback(None, num_samples, {}, 0)
+
+    mic_stats, speaker_stats = mixer.instrumentation.stats()
+    assert mic_stats.count == 1
+    assert mic_stats.input_overflows == 1
+    assert speaker_stats.count == 3
+    assert speaker_stats.deadline_us == num_samples / 44_100 * 1e6
+    assert 0 < speaker_stats.runtime_max_us
+
+    with tempfile.TemporaryDirectory() as dump_dir:
+        path = Path(dump_dir) / "stats.json"
+        mixer.instrumentation.dump(path)
+        report = json.loads(path.read_text())
+    assert len(report["records"]["speaker"]["rows"]) == 3
+    assert report["stats"][0]["input_overflows"] == 1
+
+
+if __name__ == "__main__":
+    app()
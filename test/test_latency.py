@@ -0,0 +1,104 @@
+import tempfile
+from pathlib import Path
+import pyaudio
+from pilooper.latency import (
+    CalibrationError,
+    LatencyCalibration,
+    latency_key,
+    load_latencies,
+    save_latency,
+)
+from pilooper.mixer import Mixer
+from typer import Typer
+import numpy as np
+
+app = Typer()
+
+
+def loopback(calibration: LatencyCalibration, latency: int, frame_count: int = 512):
+    """runs the calibration over a simulated (noisy, attenuated) round trip"""
+    rng = np.random.default_rng(0)
+    delay_line = np.zeros(latency, dtype=np.int16)
+    flags = pyaudio.paContinue
+    while flags == pyaudio.paContinue:
+        played = np.concatenate([delay_line, np.zeros(frame_count, np.int16)])
+        in_data = played[:frame_count] // 4 + rng.integers(
+            -200, 200, size=frame_count, dtype=np.int16
+        )
+        out_data, flags = calibration.callback(in_data.tobytes(), frame_count, {}, 0)
+        played[latency:] += np.frombuffer(out_data, np.int16)
+        delay_line = played[frame_count:]
+
+
+@app.command()
+def test_calibration():
+    for latency in [700, 1234, 9_000]:
+        calibration = LatencyCalibration.create()
+        loopback(calibration, latency)
+        assert calibration.done.is_set()
+        assert calibration.latency() == latency
+
+    # nothing comes back
+    calibration = LatencyCalibration.create()
+    calibration.recorded[:] = 0
+    calibration.done.set()
+    try:
+        calibration.latency()
+        assert False, "expected a CalibrationError"
+    except CalibrationError:
+        pass
+
+
+@app.command()
+def test_latency_store():
+    with tempfile.TemporaryDirectory() as store_dir:
+        path = Path(store_dir) / "pilooper" / "latency.json"
+        assert load_latencies(path) == {}
+        save_latency("00:0C:8A:43:83:85", 100, path)
+        save_latency("2A:85:3F:3B:7B:D4", 200, path)
+        save_latency("00:0C:8A:43:83:85", 150, path)
+        assert load_latencies(path) == {
+            "00:0C:8A:43:83:85": 150,
+            "2A:85:3F:3B:7B:D4": 200,
+        }
+        # measured at another buffer size, a latency of its own
+        save_latency(latency_key("00:0C:8A:43:83:85", 256), 180, path)
+        latencies = load_latencies(path)
+        assert latencies[latency_key("00:0C:8A:43:83:85")] == 150
+        assert latencies[latency_key("00:0C:8A:43:83:85", 256)] == 180
+
+
+@app.command()
+def test_latency_compensation():
+    frame_count = 300
+    loop_len = 20 * frame_count
+    latency = 1000
+    mixer = Mixer.create_mixer(track_length_seconds=1, fade_seconds=0)
+    mixer.set_latency(latency)
+
+    loop = np.random.randint(low=-5000, high=5000, dtype=np.int16, size=loop_len)
+    mixer.start_recording()
+    for block in np.split(loop, loop_len // frame_count):
+        mixer.duplex_callback(block.tobytes(), frame_count, {}, 0)
+    mixer.stop_recording()
+    mixer.mix()
+
+    # the overdub plays along in time, but is recorded latency samples late
+    overdub = np.random.randint(low=-5000, high=5000, dtype=np.int16, size=loop_len)
+    recorded = np.roll(overdub, latency)
+    mixer.duplex_callback(bytes(frame_count * 2), frame_count, {}, 0)
+    position = mixer.speaker_track.track.position
+    mixer.start_recording()
+    for block in np.split(recorded, loop_len // frame_count):
+        mixer.duplex_callback(block.tobytes(), frame_count, {}, 0)
+    mixer.stop_recording()
+    mixer.mix()
+    mixer.speaker_track.swap()
+
+    expected = loop + np.roll(overdub, position)
+    np_speaker = mixer.speaker_track.track.frames()[:, 0]
+    assert np.array_equal(np_speaker[:loop_len], expected)
+
+
+if __name__ == "__main__":
+    app()
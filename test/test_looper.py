@@ -17,6 +17,10 @@ def live_test_looper():
     speaker = Speaker.from_bt_headphones(callback=mixer.speaker_callback)
 
     def record():
+        # no overdub stream reserves ahead of the mic, the whole take is
+        # reserved before the callbacks run
+        mixer.reserve_take()
+        assert mixer.mic_track.reserved_idx == len(mixer.mic_track.track.data)
         mic.start()
         time.sleep(record_time_seconds)
         mic.stop()
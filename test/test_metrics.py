@@ -0,0 +1,54 @@
+import pyaudio
+from pilooper.metrics import MetricsExporter
+from pilooper.mixer import Mixer
+from typer import Typer
+import numpy as np
+
+app = Typer()
+
+
+@app.command()
+def test_metrics_exporter():
+    mixer = Mixer.create_mixer(track_length_seconds=1)
+    exporter = MetricsExporter.create(mixer)
+    registry = exporter.metrics.registry
+
+    num_samples = 44_100 // 2
+    mic_audio = np.zeros(num_samples, dtype=np.int16)
+    mixer.mic_callback(mic_audio.tobytes(), num_samples, {}, 0)
+    mixer.mix()
+    mixer.add_metronome(bpm=100)
+    for _ in range(3):
+        mixer.speaker_callback(None, 1024, {}, pyaudio.paOutputUnderflow)
+    exporter.poll()
+
+    def value(name: str, **labels) -> float | None:
+        return registry.get_sample_value(name, labels)
+
+    assert value("pilooper_callback_runtime_seconds_count", callback="speaker") == 3
+    assert value("pilooper_callback_runtime_seconds_count", callback="mic") == 1
+    assert (
+        value("pilooper_xruns_total", callback="speaker", kind="output_underflow") == 3
+    )
+    assert value("pilooper_mix_duration_seconds_count") == 1
+    assert value("pilooper_loop_length_seconds") == 0.5
+    assert value("pilooper_metronome_enabled") == 1
+    assert value("pilooper_metronome_bpm") == 100
+    # the bytes in use : the mic is reserved ahead (here the whole track), the
+    # loop is half a second of float32
+    assert value("pilooper_buffer_bytes", buffer="mic") == 44_100 * 2
+    assert value("pilooper_buffer_bytes", buffer="mixed") == num_samples * 4
+    assert value("pilooper_buffer_bytes", buffer="speaker_front") == num_samples * 4
+
+    # only records written since the last poll are collected
+    mixer.speaker_callback(None, 1024, {}, 0)
+    exporter.poll()
+    assert value("pilooper_callback_runtime_seconds_count", callback="speaker") == 4
+    assert (
+        value("pilooper_xruns_total", callback="speaker", kind="output_underflow") == 3
+    )
+    assert value("pilooper_mix_duration_seconds_count") == 1
+
+
+if __name__ == "__main__":
+    app()
@@ -1,6 +1,8 @@
 import time
 from pilooper.metronome import Metronome
 
+import numpy as np
+
 from pathlib import Path
 from typer import Typer
 import pyaudio
@@ -21,11 +23,15 @@ Pa_Callback_Flags = (
 @app.command()
 def live_test_metronome():
     wav_file = Path("/home/acharyahemanth/dev/drumstick_16.wav")
-    metronome = Metronome.from_file(bpm=100, wav_file=wav_file, track_length_seconds=3)
+    metronome = Metronome.from_file(wav_file=wav_file, bpm=100)
+    position = 0
 
     def speaker_callback(_: None, frame_count: int, __: dict, ___: Pa_Callback_Flags):
-        out_data = metronome.next(frame_count=frame_count)
-        return out_data, pyaudio.paContinue
+        nonlocal position
+        out = np.zeros((frame_count, 1), dtype=np.float32)
+        metronome.mix_into(out, position)
+        position += frame_count
+        return out.astype(np.int16).tobytes(), pyaudio.paContinue
 
     speaker = Speaker.from_bt_headphones(callback=speaker_callback)
     print("playing metronome...")
@@ -1,6 +1,10 @@
 import logging
+import mmap
+import tempfile
+import wave
+from pathlib import Path
 from pilooper.constants import SAMPLING_RATE
-from pilooper.mixer import Mixer
+from pilooper.mixer import Mixer, TileMode
 from typer import Typer
 import numpy as np
 
@@ -9,7 +13,7 @@ app = Typer()
 
 @app.command()
 def test_basic():
-    mixer = Mixer.create_mixer(track_length_seconds=10)
+    mixer = Mixer.create_mixer(track_length_seconds=10, fade_seconds=0)
 
     num_record_samples = 44_100 * 1
     mic_audio_1 = np.random.randint(
@@ -27,26 +31,26 @@ def test_basic():
 
     mixer.mic_callback(mic_audio_1.tobytes(), num_record_samples, 0, {})
     mixer.mix()
+    mixer.speaker_track.swap()
 
-    speaker_audio_1 = np.frombuffer(mixer.speaker_track.track.data, dtype=np.int16)
+    speaker_audio_1 = mixer.speaker_track.track.frames()[:, 0]
     speaker_audio_1 = speaker_audio_1[:num_record_samples]
-    assert mixer.speaker_track.track.length_bytes == num_record_samples * 2
+    assert mixer.speaker_track.track.length == num_record_samples
     assert mixer.speaker_track.track.rw_idx == 0
     assert np.allclose(mic_audio_1, speaker_audio_1)
     print("mix-1 success!")
 
     mixer.mic_callback(mic_audio_2.tobytes(), num_record_samples, 0, {})
     mixer.mix()
+    mixer.speaker_track.swap()
 
-    speaker_audio_2 = np.frombuffer(mixer.speaker_track.track.data, dtype=np.int16)
+    speaker_audio_2 = mixer.speaker_track.track.frames()[:, 0]
     speaker_audio_2 = speaker_audio_2[:num_record_samples]
-    assert mixer.speaker_track.track.length_bytes == num_record_samples * 2
+    assert mixer.speaker_track.track.length == num_record_samples
     assert mixer.speaker_track.track.rw_idx == 0
+    # the mix bus keeps the full sum, its only limited on the way out
     expected_mix = mic_audio_1.astype(np.float32) + mic_audio_2.astype(np.float32)
-    expected_mix = np.clip(
-        expected_mix, a_min=np.iinfo(np.int16).min, a_max=np.iinfo(np.int16).max
-    )
-    assert np.allclose(speaker_audio_2.astype(np.float32), expected_mix)
+    assert np.allclose(speaker_audio_2, expected_mix)
     print("mix-2 success!")
 
     print("TEST PASS!")
@@ -54,7 +58,9 @@ def test_basic():
 
 @app.command()
 def test_track_lengths():
-    mixer = Mixer.create_mixer(track_length_seconds=10, log_level=logging.DEBUG)
+    mixer = Mixer.create_mixer(
+        track_length_seconds=10, log_level=logging.DEBUG, fade_seconds=0
+    )
 
     num_record_samples_long = 44_100 * 2
     num_record_samples_short = 44_100 * 1
@@ -73,22 +79,18 @@ def test_track_lengths():
 
     # check if speaker track is extended correctly
     def check_mix():
+        mixer.speaker_track.swap()
         assert (
-            mixer.speaker_track.track.length_bytes == 2 * num_record_samples_long
+            mixer.speaker_track.track.length == num_record_samples_long
         ), "speaker track is not off correct length"
-        np_speaker = np.frombuffer(mixer.speaker_track.track.data, dtype=np.int16)[
-            :num_record_samples_long
-        ]
+        np_speaker = mixer.speaker_track.track.frames()[:num_record_samples_long, 0]
         np_mic_short_ext = np.concatenate([mic_audio_short, mic_audio_short], axis=0)
 
         expected_mix = mic_audio_long.astype(np.float32) + np_mic_short_ext.astype(
             np.float32
         )
-        expected_mix = np.clip(
-            expected_mix, a_min=np.iinfo(np.int16).min, a_max=np.iinfo(np.int16).max
-        )
 
-        assert np.allclose(np_speaker.astype(np.float32), expected_mix)
+        assert np.allclose(np_speaker, expected_mix)
 
     # record longer track
     mixer.mic_callback(mic_audio_long.tobytes(), num_record_samples_long, 0, {})
@@ -116,9 +118,363 @@ def test_track_lengths():
     print("TEST PASS!")
 
 
+@app.command()
+def test_lcm_tiling():
+    mixer = Mixer.create_mixer(
+        track_length_seconds=1, log_level=logging.DEBUG, fade_seconds=0
+    )
+    mixer.tile_mode = TileMode.LCM
+
+    # 3 beats over 4 beats
+    samples_per_beat = 1000
+    mic_audio_3 = np.random.randint(
+        low=-1000, high=1000, dtype=np.int16, size=3 * samples_per_beat
+    )
+    mic_audio_4 = np.random.randint(
+        low=-1000, high=1000, dtype=np.int16, size=4 * samples_per_beat
+    )
+
+    mixer.mic_callback(mic_audio_3.tobytes(), len(mic_audio_3), 0, {})
+    mixer.mix()
+    mixer.mic_callback(mic_audio_4.tobytes(), len(mic_audio_4), 0, {})
+    mixer.mix()
+    mixer.speaker_track.swap()
+
+    num_lcm_samples = 12 * samples_per_beat
+    assert mixer.speaker_track.track.length == num_lcm_samples
+    np_speaker = mixer.speaker_track.track.frames()[:, 0]
+    expected_mix = np.tile(mic_audio_3, 4) + np.tile(mic_audio_4, 3)
+    assert np.array_equal(np_speaker[:num_lcm_samples], expected_mix)
+
+
+@app.command()
+def test_stream_overdubs():
+    mixer = Mixer.create_mixer(
+        track_length_seconds=3, log_level=logging.DEBUG, fade_seconds=0
+    )
+    streaming_mixer = Mixer.create_mixer(
+        track_length_seconds=3,
+        log_level=logging.DEBUG,
+        stream_overdubs=True,
+        fade_seconds=0,
+    )
+
+    num_block_samples = 1024
+    for idx, num_record_samples in enumerate([44_100 * 1, 44_100 * 2, 30_000, 20_000]):
+        mic_audio = np.random.randint(
+            low=np.iinfo(np.int16).min,
+            high=np.iinfo(np.int16).max,
+            dtype=np.int16,
+            size=num_record_samples - num_record_samples % num_block_samples,
+        )
+        for block in np.split(mic_audio, len(mic_audio) // num_block_samples):
+            mixer.mic_callback(block.tobytes(), len(block), 0, {})
+            streaming_mixer.mic_callback(block.tobytes(), len(block), 0, {})
+            streaming_mixer.stream_step()
+        mixer.mix()
+        streaming_mixer.mix()
+
+        length_bytes = mixer.mixed_track.length_bytes
+        assert streaming_mixer.mixed_track.length_bytes == length_bytes
+        assert (
+            streaming_mixer.mixed_track.data[:length_bytes]
+            == mixer.mixed_track.data[:length_bytes]
+        )
+
+        # the streamed mix is published to the speaker without a copy, the
+        # speaker plays the same loop
+        speaker = streaming_mixer.speaker_track
+        assert speaker.back is not None
+        assert speaker.back.data is streaming_mixer.mixed_track.data
+        assert streaming_mixer.stream is not None
+        buffers = [
+            streaming_mixer.stream.pending_track.data,
+            streaming_mixer.stream.spare,
+            speaker.track.data,
+            speaker.back.data,
+        ]
+        assert len({id(data) for data in buffers}) == 4
+        # note : not on every take, so that some mixes land before the swap
+        if idx % 2 == 0:
+            expected, _ = mixer.speaker_callback(None, 500, {}, None)
+            played, _ = streaming_mixer.speaker_callback(None, 500, {}, None)
+            assert played == expected
+
+    # a stopped take doesnt touch the mix
+    mixed = bytes(streaming_mixer.mixed_track.data)
+    streaming_mixer.mic_callback(mic_audio.tobytes(), len(mic_audio), 0, {})
+    streaming_mixer.stream_step()
+    streaming_mixer.reset_mic_track()
+    assert streaming_mixer.stream is not None
+    assert streaming_mixer.stream.num_mixed == 0
+    assert streaming_mixer.mixed_track.data[:] == mixed
+
+    streaming_mixer.stop_stream()
+
+
+@app.command()
+def test_layers():
+    mixer = Mixer.create_mixer(
+        track_length_seconds=2,
+        log_level=logging.DEBUG,
+        layer_budget_seconds=2,
+        fade_seconds=0,
+    )
+
+    num_record_samples = 44_100 // 2
+    mic_audio = [
+        np.random.randint(low=-10_000, high=10_000, dtype=np.int16, size=size)
+        for size in [num_record_samples, 2 * num_record_samples, 2 * num_record_samples]
+    ]
+
+    def check_speaker(expected: np.ndarray):
+        mixer.speaker_track.swap()
+        assert mixer.speaker_track.track.length == len(expected)
+        np_speaker = mixer.speaker_track.track.frames()[:, 0]
+        assert np.array_equal(np_speaker[: len(expected)], expected)
+
+    for audio in mic_audio[:2]:
+        mixer.mic_callback(audio.tobytes(), len(audio), 0, {})
+        mixer.mix()
+    both = np.tile(mic_audio[0], 2) + mic_audio[1]
+    check_speaker(both)
+
+    mixer.undo()
+    check_speaker(mic_audio[0])
+
+    mixer.redo()
+    check_speaker(both)
+
+    mixer.set_layer_muted(0, True)
+    check_speaker(mic_audio[1])
+    mixer.set_layer_muted(0, False)
+    mixer.set_layer_gain(1, 0.5)
+    half_gain = np.tile(mic_audio[0], 2) + 0.5 * mic_audio[1].astype(np.float32)
+    check_speaker(half_gain)
+    mixer.set_layer_gain(1, 1.0)
+
+    # the third take goes over budget and freezes the first one
+    mixer.mic_callback(mic_audio[2].tobytes(), len(mic_audio[2]), 0, {})
+    mixer.mix()
+    assert mixer.layers is not None
+    assert len(mixer.layers.layers) == 2
+    check_speaker(both + mic_audio[2])
+
+    mixer.undo()
+    mixer.undo()
+    assert not mixer.layers.undo()
+    check_speaker(mic_audio[0])
+
+
+@app.command()
+def test_layers_of_grown_loop():
+    # the 200 frame layer doesnt divide the loop it was added to (300 frames),
+    # which the 400 frame take then makes longer
+    rng = np.random.default_rng(0)
+    takes = [
+        rng.integers(-10_000, 10_000, size, dtype=np.int16) for size in [300, 200, 400]
+    ]
+
+    def mix(takes: list[np.ndarray], fade_seconds: float) -> Mixer:
+        mixer = Mixer.create_mixer(
+            track_length_seconds=1,
+            layer_budget_seconds=1,
+            fade_seconds=fade_seconds,
+        )
+        for take in takes:
+            mixer.mic_callback(take.tobytes(), len(take), 0, {})
+            mixer.mix()
+        return mixer
+
+    def loop(mixer: Mixer) -> np.ndarray:
+        return mixer.mixed_track.frames()[: mixer.mixed_track.length, 0]
+
+    for fade_seconds in [0, 0.001]:
+        mixer = mix(takes, fade_seconds)
+        without = loop(mix([takes[0], takes[2]], fade_seconds))
+        mixer.set_layer_muted(1, True)
+        assert np.allclose(loop(mixer), without, atol=0.1)
+        mixer.set_layer_muted(1, False)
+        mixer.set_layer_gain(1, 0.5)
+        mixer.set_layer_gain(1, 0.0)
+        assert np.allclose(loop(mixer), without, atol=0.1)
+        mixer.set_layer_gain(1, 1.0)
+        assert np.allclose(loop(mixer), loop(mix(takes, fade_seconds)), atol=0.1)
+
+
+@app.command()
+def test_headroom():
+    mixer = Mixer.create_mixer(
+        track_length_seconds=1, log_level=logging.DEBUG, fade_seconds=0
+    )
+
+    # overdubs over full scale arent clipped in the loop : taking them back
+    # out again leaves the loud take as it was
+    loud = np.random.randint(low=20_000, high=32_767, dtype=np.int16, size=4096)
+    for take in [loud, loud, -loud]:
+        mixer.mic_callback(take.tobytes(), len(take), 0, {})
+        mixer.mix()
+    speaker_audio, _ = mixer.speaker_callback(None, len(loud), {}, None)
+    assert np.array_equal(np.frombuffer(speaker_audio, np.int16), loud)
+
+    # the loop is limited on the way out instead
+    mixer.mic_callback(loud.tobytes(), len(loud), 0, {})
+    mixer.mix()
+    speaker_audio, _ = mixer.speaker_callback(None, len(loud), {}, None)
+    np_speaker = np.frombuffer(speaker_audio, np.int16)
+    assert np.all(np_speaker > 0)
+    assert np.corrcoef(np_speaker[1000:], loud[1000:])[0, 1] > 0.99
+
+
+@app.command()
+def test_fades():
+    kwargs = [{}, {"stream_overdubs": True}, {"layer_budget_seconds": 1}]
+    mixers = [
+        Mixer.create_mixer(track_length_seconds=1, log_level=logging.DEBUG, **kw)
+        for kw in kwargs
+    ]
+    # the loop is cut off mid-way through the second take, then tiled to the
+    # length of the third, which cuts off the first take
+    t = np.arange(16_000)
+    takes = [
+        (10_000 * np.sin(t[:length] / period)).astype(np.int16)
+        for length, period in [(10_000, 17), (3000, 23), (16_000, 31)]
+    ]
+
+    def loops() -> list[np.ndarray]:
+        return [
+            mixer.mixed_track.frames()[: mixer.mixed_track.length, 0]
+            for mixer in mixers
+        ]
+
+    def max_step(loop: np.ndarray) -> float:
+        # note : across the loop seam too
+        return np.abs(np.diff(loop, append=loop[:1])).max()
+
+    for idx, take in enumerate(takes):
+        for mixer in mixers:
+            for block in np.split(take, len(take) // 1000):
+                mixer.mic_callback(block.tobytes(), len(block), 0, {})
+                if mixer.stream is not None:
+                    mixer.stream_step()
+            mixer.mix()
+        loop, streamed, layered = loops()
+        assert np.allclose(loop, streamed, atol=0.1)
+        assert np.allclose(loop, layered, atol=0.1)
+        # no clicks : the loop doesnt step further than its takes
+        assert max_step(loop) < 2_000, idx
+        if idx == 1:
+            two_takes = loop.copy()
+
+    # the seam crossfade is taken back with the layer that made the loop longer
+    mixers[2].undo()
+    assert np.allclose(loops()[2], two_takes, atol=0.1)
+    for mixer in mixers:
+        mixer.stop_stream()
+
+
+@app.command()
+def test_master_gain():
+    mixer = Mixer.create_mixer(
+        track_length_seconds=1, log_level=logging.DEBUG, fade_seconds=0
+    )
+    take = np.full(4096, 1000, dtype=np.int16)
+    mixer.mic_callback(take.tobytes(), len(take), 0, {})
+    mixer.mix()
+
+    mixer.set_master_gain(0.5)
+    speaker_audio, _ = mixer.speaker_callback(None, 2048, {}, None)
+    np_speaker = np.frombuffer(speaker_audio, np.int16)
+    # ramped down over the first frames of the block, instead of stepping
+    assert 995 <= np_speaker[0] <= 1000
+    assert np.all(np.diff(np_speaker.astype(np.int32)) <= 0)
+    assert np.all(np_speaker[1024:] == 500)
+    speaker_audio, _ = mixer.speaker_callback(None, 2048, {}, None)
+    assert np.all(np.frombuffer(speaker_audio, np.int16) == 500)
+
+
+@app.command()
+def test_monitoring():
+    mixer = Mixer.create_mixer(
+        track_length_seconds=1, log_level=logging.DEBUG, fade_seconds=0
+    )
+    take = np.full(4096, 1000, dtype=np.int16)
+    mixer.mic_callback(take.tobytes(), len(take), 0, {})
+    mixer.mix()
+
+    # the input is mixed into the output of the same callback, once the
+    # monitor gain has ramped in
+    in_data = np.full(1024, 2000, dtype=np.int16).tobytes()
+    mixer.set_monitor_gain(0.5)
+    for _ in range(2):
+        out_data, _ = mixer.duplex_callback(in_data, 1024, {}, 0)
+    assert np.all(np.frombuffer(out_data, np.int16) == 2000)
+    # monitoring isnt recording
+    assert mixer.mic_track.track.length == 0
+
+    mixer.set_monitor_gain(0.0)
+    for _ in range(2):
+        out_data, _ = mixer.duplex_callback(in_data, 1024, {}, 0)
+    assert np.all(np.frombuffer(out_data, np.int16) == 1000)
+
+
+@app.command()
+def test_mmap_storage():
+    with tempfile.TemporaryDirectory() as storage_dir:
+        mixer = Mixer.create_mixer(
+            track_length_seconds=2,
+            log_level=logging.DEBUG,
+            stream_overdubs=True,
+            storage_dir=Path(storage_dir),
+            fade_seconds=0,
+        )
+        assert isinstance(mixer.mixed_track.data, mmap.mmap)
+
+        num_record_samples = 44_100 * 1
+        mic_audio = [
+            np.random.randint(low=-10_000, high=10_000, dtype=np.int16, size=size)
+            for size in [num_record_samples, 2 * num_record_samples]
+        ]
+        for audio in mic_audio:
+            mixer.mic_callback(audio.tobytes(), len(audio), 0, {})
+            mixer.mix()
+        mixer.stop_stream()
+
+        mixer.speaker_track.swap()
+        expected_mix = np.tile(mic_audio[0], 2) + mic_audio[1]
+        speaker_audio, _ = mixer.speaker_callback(None, len(expected_mix), {}, None)
+        assert np.array_equal(np.frombuffer(speaker_audio, np.int16), expected_mix)
+
+
+@app.command()
+def test_reserve():
+    with tempfile.TemporaryDirectory() as storage_dir:
+        for stream_overdubs in [False, True]:
+            mixer = Mixer.create_mixer(
+                track_length_seconds=5,
+                log_level=logging.DEBUG,
+                stream_overdubs=stream_overdubs,
+                storage_dir=Path(storage_dir),
+            )
+            reserved = mixer.mic_track.reserved_idx
+            assert 0 < reserved < len(mixer.mic_track.track.data)
+
+            # without a stream reserving ahead of the mic, the whole take is
+            # reserved before it starts
+            mixer.start_recording()
+            if stream_overdubs:
+                assert mixer.mic_track.reserved_idx == reserved
+            else:
+                assert mixer.mic_track.reserved_idx == len(mixer.mic_track.track.data)
+            mixer.stop_recording()
+            mixer.stop_stream()
+
+
 @app.command()
 def test_overflow():
-    mixer = Mixer.create_mixer(track_length_seconds=1, log_level=logging.DEBUG)
+    mixer = Mixer.create_mixer(
+        track_length_seconds=1, log_level=logging.DEBUG, fade_seconds=0
+    )
 
     num_record_samples_first = 44_100 * 1
     num_record_samples_second = 44_100 * 1
@@ -137,12 +493,11 @@ def test_overflow():
 
     # check if speaker track is extended correctly
     def check_mix():
+        mixer.speaker_track.swap()
         assert (
-            mixer.speaker_track.track.length_bytes == 2 * num_record_samples_first
+            mixer.speaker_track.track.length == num_record_samples_first
         ), "speaker track is not off correct length"
-        np_speaker = np.frombuffer(mixer.speaker_track.track.data, dtype=np.int16)[
-            :num_record_samples_first
-        ]
+        np_speaker = mixer.speaker_track.track.frames()[:num_record_samples_first, 0]
         assert np.allclose(np_speaker, mic_audio_first)
 
     # record first track
@@ -152,13 +507,16 @@ def test_overflow():
     mixer.mic_callback(mic_audio_second.tobytes(), num_record_samples_second, 0, {})
 
     mixer.mix()
+    mixer.speaker_track.swap()
 
     check_mix()
 
 
 @app.command()
 def test_speaker_loop():
-    mixer = Mixer.create_mixer(track_length_seconds=2, log_level=logging.DEBUG)
+    mixer = Mixer.create_mixer(
+        track_length_seconds=2, log_level=logging.DEBUG, fade_seconds=0
+    )
 
     num_record_samples = 44_100 * 1
     mic_audio = np.random.randint(
@@ -202,19 +560,69 @@ def test_speaker_loop():
 
 
 @app.command()
-def test_metronome():
-    mixer = Mixer.create_mixer(track_length_seconds=1, log_level=logging.DEBUG)
-    mixer.add_metronome(bpm=100)
+def test_duplex_alignment():
+    frame_count = 300
+    loop_len = 33 * frame_count
+
+    def duplex(mixer: Mixer, in_audio: np.ndarray) -> np.ndarray:
+        out_data, _ = mixer.duplex_callback(in_audio.tobytes(), frame_count, {}, 0)
+        return np.frombuffer(out_data, np.int16).copy()
+
+    def record(mixer: Mixer, take: np.ndarray) -> np.ndarray:
+        mixer.start_recording()
+        heard = []
+        for block in np.split(take, len(take) // frame_count):
+            heard.append(duplex(mixer, block))
+            # mix while recording (the stream worker might do this as well)
+            if mixer.stream is not None:
+                mixer.stream_step()
+        mixer.stop_recording()
+        mixer.mix()
+        return np.concatenate(heard)
+
+    for kwargs in [{}, {"stream_overdubs": True}, {"layer_budget_seconds": 1}]:
+        mixer = Mixer.create_mixer(track_length_seconds=1, **kwargs, fade_seconds=0)
+        silence = np.zeros(frame_count, dtype=np.int16)
+
+        # nothing is recorded unless recording
+        duplex(mixer, np.ones(frame_count, dtype=np.int16))
+        assert mixer.mic_track.track.length_bytes == 0
+
+        takes = [
+            np.random.randint(low=-5000, high=5000, dtype=np.int16, size=size)
+            for size in [loop_len, loop_len, 10 * frame_count]
+        ]
+        record(mixer, takes[0])
+        expected = takes[0].astype(np.int32)
 
-    assert mixer.metronome is not None, "metronome not added successfully"
+        for take in takes[1:]:
+            # the loop plays on for a bit before the overdub starts
+            for _ in range(4):
+                duplex(mixer, silence)
+            position = mixer.speaker_track.track.position
+            heard = record(mixer, take)
 
-    # check if metronome is added to the speaker track
-    np_metronome = np.frombuffer(mixer.metronome.track.data, dtype=np.int16)
-    np_speaker = np.frombuffer(mixer.speaker_track.track.data, dtype=np.int16)
-    assert np.allclose(np_metronome, np_speaker)
+            # the take is heard along with the loop from position on ...
+            idx = (position + np.arange(len(take))) % loop_len
+            assert np.array_equal(heard, expected[idx])
+            # ... and mixed in at position (tiled, if its shorter than the loop)
+            expected = expected + take[(np.arange(loop_len) - position) % len(take)]
 
-    # record and check if it plays with the metronome
-    num_record_samples = 44_100 * 1
+            mixer.speaker_track.swap()
+            np_speaker = mixer.speaker_track.track.frames()[:, 0]
+            assert mixer.speaker_track.track.length == loop_len, kwargs
+            assert np.array_equal(np_speaker[:loop_len], expected), kwargs
+        mixer.stop_stream()
+
+
+@app.command()
+def test_speaker_short_loop():
+    mixer = Mixer.create_mixer(
+        track_length_seconds=1, log_level=logging.DEBUG, fade_seconds=0
+    )
+
+    # loop is shorter than a single speaker callback
+    num_record_samples = 300
     mic_audio = np.random.randint(
         low=np.iinfo(np.int16).min,
         high=np.iinfo(np.int16).max,
@@ -222,31 +630,88 @@ def test_metronome():
         size=num_record_samples,
     )
     mixer.mic_callback(mic_audio.tobytes(), num_record_samples, 0, {})
+    mixer.mix()
+
+    num_samples_to_read = 1024
+    full_speaker_audio = bytearray(0)
+    for _ in range(3):
+        speaker_audio, _ = mixer.speaker_callback(None, num_samples_to_read, {}, None)
+        assert len(speaker_audio) == num_samples_to_read * 2
+        full_speaker_audio.extend(speaker_audio)
+
+    np_speaker = np.frombuffer(full_speaker_audio, dtype=np.int16)
+    np_mic_tiled = np.tile(mic_audio, 3 * num_samples_to_read // num_record_samples + 1)
+    assert np.allclose(np_speaker, np_mic_tiled[: len(np_speaker)])
 
+
+@app.command()
+def test_metronome():
+    mixer = Mixer.create_mixer(
+        track_length_seconds=1, log_level=logging.DEBUG, fade_seconds=0
+    )
+
+    # click is shorter than a beat, at 100 bpm beats are exactly 26460 samples
+    click = np.random.randint(low=-1000, high=1000, dtype=np.int16, size=1000)
+    with tempfile.TemporaryDirectory() as wav_dir:
+        wav_file = Path(wav_dir) / "click.wav"
+        with wave.open(str(wav_file), "wb") as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(SAMPLING_RATE)
+            wf.writeframes(click.tobytes())
+        mixer.add_metronome(bpm=100, wav_file=wav_file)
+    assert mixer.metronome is not None, "metronome not added successfully"
+
+    num_samples = 44_100 * 1
+    np_metronome = np.zeros(num_samples, dtype=np.int16)
+    for beat_start in [0, 26460]:
+        np_metronome[beat_start : beat_start + len(click)] = click
+
+    # metronome plays without anything being recorded
+    speaker_audio, _ = mixer.speaker_callback(None, num_samples, {}, None)
+    assert np.array_equal(np.frombuffer(speaker_audio, np.int16), np_metronome)
+
+    # record and check if it plays with the metronome (from the top of the loop)
+    # note : with headroom for the click, the limiter stays out of it
+    mic_audio = np.random.randint(
+        low=-30_000, high=30_000, dtype=np.int16, size=num_samples
+    )
+    mixer.mic_callback(mic_audio.tobytes(), num_samples, 0, {})
     mixer.mix()
+    mixer.speaker_track.swap()
 
-    np_speaker = np.frombuffer(mixer.speaker_track.track.data, dtype=np.int16)
     expected_mix = mic_audio.astype(np.float32) + np_metronome.astype(np.float32)
     expected_mix = np.clip(
         expected_mix, a_min=np.iinfo(np.int16).min, a_max=np.iinfo(np.int16).max
     )
+    speaker_audio, _ = mixer.speaker_callback(None, num_samples, {}, None)
+    np_speaker = np.frombuffer(speaker_audio, np.int16)
     assert np.allclose(np_speaker.astype(np.float32), expected_mix)
 
     # stop metronome and check if you get just mic audio
     mixer.stop_metronome()
-    np_speaker = np.frombuffer(mixer.speaker_track.track.data, dtype=np.int16)
-    assert np.allclose(np_speaker.astype(np.float32), mic_audio)
+    speaker_audio, _ = mixer.speaker_callback(None, num_samples, {}, None)
+    assert np.array_equal(np.frombuffer(speaker_audio, np.int16), mic_audio)
 
     # start metronome and check if its added
     mixer.start_metronome()
-    np_speaker = np.frombuffer(mixer.speaker_track.track.data, dtype=np.int16)
+    speaker_audio, _ = mixer.speaker_callback(None, num_samples, {}, None)
+    np_speaker = np.frombuffer(speaker_audio, np.int16)
     assert np.allclose(np_speaker.astype(np.float32), expected_mix)
 
+    # changing the bpm doesnt need a new metronome
+    metronome = mixer.metronome
+    mixer.add_metronome(bpm=120)
+    assert mixer.metronome is metronome
+    assert mixer.metronome.samples_per_beat == 22050
+
 
 @app.command()
 def test_bpm():
     bpm = 100
-    mixer = Mixer.create_mixer(track_length_seconds=1, log_level=logging.DEBUG)
+    mixer = Mixer.create_mixer(
+        track_length_seconds=1, log_level=logging.DEBUG, fade_seconds=0
+    )
     mixer.set_bpm(bpm)
 
     samples_per_minute = SAMPLING_RATE * 60
@@ -263,11 +728,12 @@ def test_bpm():
     mixer.mic_callback(mic_audio.tobytes(), num_record_samples, 0, {})
 
     mixer.mix()
+    mixer.speaker_track.swap()
 
     # check that the last sample is rejected
-    np_speaker = np.frombuffer(mixer.speaker_track.track.data, dtype=np.int16)
-    assert mixer.speaker_track.track.length_bytes == (len(mic_audio) - 1) * 2
-    np_speaker = np_speaker[: mixer.speaker_track.track.length_bytes // 2]
+    np_speaker = mixer.speaker_track.track.frames()[:, 0]
+    assert mixer.speaker_track.track.length == (len(mic_audio) - 1)
+    np_speaker = np_speaker[: mixer.speaker_track.track.length]
     assert np.allclose(np_speaker, mic_audio[:-1])
 
 
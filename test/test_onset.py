@@ -0,0 +1,178 @@
+import logging
+import numpy as np
+from typer import Typer
+from pilooper.constants import SAMPLING_RATE
+from pilooper.mixer import Mixer
+from pilooper.onset import trim_take
+import pilooper.dsp as dsp
+
+app = Typer()
+
+BPM = 120
+SAMPLES_PER_BEAT = dsp.samples_per_beat(BPM, SAMPLING_RATE)
+
+
+def _take(
+    num_samples: int, first_note: int, clicks: list[int], seed: int = 0
+) -> np.ndarray:
+    """a decaying note on every beat from first_note on, over a noise floor,
+    with a pedal click (a short burst of noise) at each of clicks"""
+    rng = np.random.default_rng(seed)
+    take = rng.normal(0, 30, num_samples)
+    t = np.arange(int(SAMPLES_PER_BEAT)) / SAMPLING_RATE
+    note = 6000 * np.sin(2 * np.pi * 220 * t) * np.exp(-t * 4)
+    for beat in np.arange(first_note, num_samples, SAMPLES_PER_BEAT).astype(int):
+        n = min(len(note), num_samples - beat)
+        take[beat : beat + n] += note[:n]
+    click_len = int(0.004 * SAMPLING_RATE)
+    for click in clicks:
+        take[click : click + click_len] += rng.normal(0, 12000, click_len) * np.exp(
+            -np.arange(click_len) / 40
+        )
+    return np.clip(take, -32768, 32767).astype(np.int16)
+
+
+@app.command()
+def test_trim_first_take():
+    num_samples = 20 * SAMPLING_RATE
+    first_note = 9000
+    stop_click = num_samples - 4000
+    take = _take(num_samples, first_note, clicks=[1300, stop_click])
+
+    trim = trim_take(take, SAMPLES_PER_BEAT, None, SAMPLING_RATE)
+    # starts on the first note (to the analysis block), a whole number of beats
+    # long, and ends before the stop click
+    assert first_note - 256 <= trim.start <= first_note
+    num_beats = (trim.end - trim.start) / SAMPLES_PER_BEAT
+    assert abs(num_beats - round(num_beats)) * SAMPLES_PER_BEAT < 1
+    assert trim.end <= stop_click
+    assert trim.mute == []
+
+    # on the metronome grid instead
+    phase = 1000.0
+    trim = trim_take(take, SAMPLES_PER_BEAT, phase, SAMPLING_RATE)
+    assert (trim.start - phase) % SAMPLES_PER_BEAT < 1
+
+
+@app.command()
+def test_trim_overdub():
+    num_samples = 10 * SAMPLING_RATE
+    start_click, stop_click = 1300, num_samples - 4000
+    take = _take(num_samples, 5000, clicks=[start_click, stop_click])
+
+    trim = trim_take(take, SAMPLES_PER_BEAT, None, SAMPLING_RATE, keep_start=True)
+    assert trim.start == 0
+    # whole beats from its start (not the loop grid), nearest the stop click
+    num_beats = round(trim.end / SAMPLES_PER_BEAT)
+    assert trim.end == round(num_beats * SAMPLES_PER_BEAT)
+    assert abs(trim.end - stop_click) <= SAMPLES_PER_BEAT / 2
+    assert trim.end <= num_samples
+    # the start click is silenced, the note after it isnt
+    ((mute_start, mute_end),) = [m for m in trim.mute if m[0] < num_samples // 2]
+    assert mute_start <= start_click < start_click + 100 < mute_end < 5000
+
+
+@app.command()
+def test_mixer_trims_takes():
+    for stream_overdubs in [False, True]:
+        mixer = Mixer.create_mixer(
+            track_length_seconds=30,
+            log_level=logging.DEBUG,
+            stream_overdubs=stream_overdubs,
+            fade_seconds=0,
+        )
+        try:
+            mixer.set_bpm(BPM)
+            num_samples = 20 * SAMPLING_RATE
+            first_note = 9000
+            take = _take(num_samples, first_note, clicks=[1300, num_samples - 4000])
+            frame_count = 1024
+            for start in range(0, num_samples - frame_count, frame_count):
+                block = take[start : start + frame_count]
+                mixer.mic_callback(block.tobytes(), frame_count, {}, 0)
+                if stream_overdubs:
+                    mixer.stream_step()
+            mixer.mix()
+
+            # the loop is the take from its first note on, without the clicks
+            loop_len = mixer.mixed_track.length
+            assert (
+                abs(loop_len / SAMPLES_PER_BEAT - round(loop_len / SAMPLES_PER_BEAT))
+                < 1e-3
+            )
+            np_mixed = mixer.mixed_track.frames()[:, 0]
+            start = np.flatnonzero(
+                np.all(
+                    np.lib.stride_tricks.sliding_window_view(take, 64) == np_mixed[:64],
+                    axis=1,
+                )
+            )
+            assert len(start) == 1
+            assert first_note - 256 <= start[0] <= first_note
+            assert np.array_equal(
+                np_mixed[:loop_len], take[start[0] : start[0] + loop_len]
+            )
+
+            # an overdub keeps its start, only its click is silenced (streamed
+            # or not)
+            loop = np_mixed[:loop_len].copy()
+            overdub = _take(loop_len, 5000, clicks=[1300], seed=1)
+            for start in range(0, loop_len - frame_count, frame_count):
+                block = overdub[start : start + frame_count]
+                mixer.mic_callback(block.tobytes(), frame_count, {}, 0)
+                if stream_overdubs:
+                    mixer.stream_step()
+            mixer.mix()
+            assert mixer.mixed_track.length == loop_len
+            # note : the streamed mix swaps buffers
+            np_mixed = mixer.mixed_track.frames()[:, 0]
+            assert np.array_equal(np_mixed[1300:1400], loop[1300:1400])
+            assert not np.array_equal(np_mixed[5000:6000], loop[5000:6000])
+        finally:
+            mixer.stop_stream()
+
+
+@app.command()
+def test_overdubs_keep_whole_beats():
+    # an overdub that starts between beats and is longer than the loop sets
+    # the loop length, which has to stay whole beats
+    bpm, frame_count = 97, 512
+    samples_per_beat = dsp.samples_per_beat(bpm, SAMPLING_RATE)
+    for stream_overdubs in [False, True]:
+        mixer = Mixer.create_mixer(
+            track_length_seconds=30,
+            log_level=logging.DEBUG,
+            stream_overdubs=stream_overdubs,
+            fade_seconds=0,
+        )
+        try:
+            mixer.set_bpm(bpm)
+            takes = [
+                _take(round(3.3 * samples_per_beat), 3000, clicks=[1300]),
+                _take(round(5.6 * samples_per_beat), 3000, clicks=[1300], seed=1),
+            ]
+            for idx, take in enumerate(takes):
+                # the loop plays on for a bit, the overdub starts mid-beat
+                for _ in range(7 * idx):
+                    mixer.duplex_callback(bytes(2 * frame_count), frame_count, {}, 0)
+                mixer.start_recording()
+                for start in range(0, len(take) - frame_count, frame_count):
+                    block = take[start : start + frame_count]
+                    mixer.duplex_callback(block.tobytes(), frame_count, {}, 0)
+                    if stream_overdubs:
+                        mixer.stream_step()
+                mixer.stop_recording()
+                if idx:
+                    assert mixer.mic_track.loop_offset % samples_per_beat > 1
+                mixer.mix()
+
+                loop_len = mixer.mixed_track.length
+                num_beats = round(loop_len / samples_per_beat)
+                assert loop_len == round(num_beats * samples_per_beat)
+            assert mixer.mixed_track.length > round(3 * samples_per_beat)
+        finally:
+            mixer.stop_stream()
+
+
+if __name__ == "__main__":
+    app()
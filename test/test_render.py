@@ -0,0 +1,67 @@
+import tempfile
+from pathlib import Path
+import numpy as np
+from typer import Typer
+from pilooper.constants import SAMPLING_RATE
+from pilooper.export import write_file
+from pilooper.render import bounce, read_wav, render
+
+app = Typer()
+
+
+@app.command()
+def test_render():
+    rng = np.random.default_rng(0)
+    takes = [rng.integers(-1000, 1000, n, dtype=np.int16) for n in [8192, 4096]]
+    expected = takes[0].astype(np.int32)
+    expected[:4096] += takes[1]
+    expected[4096:] += takes[1]
+
+    for stream_overdubs in [False, True]:
+        mix, stats = render(
+            takes,
+            frame_count=512,
+            stream_overdubs=stream_overdubs,
+            num_loops=2,
+            fade_seconds=0,
+        )
+        assert np.array_equal(mix[:, 0], np.tile(expected, 2))
+        assert stats.take_seconds == 12288 / SAMPLING_RATE
+        assert len(stats.mix_seconds) == 2
+
+    # the metronome is only in the bounce, not in the loop
+    mix, _ = render(takes, frame_count=512, metronome_bpm=120, fade_seconds=0)
+    assert len(mix) == len(expected)
+    assert not np.array_equal(mix[:, 0], expected)
+
+
+@app.command()
+def test_bounce():
+    rng = np.random.default_rng(1)
+    takes = [
+        rng.integers(-1000, 1000, SAMPLING_RATE + 2048, dtype=np.int16) for _ in "ab"
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = [Path(tmp_dir) / f"take_{idx}.wav" for idx in range(len(takes))]
+        for path, take in zip(paths, takes):
+            write_file(path, take)
+        out = Path(tmp_dir) / "mix.wav"
+        bounce(
+            paths,
+            out=out,
+            bpm=120,
+            clip_50=False,
+            metronome_bpm=None,
+            latency=0,
+            frame_count=1024,
+            stream_overdubs=False,
+            loops=1,
+        )
+        # the same as rendering the takes directly, beat synced to 2 beats
+        mix, _ = render(takes, bpm=120)
+        assert np.array_equal(read_wav(out), mix)
+        assert len(mix) == SAMPLING_RATE
+
+
+if __name__ == "__main__":
+    app()
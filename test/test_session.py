@@ -0,0 +1,146 @@
+import logging
+import tempfile
+from pathlib import Path
+import numpy as np
+from typer import Typer
+from pilooper.mixer import Mixer
+from pilooper.session import load_session, save_session
+
+app = Typer()
+
+
+def _record(mixer: Mixer, num_samples: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    take = rng.integers(-1000, 1000, num_samples, dtype=np.int16)
+    mixer.mic_callback(take.tobytes(), num_samples, {}, 0)
+    mixer.mix()
+    return take
+
+
+def _loop(mixer: Mixer) -> np.ndarray:
+    length = mixer.mixed_track.length
+    return mixer.mixed_track.frames()[:, 0][:length].copy()
+
+
+@app.command()
+def test_save_load():
+    mixer = Mixer.create_mixer(
+        track_length_seconds=1, log_level=logging.DEBUG, fade_seconds=0
+    )
+    mixer.add_metronome(100)
+    mixer.start_metronome()
+    mixer.set_clip50(True)
+    for seed in range(2):
+        _record(mixer, 4096, seed)
+    loop = _loop(mixer)
+
+    with tempfile.TemporaryDirectory() as session_dir:
+        save_session(mixer, Path(session_dir))
+        loop_file = (Path(session_dir) / "loop.raw").read_bytes()
+
+        loaded = Mixer.create_mixer(
+            track_length_seconds=1, log_level=logging.DEBUG, fade_seconds=0
+        )
+        session = load_session(loaded, Path(session_dir))
+        assert session["clip_50"] and loaded.clip_50
+        assert loaded.metronome is not None and loaded.metronome.enabled
+        assert loaded.metronome.bpm == 100
+        assert np.array_equal(_loop(loaded), loop)
+
+        # the loaded loop plays, and takes mix into it without touching the
+        # session files
+        loaded.stop_metronome()
+        loaded.speaker_track.swap()
+        np_speaker = loaded.speaker_track.track.frames()[:, 0]
+        assert np.array_equal(np_speaker[: len(loop)], loop)
+        loaded.set_clip50(False)
+        take = _record(loaded, len(loop), seed=2)
+        expected = np.clip(loop.astype(np.int32) + take, -32768, 32767)
+        assert np.array_equal(_loop(loaded), expected)
+        assert (Path(session_dir) / "loop.raw").read_bytes() == loop_file
+
+
+@app.command()
+def test_load_streamed():
+    # the streamed loop is shared with the speaker, loading doesnt overwrite it
+    # while it plays
+    mixer = Mixer.create_mixer(
+        track_length_seconds=1, log_level=logging.DEBUG, fade_seconds=0
+    )
+    loop = _record(mixer, 4096, seed=0)
+    streamed = Mixer.create_mixer(
+        track_length_seconds=1,
+        log_level=logging.DEBUG,
+        fade_seconds=0,
+        stream_overdubs=True,
+    )
+    playing = _record(streamed, 2048, seed=1)
+    streamed.speaker_track.swap()
+
+    with tempfile.TemporaryDirectory() as session_dir:
+        save_session(mixer, Path(session_dir))
+        load_session(streamed, Path(session_dir))
+        np_speaker = streamed.speaker_track.track.frames()[:, 0]
+        assert np.array_equal(np_speaker[: len(playing)], playing)
+        streamed.speaker_track.swap()
+        np_speaker = streamed.speaker_track.track.frames()[:, 0]
+        assert np.array_equal(np_speaker[: len(loop)], loop)
+
+        take = _record(streamed, len(loop), seed=2)
+        assert np.array_equal(_loop(streamed), loop + take)
+    streamed.stop_stream()
+
+
+@app.command()
+def test_save_load_layers():
+    mixer = Mixer.create_mixer(
+        track_length_seconds=1,
+        log_level=logging.DEBUG,
+        layer_budget_seconds=1,
+        fade_seconds=0,
+    )
+    first = _record(mixer, 2048, seed=0)
+    _record(mixer, 4096, seed=1)
+    mixer.set_layer_gain(1, 0.5)
+    loop = _loop(mixer)
+
+    with tempfile.TemporaryDirectory() as session_dir:
+        save_session(mixer, Path(session_dir))
+        loaded = Mixer.create_mixer(
+            track_length_seconds=1,
+            log_level=logging.DEBUG,
+            layer_budget_seconds=1,
+            fade_seconds=0,
+        )
+        load_session(loaded, Path(session_dir))
+        assert np.array_equal(_loop(loaded), loop)
+        assert loaded.layers is not None
+        assert [layer.gain for layer in loaded.layers.layers] == [1.0, 0.5]
+
+        # the layers can still be undone
+        loaded.undo()
+        assert np.array_equal(_loop(loaded), first)
+
+        # saving fewer layers removes the files of the others
+        save_session(loaded, Path(session_dir))
+        assert not (Path(session_dir) / "layer_1.raw").exists()
+        load_session(loaded, Path(session_dir))
+        assert np.array_equal(_loop(loaded), first)
+
+        # a session without layers becomes the base of the layers
+        plain = Mixer.create_mixer(
+            track_length_seconds=1, log_level=logging.DEBUG, fade_seconds=0
+        )
+        _record(plain, 1024, seed=3)
+        save_session(plain, Path(session_dir))
+        load_session(loaded, Path(session_dir))
+        assert np.array_equal(_loop(loaded), _loop(plain))
+        assert loaded.layers.layers == []
+        assert sorted(path.name for path in Path(session_dir).iterdir()) == [
+            "loop.raw",
+            "session.json",
+        ]
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,82 @@
+from threading import Lock
+from pilooper.audio_format import DEFAULT_FORMAT
+from pilooper.track import MicTrack, RingBuffer, SpeakerTrack, Track, allocate
+from typer import Typer
+import numpy as np
+
+app = Typer()
+
+
+@app.command()
+def test_ring_buffer():
+    ring = RingBuffer(data=bytearray(10))
+    assert ring.write(b"abcdef") == 6
+    assert ring.writable() == 4
+
+    out = bytearray(4)
+    assert ring.read_into(out) == 4
+    assert out == b"abcd"
+
+    # wraps around the end of the buffer
+    assert ring.write(b"ghijklmnop") == 8
+    assert ring.writable() == 0
+    assert ring.write(b"q") == 0
+
+    out = bytearray(20)
+    assert ring.read_into(out) == 10
+    assert out[:10] == b"efghijklmn"
+    assert ring.readable() == 0
+
+
+@app.command()
+def test_speaker_double_buffer():
+    # note : the loop is on the (float32) mix bus, the output int16
+    mutex, bus = Lock(), DEFAULT_FORMAT.bus
+    speaker = SpeakerTrack(
+        track=Track(data=bytearray(32), mutex=mutex, format=bus),
+        back=Track(data=bytearray(32), mutex=mutex, format=bus),
+    )
+    assert bytes(speaker.next(frame_count=4)) == bytes(8)
+
+    def _publish(loop: np.ndarray, at_boundary: bool = False):
+        back = np.frombuffer(speaker.back_buffer(), dtype=np.float32)
+        back[: len(loop)] = loop
+        speaker.publish(loop.nbytes, at_boundary=at_boundary)
+
+    loop = np.arange(6, dtype=np.float32)
+    _publish(loop)
+    np_speaker = np.frombuffer(speaker.next(frame_count=4), dtype=np.int16)
+    assert np.array_equal(np_speaker, [0, 1, 2, 3])
+
+    # new content continues from the current play position
+    _publish(loop * 2)
+    np_speaker = np.frombuffer(speaker.next(frame_count=4), dtype=np.int16)
+    assert np.array_equal(np_speaker, [8, 10, 0, 2])
+
+    # new content waits for the end of the current loop
+    _publish(loop * 3, at_boundary=True)
+    np_speaker = np.frombuffer(speaker.next(frame_count=6), dtype=np.int16)
+    assert np.array_equal(np_speaker, [4, 6, 8, 10, 0, 3])
+
+
+@app.command()
+def test_mic_reserve():
+    mic = MicTrack(track=Track(data=allocate(4096 * 10), mutex=Lock()))
+    mic.reserve(4096 * 3)
+    assert mic.reserved_idx == 4096 * 3
+
+    # reserved memory is kept across takes
+    mic_audio = np.arange(4096, dtype=np.int16)
+    mic.save(mic_audio.tobytes(), len(mic_audio))
+    mic.reserve(4096 * 3)
+    assert mic.reserved_idx == 4096 * 5
+    mic.reset()
+    mic.reserve(4096 * 3)
+    assert mic.reserved_idx == 4096 * 5
+
+    # doesnt change whats been recorded
+    assert np.array_equal(np.frombuffer(mic.track.data, np.int16)[:4096], mic_audio)
+
+
+if __name__ == "__main__":
+    app()